@@ -1,6 +1,37 @@
-""" RC4 compatible algorithm """
+""" RC4 compatible algorithm
 
-def arcfour(key, in_bytes, loops=20):
+Run without arguments for the self test and benchmark, or encrypt files::
+
+    $ python3 arcfour.py -k secret a.bin -o a.rc4 --verify
+    a.bin -> a.rc4: 3000000 bytes in 0.44s, 6.53 MB/s
+    verify: OK
+
+Without -o the file is encrypted in place. RC4 is symmetric, so running
+the same command on the output decrypts it.
+"""
+
+import os
+import sys
+import mmap
+import time
+import hashlib
+import argparse
+
+try:
+    import numpy
+except ImportError:  # numpy is optional: XOR whole blocks as big ints instead
+    numpy = None
+
+# keystream bytes generated per block by the 'block' engine
+BLOCK_SIZE = 2**16
+
+ENGINES = ('byte', 'block')
+
+# bytes mapped and processed per step by the file encryption CLI
+CHUNK_SIZE = 2**24
+
+
+def key_schedule(key, loops=20):
 
     kbox = bytearray(256)  # create key box
     for i, car in enumerate(key):  # copy key and vector
@@ -20,6 +51,19 @@ def arcfour(key, in_bytes, loops=20):
             j = (j + sbox[i] + kbox[i]) % 256
             sbox[i], sbox[j] = sbox[j], sbox[i]
 
+    return sbox
+
+
+def arcfour(key, in_bytes, loops=20, engine='block'):
+    """ engine='byte' is the original loop, 'block' is faster, same output """
+    if engine == 'block':
+        return arcfour_block(key, in_bytes, loops)
+    if engine != 'byte':
+        raise ValueError('unknown engine %r, expected one of %r'
+                         % (engine, ENGINES))
+
+    sbox = key_schedule(key, loops)
+
     # main loop
     i = 0
     j = 0
@@ -41,17 +85,211 @@ def arcfour(key, in_bytes, loops=20):
     return out_bytes
 
 
+def keystream_into(sbox, i, j, out):
+    """ fill out with keystream bytes, return the new (i, j) """
+    # plain lists index faster than bytearrays; copy sbox back at the end
+    box = list(sbox)
+    stream = [0] * len(out)
+    for n in range(len(out)):
+        i = (i + 1) & 255
+        si = box[i]
+        j = (j + si) & 255
+        box[i] = sj = box[j]
+        box[j] = si
+        stream[n] = box[(si + sj) & 255]
+    sbox[:] = bytes(box)
+    out[:] = bytes(stream)
+    return i, j
+
+
+def xor_into(data, keystream, out):
+    """ out[:] = data ^ keystream, all three of the same length """
+    if numpy is not None:
+        numpy.bitwise_xor(numpy.frombuffer(data, numpy.uint8),
+                          numpy.frombuffer(keystream, numpy.uint8),
+                          out=numpy.frombuffer(out, numpy.uint8))
+        return
+    size = len(out)
+    value = (int.from_bytes(data, 'little') ^
+             int.from_bytes(keystream, 'little'))
+    out[:] = value.to_bytes(size, 'little')
+
+
+class ARC4:
+    """ stateful cipher: the key schedule runs once, then update() streams """
+
+    def __init__(self, key, loops=20):
+        self._initial = bytes(key_schedule(key, loops))
+        self._keystream = bytearray(BLOCK_SIZE)
+        self.reset()
+
+    def reset(self):
+        """ restart the keystream, reusing the key schedule """
+        self.sbox = bytearray(self._initial)
+        self.i = 0
+        self.j = 0
+
+    def update(self, chunk):
+        out = bytearray(len(memoryview(chunk).cast('B')))
+        self.update_into(chunk, out)
+        return out
+
+    def update_into(self, chunk, out):
+        """ write chunk ^ keystream into the buffer out, return the length """
+        data = memoryview(chunk).cast('B')
+        size = len(data)
+        out = memoryview(out).cast('B')
+        if len(out) < size:
+            raise ValueError('output buffer too small: %d < %d'
+                             % (len(out), size))
+        for start in range(0, size, BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, size)
+            block = memoryview(self._keystream)[:end - start]
+            self.i, self.j = keystream_into(self.sbox, self.i, self.j, block)
+            xor_into(data[start:end], block, out[start:end])
+        return size
+
+
+def arcfour_block(key, in_bytes, loops=20):
+    try:
+        memoryview(in_bytes)
+    except TypeError:  # any iterable of ints, as the 'byte' engine accepts
+        in_bytes = bytes(in_bytes)
+    return ARC4(key, loops).update(in_bytes)
+
+
+def encrypt_file(key, src, dst, loops=20, chunk_size=BLOCK_SIZE * 16):
+    """ stream binary file object src into dst in constant memory """
+    cipher = ARC4(key, loops)
+    buf = bytearray(chunk_size)
+    out = bytearray(chunk_size)
+    total = 0
+    while True:
+        size = src.readinto(buf)
+        if not size:
+            return total
+        cipher.update_into(memoryview(buf)[:size], out)
+        dst.write(memoryview(out)[:size])
+        total += size
+
+
 def test():
-    from time import time
     clear = bytearray(b'1234567890' * 100000)
-    t0 = time()
-    cipher = arcfour(b'key', clear)
-    print('elapsed time: %.2fs' % (time() - t0))
-    result = arcfour(b'key', cipher)
-    assert result == clear, '%r != %r' % (result, clear)
-    print('elapsed time: %.2fs' % (time() - t0))
+    megabytes = len(clear) / 2**20
+    for engine in ENGINES:
+        t0 = time.time()
+        cipher = arcfour(b'key', clear, engine=engine)
+        elapsed = time.time() - t0
+        print('%s engine: elapsed time: %.2fs, %.2f MB/s'
+              % (engine, elapsed, megabytes / elapsed))
+        result = arcfour(b'key', cipher, engine=engine)
+        assert result == clear, '%r != %r' % (result, clear)
+        print('%s engine: elapsed time: %.2fs' % (engine, time.time() - t0))
+    assert arcfour(b'key', clear, engine='byte') == cipher, 'engines differ'
+    stream = ARC4(b'key')
+    chunks = [stream.update(clear[n:n+1000])
+              for n in range(0, len(clear), 1000)]
+    assert b''.join(chunks) == cipher, 'ARC4.update differs'
     print('OK')
 
 
+def crypt_mapped(cipher, src, dst, chunk_size=CHUNK_SIZE, digest=None):
+    """ XOR mmap src into mmap dst (may be the same map) chunk by chunk """
+    src = memoryview(src)
+    dst = memoryview(dst)
+    try:
+        for start in range(0, len(src), chunk_size):
+            chunk = src[start:start+chunk_size]
+            if digest is not None:  # hash before an in-place overwrite
+                digest.update(chunk)
+            cipher.update_into(chunk, dst[start:start+chunk_size])
+    finally:
+        # a map cannot be closed while views on it are still alive
+        src.release()
+        dst.release()
+
+
+def hash_decrypted(key, loops, path, chunk_size=CHUNK_SIZE):
+    """ sha256 of the decryption of path, computed in constant memory """
+    cipher = ARC4(key, loops)
+    digest = hashlib.sha256()
+    out = bytearray(chunk_size)
+    with open(path, 'rb') as fp:
+        buf = bytearray(chunk_size)
+        while True:
+            size = fp.readinto(buf)
+            if not size:
+                return digest
+            cipher.update_into(memoryview(buf)[:size], out)
+            digest.update(memoryview(out)[:size])
+
+
+def crypt_file(key, path, out_path=None, loops=20, chunk_size=CHUNK_SIZE,
+               verify=False):
+    """ encrypt or decrypt path into out_path, or in place if it is None """
+    cipher = ARC4(key, loops)
+    digest = hashlib.sha256() if verify else None
+    size = os.path.getsize(path)
+    t0 = time.time()
+    if out_path is None:
+        with open(path, 'r+b') as fp:
+            if size:
+                with mmap.mmap(fp.fileno(), 0) as mapped:
+                    crypt_mapped(cipher, mapped, mapped, chunk_size, digest)
+                    mapped.flush()
+    else:
+        with open(path, 'rb') as src, open(out_path, 'w+b') as dst:
+            dst.truncate(size)
+            if size:
+                m_src = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+                with m_src, mmap.mmap(dst.fileno(), 0) as m_dst:
+                    crypt_mapped(cipher, m_src, m_dst, chunk_size, digest)
+                    m_dst.flush()
+    elapsed = time.time() - t0
+    print('%s -> %s: %d bytes in %.2fs, %.2f MB/s'
+          % (path, out_path or path, size, elapsed,
+             size / 2**20 / max(elapsed, 1e-9)))
+    if verify:
+        result = hash_decrypted(key, loops, out_path or path, chunk_size)
+        ok = result.digest() == digest.digest()
+        print('verify: %s' % ('OK' if ok else 'FAILED'))
+        return ok
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Encrypt or decrypt files with arcfour (CipherSaber-2). '
+                    'Run without arguments for the self test.')
+    parser.add_argument('files', metavar='FILE', nargs='+')
+    parser.add_argument('-k', '--key', required=True,
+                        help='key text, encoded as UTF-8')
+    parser.add_argument('-o', '--output', metavar='PATH',
+                        help='output file (default: rewrite FILE in place); '
+                             'only with a single FILE')
+    parser.add_argument('--loops', type=int, default=20,
+                        help='key schedule mixing rounds (default=20)')
+    parser.add_argument('--chunk', metavar='BYTES', type=int,
+                        default=CHUNK_SIZE,
+                        help='bytes processed per step (default=%d)'
+                             % CHUNK_SIZE)
+    parser.add_argument('--verify', action='store_true',
+                        help='decrypt the result again and compare')
+    args = parser.parse_args(argv)
+    if args.output and len(args.files) > 1:
+        parser.error('-o/--output takes a single FILE')
+    if args.chunk < 1:
+        parser.error('--chunk must be positive')
+
+    key = args.key.encode('utf-8')
+    ok = True
+    for path in args.files:
+        ok = crypt_file(key, path, args.output, args.loops, args.chunk,
+                        args.verify) and ok
+    return 0 if ok else 1
+
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main())
     test()
@@ -1,18 +1,46 @@
 """
 futures.ProcessPoolExecutorの用例と性能評価
+
+引数なし（またはワーカー数だけ）で実行すると、各ワーカーが乱数のデータを作って暗号化します。
+benchを指定すると、同じJOBS/SIZEのデータを親プロセスで作り、ワーカーに渡す方法を比較します。
+pickleではデータと暗号文がプロセス間のパイプを往復しますが、
+sharedではmultiprocessing.shared_memoryに置いたデータをワーカーがその場で暗号化し、
+パイプを通るのは共有メモリの名前とオフセット、長さだけです::
+
+    $ python3 arcfour_futures.py bench 2
+    pickle: 2 workers, 3.1 MB, elapsed time: 0.47s
+    shared: 2 workers, 3.1 MB, elapsed time: 0.66s
+
+上の例は1コアのマシンのもので、3MBのコピーにかかる時間は暗号化に比べてわずかなので、
+差は誤差の範囲です。SIZEを大きくするか、暗号化の速い処理に置き換えると差が出ます。
+
+filesを指定すると、複数のファイルをワーカーで分担して、その場で暗号化（復号）します。
+ワーカーはファイルをmmapで開くので、パイプを通るのはパスだけです::
+
+    $ python3 arcfour_futures.py files -k secret a.bin b.bin c.bin
 """
 
+import os
 import sys
+import mmap
 import time
+import argparse
 from concurrent import futures
+from multiprocessing import shared_memory, resource_tracker
 from random import randrange
-from arcfour import arcfour
+from arcfour import arcfour, ARC4
 
 JOBS = 12
 SIZE = 2**18
 
 KEY = b"'Twas brillig, and the slithy toves\nDid gyre'"
 STATUS = '{} workers, elapsed time: {:.2f}s'
+BENCH_STATUS = '{}: {} workers, {:.1f} MB, elapsed time: {:.2f}s'
+
+
+def job_sizes(jobs=JOBS, size=SIZE):
+    return [size + int(size / jobs * (i - jobs/2))
+            for i in range(jobs, 0, -1)]
 
 
 def arcfour_test(size, key):
@@ -23,17 +51,111 @@ def arcfour_test(size, key):
     return size
 
 
+def arcfour_pickled(key, in_text):
+    # 引数のデータも戻り値の暗号文も、pickleされてパイプを通ります。
+    return ARC4(key).update(in_text)
+
+
+def arcfour_shared(name, offset, length, key):
+    # 共有メモリを名前で開き、[offset:offset+length]をその場で暗号化します。
+    shm = shared_memory.SharedMemory(name=name)
+    # 開いただけでもresource_trackerに登録され、ワーカーの終了時に警告と削除が起きます
+    # （bpo-39959）。共有メモリを削除するのは作った親プロセスなので、登録を取り消します。
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    try:
+        view = shm.buf[offset:offset+length]
+        ARC4(key).update_into(view, view)
+        view.release()
+    finally:
+        shm.close()
+    return offset, length
+
+
+def arcfour_file(path, key):
+    # ファイルをmmapで開き、その場で暗号化（復号）します。
+    size = os.path.getsize(path)
+    if size:
+        with open(path, 'r+b') as fp, mmap.mmap(fp.fileno(), 0) as mapped:
+            view = memoryview(mapped)
+            ARC4(key).update_into(view, view)
+            view.release()
+            mapped.flush()
+    return path, size
+
+
+def encrypt_pickled(executor, buffers, key):
+    """ 各バッファをpickleでワーカーに送り、暗号文のリストを返します """
+    to_do = [executor.submit(arcfour_pickled, key, data) for data in buffers]
+    return [future.result() for future in to_do]
+
+
+def encrypt_shared(executor, buffers, key):
+    """
+    すべてのバッファを1つの共有メモリに並べてワーカーに暗号化させ、暗号文のリストを返します。
+    """
+    total = sum(len(data) for data in buffers)
+    shm = shared_memory.SharedMemory(create=True, size=max(total, 1))
+    try:
+        offsets = []
+        offset = 0
+        for data in buffers:
+            shm.buf[offset:offset+len(data)] = data
+            offsets.append((offset, len(data)))
+            offset += len(data)
+        to_do = [executor.submit(arcfour_shared, shm.name, offset, length, key)
+                 for offset, length in offsets]
+        for future in futures.as_completed(to_do):
+            future.result()
+        return [bytes(shm.buf[offset:offset+length])
+                for offset, length in offsets]
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def bench(workers=None):
+    """ 同じJOBS/SIZEのデータで、pickleと共有メモリによる受け渡しを比較します """
+    buffers = [os.urandom(size) for size in job_sizes()]
+    megabytes = sum(map(len, buffers)) / 2**20
+    results = {}
+    with futures.ProcessPoolExecutor(workers) as executor:
+        actual_workers = executor._max_workers
+        # ワーカーの起動時間を計測に含めないよう、先に全員を起こしておきます。
+        list(executor.map(len, [b''] * actual_workers))
+        for label, encrypt in (('pickle', encrypt_pickled),
+                               ('shared', encrypt_shared)):
+            t0 = time.time()
+            results[label] = encrypt(executor, buffers, KEY)
+            print(BENCH_STATUS.format(label, actual_workers, megabytes,
+                                      time.time() - t0))
+    assert results['pickle'] == results['shared'], 'Failed bench'
+
+
+def encrypt_files(paths, key, workers=None):
+    t0 = time.time()
+    total = 0
+    with futures.ProcessPoolExecutor(workers) as executor:
+        actual_workers = executor._max_workers
+        to_do = [executor.submit(arcfour_file, path, key) for path in paths]
+        for future in futures.as_completed(to_do):
+            path, size = future.result()
+            total += size
+            print('{}: {:.1f} KB'.format(path, size/2**10))
+    elapsed = time.time() - t0
+    print(STATUS.format(actual_workers, elapsed))
+    print('{:.2f} MB/s'.format(total / 2**20 / max(elapsed, 1e-9)))
+
+
 def main(workers=None):
     if workers:
         workers = int(workers)
     t0 = time.time()
 
-    with futures.ProcessPoolExecutor as executor:
+    with futures.ProcessPoolExecutor(workers) as executor:
         actual_workers = executor._max_workers
 
         to_do = []
-        for i in range(JOBS, 0, -1):
-            size = SIZE + int(SIZE / JOBS * (i - JOBS/2))
+        for size in job_sizes():
             job = executor.submit(arcfour_test, size, KEY)
             to_do.append(job)
 
@@ -43,9 +165,34 @@ def main(workers=None):
 
     print(STATUS.format(actual_workers, time.time() - t0))
 
+
+def cli(argv):
+    parser = argparse.ArgumentParser(
+        description='Encrypt buffers or files across a process pool.')
+    sub = parser.add_subparsers(dest='mode', required=True)
+    bench_parser = sub.add_parser('bench',
+        help='compare pickled and shared-memory transfer')
+    bench_parser.add_argument('workers', type=int, nargs='?')
+    files_parser = sub.add_parser('files',
+        help='encrypt (or decrypt) FILEs in place, one per job')
+    files_parser.add_argument('files', metavar='FILE', nargs='+')
+    files_parser.add_argument('-k', '--key', required=True,
+        help='key text, encoded as UTF-8')
+    files_parser.add_argument('-w', '--workers', type=int)
+    args = parser.parse_args(argv)
+    if args.mode == 'bench':
+        bench(args.workers)
+    else:
+        encrypt_files(args.files, args.key.encode('utf-8'), args.workers)
+
+
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        workers = int(sys.argv[1])
+    if len(sys.argv) > 1 and sys.argv[1] in ('bench', 'files',
+                                             '-h', '--help'):
+        cli(sys.argv[1:])
     else:
-        workers = None
-    main(workers)
+        if len(sys.argv) == 2:
+            workers = int(sys.argv[1])
+        else:
+            workers = None
+        main(workers)
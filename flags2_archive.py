@@ -0,0 +1,258 @@
+"""
+ダウンロードした国旗を1つのファイルにまとめる、パック形式のアーカイブ
+
+国旗ごとにファイルを作る代わりに、画像をアーカイブの末尾へ順に追加し、
+最後に国別コードから(位置, 長さ, SHA-256)を引く索引を書き込みます。
+同じ画像は1度だけ格納し、索引の複数のエントリーから参照します。
+
+ファイルの形式::
+
+    MAGIC (8バイト)
+    画像のバイト列 ...
+    索引 (JSON、UTF-8)
+    索引の位置 (8バイト、リトルエンディアン) + MAGIC (8バイト)
+
+読み出しにはArchiveReaderを使います。ファイルをメモリマップし、
+画像ごとにコピーなしのmemoryviewを返します。
+
+Sample run::
+
+    $ python3 flags2_archive.py downloads.pack BR CN
+    BR        3512 bytes at       8  a4f9c3e2...
+    CN        2417 bytes at    3520  5d02b1c7...
+    194 flags, 869.2 KiB.
+
+"""
+
+import io
+import os
+import sys
+import mmap
+import json
+import struct
+import hashlib
+import argparse
+import threading
+import contextlib
+import collections
+
+MAGIC = b'FLAGPAK1'
+TRAILER = struct.Struct('<Q8s')
+
+
+def code_of(filename):
+    """flag_fileに渡されるファイル名（'br.gif'）から国別コードを返します。"""
+    return os.path.splitext(os.path.basename(filename))[0].upper()
+
+
+class ArchiveWriter:
+    """
+    スレッドから同時に画像を追加できるアーカイブです。
+    書き込む位置だけをロックの中で決め、書き込み自体はos.pwriteでロックの外で行います。
+    索引はcloseのときに1度だけ書き込み、一時ファイルの名前をアトミックにpathへ変更します。
+    以前のアーカイブにあって、今回は書き込まれなかった国旗は、今回問い合わせなかったか、
+    304が返ってきたものだけを引き継ぎます。404やエラーになった国旗は、引き継がずに捨てます。
+    問い合わせたコードはtrackで、304が返ってきたコードはkeepで知らせます。
+    以前のアーカイブは最初に開いたままにしておくので、previous_indexで条件付きGETを
+    決めた国旗は、closeまでにpathが置き換えられても必ず引き継げます。
+    countsはflags2_common.FlagStoreと同じように、追加した画像と重複を数えます。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.part'
+        self.index = {}
+        self.counts = collections.Counter()
+        self.carried = 0
+        self.dropped = 0
+        self.attempted = set()
+        self.unchanged = set()
+        self._by_digest = {}
+        self._lock = threading.Lock()
+        try:
+            self._previous = ArchiveReader(path)
+        except (OSError, ValueError):
+            self._previous = None
+        self._fp = open(self.tmp_path, 'wb')
+        self._fp.write(MAGIC)
+        self._fp.flush()
+        self._offset = len(MAGIC)
+
+    def previous_index(self):
+        """
+        以前のアーカイブの索引（国別コードから[位置, 長さ, SHA-256]）を返します。
+        アーカイブがないか壊れていれば、空のdictを返します。
+        """
+        return self._previous.index if self._previous is not None else {}
+
+    def track(self, codes):
+        """
+        codesの国別コードをそのまま生成し、問い合わせたコードとして記録します。
+        """
+        for cc in codes:
+            self.attempted.add(cc)
+            yield cc
+
+    def keep(self, cc):
+        """ccに304が返ってきたことを記録します。closeで以前の画像を引き継ぎます。"""
+        self.unchanged.add(cc)
+
+    def add(self, cc, data, counts=None):
+        counts = self.counts if counts is None else counts
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            found = self._by_digest.get(digest)
+            counts['files'] += 1
+            if found is None:
+                offset = self._offset
+                self._offset += len(data)
+                self._by_digest[digest] = offset
+                counts['unique'] += 1
+                counts['stored'] += len(data)
+            else:
+                offset = found
+                counts['dupes'] += 1
+                counts['saved'] += len(data)
+            self.index[cc] = [offset, len(data), digest]
+        if found is None:
+            self._write_at(data, offset)
+
+    def _write_at(self, data, offset):
+        if hasattr(os, 'pwrite'):
+            os.pwrite(self._fp.fileno(), data, offset)
+        else:
+            # os.pwriteのないOS（Windows）では、移動と書き込みをまとめてロックします。
+            with self._lock:
+                self._fp.seek(offset)
+                self._fp.write(data)
+                self._fp.flush()
+
+    @contextlib.contextmanager
+    def flag_file(self, filename):
+        """
+        flags2_common.flag_fileと同じように使えます。
+        書き込まれたデータはメモリに溜め、withブロックが正常に終了したときに追加します。
+        """
+        buf = io.BytesIO()
+        yield buf
+        self.add(code_of(filename), buf.getvalue())
+
+    def close(self):
+        """
+        以前のアーカイブから引き継ぐ国旗を追加し、索引を書き込みます。
+        引き継がなかった国旗の数はdroppedに入ります。
+        """
+        reader, self._previous = self._previous, None
+        if reader is not None:
+            carried = collections.Counter()
+            with reader:
+                for cc in reader:
+                    if cc in self.index:
+                        continue
+                    if cc in self.attempted and cc not in self.unchanged:
+                        self.dropped += 1
+                        continue
+                    with reader[cc] as view:
+                        self.add(cc, view, carried)
+            self.carried = carried['files']
+        self._fp.seek(self._offset)
+        self._fp.write(json.dumps(self.index, sort_keys=True).encode('utf-8'))
+        self._fp.write(TRAILER.pack(self._offset, MAGIC))
+        self._fp.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self._previous is not None:
+            self._previous.close()
+            self._previous = None
+        self._fp.close()
+        with contextlib.suppress(OSError):
+            os.remove(self.tmp_path)
+
+
+class ArchiveReader:
+    """
+    アーカイブをメモリマップして読み出します。reader[cc]は画像のmemoryviewを返します。
+    memoryviewはマップされたメモリを直接指すので、closeの前にすべて解放してください。
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size < len(MAGIC) + TRAILER.size:
+                raise ValueError('{} is not a flag archive'.format(path))
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        index_offset, magic = TRAILER.unpack_from(self._mmap,
+                                                  size - TRAILER.size)
+        if self._mmap[:len(MAGIC)] != MAGIC or magic != MAGIC:
+            self.close()
+            raise ValueError('{} is not a flag archive'.format(path))
+        raw_index = self._mmap[index_offset:size - TRAILER.size]
+        self.index = json.loads(raw_index.decode('utf-8'))
+
+    def __getitem__(self, cc):
+        offset, length, _ = self.index[cc.upper()]
+        return self._view[offset:offset + length]
+
+    def __contains__(self, cc):
+        return cc.upper() in self.index
+
+    def __iter__(self):
+        return iter(sorted(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def digest(self, cc):
+        return self.index[cc.upper()][2]
+
+    def verify(self, cc):
+        """画像のSHA-256が索引の値と一致すれば真を返します。"""
+        with self[cc] as view:
+            return hashlib.sha256(view).hexdigest() == self.digest(cc)
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='List or verify the flags in a packed archive.')
+    parser.add_argument('path', help='archive written with --archive')
+    parser.add_argument('cc', metavar='CC', nargs='*',
+        help='country codes to show (default: all)')
+    parser.add_argument('--verify', action='store_true',
+        help='check every image against its SHA-256')
+    args = parser.parse_args()
+
+    with ArchiveReader(args.path) as reader:
+        codes = [cc.upper() for cc in args.cc] or list(reader)
+        total = 0
+        bad = 0
+        for cc in codes:
+            if cc not in reader:
+                print('{:<4} not in archive'.format(cc))
+                continue
+            offset, length, digest = reader.index[cc]
+            total += length
+            status = ''
+            if args.verify and not reader.verify(cc):
+                status = ' CORRUPT'
+                bad += 1
+            print('{:<4}{:>8} bytes at {:>7}  {}...{}'.format(
+                cc, length, offset, digest[:8], status))
+        print('{} flags, {:.1f} KiB.'.format(len(codes), total / 1024))
+    if bad:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,26 @@
+import time
 import asyncio
+import hashlib
+import functools
+import itertools
+import contextlib
 import collections
 
 import aiohttp
 from aiohttp import web
+from aiohttp.http_exceptions import HttpProcessingError
 import tqdm
 
-from flags2_common import main, HTTPStatus, Result, save_flag
+from flags2_common import (main, tally, HTTPStatus, Result, save_flag,
+                           flag_file, DNS_TTL, KEEPALIVE, CHUNK_SIZE,
+                           RETRY_STATUS, record_result, count_hint,
+                           window_size)
+from flags2_limits import AIMD, AsyncLimiter
+from flags2_writer import AsyncWriter
 
 # default set low to avoid errors from remote site,
 # such as 503 - Service Temporarily Unavailable
+# (--rate limits the request rate instead, so -m can be raised with it)
 DEFAULT_CONCUR_REQ = 5
 MAX_CONCUR_REQ = 1000
 
@@ -22,41 +34,332 @@ class FetchError(Exception):
         self.country_code = country_code
 
 
-@asyncio.coroutine
-def get_flag(base_url, cc):
+def error_message(exc):
     """
-    get_flag関数はダウンロードした画像のバイト列を返します。
-    HTTPステータスコードが404ならweb.HTTPNotFoundを、
-    それ以外のコードならaiohttp.HttpProcessingErrorをそれぞれ上げます。
-    """
-    url = '{}/{cc}/{cc}.gif'.format(BASE_URL, cc=cc.lower())
-    resp = yield from aiohttp.request('GET', url)
-    if resp.status == 200:
-        image = yield from resp.read()
-        return image
-    elif resp.status == 404:
-        raise web.HTTPNotFound()
+    FetchErrorなら、元の例外（__cause__）からエラーメッセージを取り出して返します。
+    """
+    if not isinstance(exc, FetchError):
+        return None
+    cause = exc.__cause__
+    # aiohttpのHttpProcessingErrorは、argsではなく属性にステータスを持っています。
+    if isinstance(cause, HttpProcessingError):
+        return 'HTTP {} - {}'.format(cause.code, cause.message)
+    if cause.args and cause.args[0]:
+        return str(cause.args[0])
+    # 元の例外にエラーメッセージがなければ、ひも付けられた例外クラスの名前を
+    # エラーメッセージとして用います。
+    return cause.__class__.__name__
+
+
+def request_trace(stats):
+    """
+    接続の新規作成と再利用をホストごとに数え、DNSの名前解決、接続の確立、
+    最初のバイト（ヘッダー）の受信までの時間をstatsへ記録するTraceConfigを返します。
+    on_request_startは接続の取得より先に呼ばれるので、
+    そこでリクエストごとのコンテキスト（ctx）にホスト名と開始時刻を記録しておきます。
+    """
+    metrics = stats.metrics
+
+    async def on_request_start(session, ctx, params):
+        ctx.host = '{}:{}'.format(params.url.host, params.url.port)
+        ctx.t0 = time.time()
+
+    async def on_dns_resolvehost_start(session, ctx, params):
+        ctx.dns_t0 = time.time()
+
+    async def on_dns_resolvehost_end(session, ctx, params):
+        metrics.observe('dns', time.time() - ctx.dns_t0)
+
+    async def on_connection_create_start(session, ctx, params):
+        ctx.connect_t0 = time.time()
+
+    async def on_connection_create_end(session, ctx, params):
+        stats.count_connection(ctx.host, 'created')
+        metrics.observe('connect', time.time() - ctx.connect_t0)
+
+    async def on_connection_reuseconn(session, ctx, params):
+        stats.count_connection(ctx.host, 'reused')
+
+    async def on_request_end(session, ctx, params):
+        # on_request_endはレスポンスのヘッダーを受信した時点で呼ばれます。
+        metrics.observe('ttfb', time.time() - ctx.t0)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+def make_session(concur_req, options=None):
+    """
+    実行全体で共有するaiohttp.ClientSessionを作成します。
+    TCPConnectorが接続をプールするので、同じホストへのリクエストでは
+    DNSの名前解決とTCPのハンドシェイクが再利用されます。
+    """
+    limit_per_host, dns_ttl, keepalive, pool = 0, DNS_TTL, KEEPALIVE, True
+    trace_configs = []
+    timeout = None
+    if options is not None:
+        limit_per_host = options.limit_per_host
+        dns_ttl = options.dns_ttl
+        keepalive = options.keepalive
+        pool = options.pool
+        trace_configs.append(request_trace(options.stats))
+        # プールの空きを待つ時間は含めず、接続と読み込みのそれぞれに制限を設けます。
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=options.retry.connect_timeout,
+            sock_read=options.retry.read_timeout)
+
+    connector_args = dict(limit=concur_req, limit_per_host=limit_per_host,
+                          use_dns_cache=dns_ttl > 0, ttl_dns_cache=dns_ttl)
+    if pool and keepalive > 0:
+        connector_args['keepalive_timeout'] = keepalive
     else:
-        raise aiohttp.HttpProcessingError(code=resp.status, message=resp.reason, headers=resp.headers)
+        # キープアライブしない場合は、レスポンスごとに接続を閉じます。
+        connector_args['force_close'] = True
+    connector = aiohttp.TCPConnector(**connector_args)
+    session_args = dict(connector=connector, trace_configs=trace_configs)
+    if timeout is not None:
+        session_args['timeout'] = timeout
+    return aiohttp.ClientSession(**session_args)
 
 
-@asyncio.coroutine
-def download_one(cc, base_url, semaphore, verbose):
+def retry_reason(exc):
     """
-    引数のsemaphoreにはasyncio.Semaphoreのインスタンスを指定します。
-    このクラスは並行して行うリクエストの数を制限するための同期用メカニズムです。
+    再試行すべき例外なら、再試行の理由を表す文字列を返します。そうでなければNoneを返します。
     """
+    if isinstance(exc, asyncio.TimeoutError):
+        return 'timeout'
+    if isinstance(exc, aiohttp.ClientConnectionError):
+        return 'connection error'
+    if (isinstance(exc, HttpProcessingError)
+            and exc.code in RETRY_STATUS):
+        return 'HTTP {}'.format(exc.code)
+    return None
 
+
+async def acquire_slot(semaphore, throttle=None, url=None, counts=None):
+    """
+    semaphore（かリミッター）を取得してから--rateのトークンを待ち、
+    with文で解放するコンテキストマネージャを返します。
+    """
+    if isinstance(semaphore, AsyncLimiter):
+        slot = await semaphore.acquire()
+    else:
+        # asyncio.Semaphoreのacquireは真を返すだけなので、
+        # with文の終わりにreleaseを呼び出すExitStackを返します。
+        await semaphore.acquire()
+        slot = contextlib.ExitStack()
+        slot.callback(semaphore.release)
+    if throttle is not None:
+        # --rateのトークンは、semaphoreを取得してから予約します。
+        # 先に予約すると、semaphoreを待つあいだに予約した時刻が過ぎ、
+        # 待たされたリクエストがまとめて送られてしまうからです。
+        try:
+            await throttle.wait_async(url, counts)
+        except BaseException:
+            slot.__exit__(None, None, None)
+            raise
+        # リミッターのスロットなら、トークンを待った時間を応答時間から除きます。
+        restart = getattr(slot, 'restart', None)
+        if restart is not None:
+            restart()
+    return slot
+
+
+async def retry_coro(policy, coro_func, stats=None, slot=None):
+    """
+    flags2_common.retry_callのコルーチン版です。coro_funcを呼び出して得られるコルーチンを駆動し、
+    一時的な障害なら、イベントループをブロックせずに待ってから作り直します。
+    slotには、試行ごとにacquire_slotのようなコルーチンを返す関数を指定します。
+    所要時間はslotを取得してから計り、再試行までの待ち時間はslotを解放してから待ちます。
+    """
+    attempt = 0
+    while True:
+        try:
+            cm = (await slot()) if slot is not None else contextlib.suppress()
+            with cm:
+                t0 = time.time()
+                try:
+                    result = await coro_func()
+                finally:
+                    if stats is not None:
+                        stats.observe_latency(time.time() - t0)
+        except Exception as exc:
+            reason = retry_reason(exc)
+            if reason is None or attempt >= policy.retries:
+                raise
+            if stats is not None:
+                stats.count_retry(reason)
+            await asyncio.sleep(policy.delay(attempt))
+            attempt += 1
+        else:
+            return result
+
+
+async def fetch_flag(session, base_url, cc, headers=None, metrics=None):
+    """
+    画像のバイト列と、レスポンスのヘッダーを返します。
+    HTTPステータスコードが404ならweb.HTTPNotFoundを、
+    304（条件付きGETで変更なし）ならweb.HTTPNotModifiedを、
+    それ以外のコードならHttpProcessingErrorをそれぞれ上げます。
+    """
+    url = '{}/{cc}/{cc}.gif'.format(base_url, cc=cc.lower())
+    resp = await session.get(url, headers=headers or {})
     try:
-        # システムが全体としてはブロックされないようにするため、
-        # semaphoreをyield from式の中でコンテキストマネージャとして使用します。
-        # semaphoreのカウンタが上限に達しているとき、このコルーチンだけがブロックされます。
-        with (yield from semaphore):
+        if resp.status == 200:
+            t0 = time.time()
+            image = await resp.read()
+            if metrics is not None:
+                metrics.observe('body', time.time() - t0)
+                metrics.add_bytes(len(image))
+            return image, resp.headers
+        elif resp.status == 304:
+            raise web.HTTPNotModified()
+        elif resp.status == 404:
+            raise web.HTTPNotFound()
+        else:
+            raise HttpProcessingError(code=resp.status, message=resp.reason,
+                                      headers=resp.headers)
+    finally:
+        # 接続をプールに戻し、次のリクエストで再利用できるようにします。
+        resp.release()
+
+
+async def get_flag(session, base_url, cc, cache=None, metrics=None):
+    """
+    get_flag関数はダウンロードした画像のバイト列を返します。
+    索引（cache）に記録があれば条件付きGETにし、ダウンロードできたら記録を更新します。
+    """
+    headers = cache.request_headers(cc) if cache is not None else {}
+    image, resp_headers = await fetch_flag(session, base_url, cc,
+                                                headers, metrics)
+    if cache is not None:
+        digest = hashlib.sha256(image).hexdigest()
+        cache.update(cc, resp_headers, len(image), digest)
+    return image
 
-            # このwith文が終了すると、semaphoreのカウンタは1つ減じられます。
-            # これで、同じsemaphoreオブジェクトで待機しているであろう他のコルーチンインスタンスのブロックが解除されます。
-            image = yield from get_flag(base_url, cc)
 
+async def get_flag_stream(session, base_url, cc, filename, cache=None,
+                    metrics=None, store=None):
+    """
+    get_flagと同じリクエストを送りますが、レスポンスの本体をメモリに溜めずに、
+    CHUNK_SIZEバイトずつfilenameへ書き出します。
+    ファイルへの書き込みはデフォルトのExecutorで実行し、完了を待ってから次のチャンクを読みます。
+    そのため、bodyの時間には書き込みの時間も含まれます。
+    書き出したバイト数とSHA-256の値を返します。
+    """
+    url = '{}/{cc}/{cc}.gif'.format(base_url, cc=cc.lower())
+    headers = cache.request_headers(cc) if cache is not None else {}
+    resp = await session.get(url, headers=headers)
+    try:
+        if resp.status == 200:
+            loop = asyncio.get_event_loop()
+            t0 = time.time()
+            size = 0
+            algo = hashlib.sha256()
+            # --dedupeのときは、FlagStoreが書き込みながらSHA-256を計算します。
+            opener = store.flag_file if store is not None else flag_file
+            with opener(filename) as fp:
+                # resp.content.iter_chunkedはasync forでしか使えないので、
+                # 同じことをreadの繰り返しで行います。
+                while True:
+                    chunk = await resp.content.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    algo.update(chunk)
+                    size += len(chunk)
+                    await loop.run_in_executor(None, fp.write, chunk)
+            if metrics is not None:
+                metrics.observe('body', time.time() - t0)
+                metrics.add_bytes(size)
+            if cache is not None:
+                cache.update(cc, resp.headers, size, algo.hexdigest())
+            return size, algo.hexdigest()
+        elif resp.status == 304:
+            raise web.HTTPNotModified()
+        elif resp.status == 404:
+            raise web.HTTPNotFound()
+        else:
+            raise HttpProcessingError(code=resp.status, message=resp.reason,
+                                      headers=resp.headers)
+    finally:
+        resp.release()
+
+
+async def download_one(session, cc, base_url, semaphore, verbose, options=None,
+                 writer=None):
+    """
+    引数のsessionには、すべてのダウンロードで共有するaiohttp.ClientSessionを指定します。
+    引数のsemaphoreにはasyncio.Semaphoreのインスタンスを指定します。
+    このクラスは並行して行うリクエストの数を制限するための同期用メカニズムです。
+    引数のwriterには、画像を書き出すflags2_writer.AsyncWriterを指定します。
+    """
+    filename = cc.lower() + '.gif'
+    stream = options is not None and options.stream
+    cache = options.cache if options is not None else None
+    policy = options.retry if options is not None else None
+    metrics = options.stats.metrics if options is not None else None
+    store = options.store if options is not None else None
+    throttle = options.throttle if options is not None else None
+    # 実行の記録（Journal）に残す、画像のバイト数とSHA-256の値です。
+    size = digest = None
+
+    # システムが全体としてはブロックされないようにするため、
+    # semaphoreはawait式で取得し、with文で解放します。
+    # semaphoreのカウンタが上限に達しているとき、このコルーチンだけがブロックされます。
+    # with文が終了すると、semaphoreのカウンタは1つ減じられます。
+    # これで、同じsemaphoreオブジェクトで待機しているであろう他のコルーチンインスタンスのブロックが解除されます。
+    acquire = functools.partial(
+        acquire_slot, semaphore, throttle, base_url,
+        options.stats.throttle if throttle is not None else None)
+
+    async def fetch():
+        nonlocal size, digest
+        if stream:
+            # --streamが指定されたら、画像はダウンロードしながらディスクに書き出されます。
+            size, digest = await get_flag_stream(
+                session, base_url, cc, filename, cache, metrics, store)
+            return None
+        image = await get_flag(session, base_url, cc, cache, metrics)
+        size, digest = len(image), hashlib.sha256(image).hexdigest()
+        if writer is None:
+            return image
+
+        # 書き込み待ちの画像が予算を超えていれば、semaphoreを持ったまま待ちます。
+        # ディスクが追いつかないあいだは、新しいダウンロードも始まりません。
+        return (await writer.submit(image, filename))
+
+    try:
+        if policy is None:
+            with (await acquire()):
+                result = await fetch()
+        else:
+            # 再試行までの待ち時間にはsemaphoreを解放しているので、
+            # 他のダウンロードが先に進めます。
+            result = await retry_coro(policy, fetch, options.stats,
+                                           acquire)
+
+        # 書き込みの完了を待ちます。書き込みのエラーも、この国別コードのエラーとして数えられます。
+        # writerがなければ、イベントループのデフォルトのスレッドプールで書き込みます。
+        # run_in_executorの第1引数にはExecutorインスタンスを指定し、
+        # 残りの引数は呼び出し可能オブジェクトとその位置引数です。
+        if result is not None and writer is None:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, save_flag, result, filename,
+                                            metrics, store)
+        elif result is not None:
+            await result
+
+    # 手元の画像が最新なら、保存は不要です。
+    except web.HTTPNotModified:
+        status = HTTPStatus.not_modified
+        msg = 'not modified'
     # 指定の国旗が見つからなかったときは、その旨をResultのステータスにセットします。
     except web.HTTPNotFound:
         status = HTTPStatus.not_found
@@ -67,93 +370,153 @@ def download_one(cc, base_url, semaphore, verbose):
         # この構文は、「PEP 3134 - Exception Chaining and Embedded Tracebacks」で導入されたものです。
         raise FetchError(cc) from exc
     else:
-        # # 実際に国旗の画像をディスクに保存するのはこの関数です。
-        # save_flag(image, cc.lower() + '.gif')
-        # status = HTTPStatus.ok
-        # msg = 'OK'
-
-        # イベントループオブジェクトの参照を取得します。
-        loop = asyncio.get_event_loop()
-
-        # run_in_executorの第!引数にはExecutorインスタンスを指定します。
-        # Noneならば、イベントループのデフォルトのスレッドプールExecutorが使用されます。
-        # 残りの引数は呼び出し可能オブジェクトとその位置引数です。
-        loop.run_in_executor(None, save_flag, image, cc.lower() + '.gif')
-        
         status = HTTPStatus.ok
         msg = 'OK'
 
+    # 404の結果と、終わったことを記録し、次回の実行では問い合わせないようにします。
+    record_result(options, cc, status, size, digest)
+
     if verbose and msg:
         print(cc, msg)
 
     return Result(status, cc)
 
 
-@asyncio.coroutine
-def downloader_coro(cc_list, base_url, verbose, concur_req):
+def make_limiter(concur_req, options=None, verbose=False):
+    """
+    同時に実行するリクエストの数を制限する、セマフォかリミッターを返します。
+    """
+    if options is not None and options.adaptive:
+        # --adaptiveが指定されたら、セマフォの代わりにAIMDで上限を増減させるリミッターを使います。
+        # 404と304はサーバーの過負荷ではないので、エラーとはみなしません。
+        controller = AIMD(1, concur_req)
+        options.stats.concurrency = controller.history
+        return AsyncLimiter(controller,
+                            benign=(web.HTTPNotFound, web.HTTPNotModified),
+                            verbose=verbose)
+    # asyncio.Semaphoreを作成します。
+    # このセマフォを共有するコルーチンは、最大concur_req個まで実行できます。
+    return asyncio.Semaphore(concur_req)
+
+
+def make_writer(options=None):
+    """
+    --write-workers、--write-buffer、--batch-writesに従ったAsyncWriterを返します。
+    """
+    if options is None:
+        return AsyncWriter()
+    return AsyncWriter(options.write_workers, options.write_buffer,
+                       options.batch_writes, options.stats.metrics,
+                       options.store)
+
+
+async def downloader_coro(cc_list, base_url, verbose, concur_req, options=None):
     """
     このコルーチンはdownload_manyと同じ引数を受け取ります。
     しかし、これはコルーチン関数であり、download_manyのような普通の関数ではないため、
     mainから直接呼び出すことはできません。
     """
 
-    counter = collections.Counter()
-
-    # asyncio.Semaphoreを作成します。
-    # このセマフォを共有するコルーチンは、最大concur_req個まで実行できます。
-    semaphore = asyncio.Semaphore(concur_req)
+    semaphore = make_limiter(concur_req, options, verbose)
 
-    # download_oneコルーチンを1回呼び出すごとに1つずつコルーチンオブジェクトを作成し、リストにします。
-    to_do = [download_one(cc, base_url, semaphore, verbose) for cc in sorted(cc_list)]
+    # すべてのダウンロードで1つのセッション（と、その接続プール）を共有します。
+    session = make_session(concur_req, options)
+    writer = make_writer(options)
+    try:
+        counter = await collect_results(session, cc_list, base_url,
+                                             verbose, semaphore, options,
+                                             writer,
+                                             window_size(concur_req, options))
+    finally:
+        await session.close()
+        # 結果を返す（final_reportを表示する）前に、書き込みがすべて終わるのを待ちます。
+        await writer.close()
+    if options is not None:
+        options.stats.writes = writer.summary()
 
-    # 完了するとFutureインスタンスを返すイテレータを取得します。
-    to_do_iter = asyncio.as_completed(to_do)
+    # 他のスクリプトと同じように、カウンタを返します。
+    return counter
 
-    if not verbose:
-        # このイテレータをtqdm関数でラップすることで、プログレスバーを表示します。
-        to_do_iter = tqdm.tqdm(to_do_iter, total=len(cc_list))
 
-    # 完了したFutureインスタンスに対し、以前のdownload_manyにあるものとほとんど同じループで反復処理します。
-    # 変更の大半は、HTTPライブラリ間の例外処理の違い（requestsに対しここではaiohttp）によるものです。
-    for future in to_do_iter:
-        try:
-            # asyncio.Futureの結果を取得するには、
-            # future.result()を呼び出す代わりにyield fromを用いるのが最も簡単な方法です。
-            res = yield from future
-
-        # download_oneで発生する例外はどれも、元の例外をひも付けしたFetchErrorにラップされます。
-        except FetchError as exc:
-            # 例外FetchErrorから、エラーが発生した国別コードを取得します。
-            country_code = exc.country_code
-            try:
-                # 元の例外（__cause__）からエラーメッセージの取得を試みます。
-                error_msg = exc.__cause__.args[0]
-            except IndexError:
-                # 元の例外にエラーメッセージがなければ、ひも付けられた例外クラスの名前を
-                # エラーメッセージとして用います。
-                error_msg = exc.__cause__.__class__.__name__
-            if verbose and error_msg:
-                msg = '*** Error for {}: {}'
-                print(msg.format(country_code, error_msg))
-            status = HTTPStatus.error
-        else:
-            status = res.status
+async def collect_results(session, cc_list, base_url, verbose, semaphore,
+                    options=None, writer=None, window=None):
+    """
+    ダウンロードを実行し、結果をHTTPStatus別に集計したカウンタを返します。
+    国別コードはcc_listから必要になった分だけ取り出し、
+    同時に存在するタスクはwindow個（Noneなら既定の数）までに抑えます。
+    """
 
-        # 結果を集計します。
-        counter[status] += 1
+    counter = collections.Counter()
+    if window is None:
+        window = window_size(MAX_CONCUR_REQ, options)
+    cc_iter = iter(cc_list)
+    pending = set()
+
+    def fill():
+        # download_oneコルーチンを1回呼び出すごとに1つずつコルーチンオブジェクトを作成し、
+        # タスクとしてイベントループに投入します。すべてのコードのコルーチンを先に作ると、
+        # --everyのようにコードが多いときに、その数だけメモリを使ってしまいます。
+        for cc in itertools.islice(cc_iter, window - len(pending)):
+            pending.add(asyncio.ensure_future(
+                download_one(session, cc, base_url, semaphore, verbose,
+                             options, writer)))
+
+    # プログレスバーは、タスクが1つ完了するごとに進めます。
+    progress = (None if verbose
+                else tqdm.tqdm(total=count_hint(cc_list, options)))
+
+    fill()
+    try:
+        while pending:
+            # 少なくとも1つのタスクが完了するまで待ち、空いた分をすぐに補充します。
+            done, _ = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            pending -= done
+            fill()
+
+            # 完了したタスクに対し、以前のdownload_manyにあるものとほとんど同じループで反復処理します。
+            # 変更の大半は、HTTPライブラリ間の例外処理の違い（requestsに対しここではaiohttp）によるものです。
+            for future in done:
+                try:
+                    # 完了したタスクのresult()はブロックしません。
+                    res = future.result()
+
+                # download_oneで発生する例外はどれも、元の例外をひも付けしたFetchErrorにラップされます。
+                except FetchError as exc:
+                    # 例外FetchErrorから、エラーが発生した国別コードを取得します。
+                    country_code = exc.country_code
+                    error_msg = error_message(exc)
+                    status = HTTPStatus.error
+                else:
+                    country_code = res.data
+                    error_msg = ''
+                    status = res.status
+
+                # 結果を集計します。
+                tally(counter, country_code, status, error_msg, verbose)
+                if progress is not None:
+                    progress.update(1)
+    finally:
+        # 予期しない例外で抜けるときは、残りのタスクを取り消します。
+        for future in pending:
+            future.cancel()
+        if progress is not None:
+            progress.close()
 
-    # 他のスクリプトと同じように、カウンタを返します。
     return counter
 
 
-def download_many(cc_list, base_url, verbose, concur_req):
+def download_many(cc_list, base_url, verbose, concur_req, options=None):
     """
     download_many関数はコルーチンをインスタンス化し、
     これをrun_until_completeを用いてイベントループに渡すだけです。
     """
 
-    loop = asyncio.get_event_loop()
-    coro = downloader_coro(cc_list, base_url, verbose, concur_req)
+    # 最後にイベントループを閉じるので、同じプロセスで何度も呼び出せるよう（flags2_benchなど）、
+    # 呼び出しごとに新しいイベントループを用意します。
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    coro = downloader_coro(cc_list, base_url, verbose, concur_req, options)
     counts = loop.run_until_complete(coro)
 
     # すべての作業が完了したら、イベントループを閉じ、countsを返します。
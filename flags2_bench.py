@@ -0,0 +1,312 @@
+"""
+flags2のダウンローダーの性能比較
+
+接続プールの有無による比較（pooling）と、各ダウンローダーを--max_reqの値を変えながら
+LOCAL、DELAY、ERRORの各サーバーで実行する比較（grid）、
+国別コードを分けるプロセスの数（--procs）を変えながら実行する比較（procs）、
+1回のリクエストでまとめて取得する国旗の数（--batch）を変えながら実行する比較（batch）ができます。
+--serveを指定すると、flags2_server.pyを起動してから計測します。
+
+Sample run::
+
+    $ python3 flags2_bench.py grid --serve -m 1 10 100
+    server  backend     max_req  flags     ok  errors  elapsed     req/s
+    LOCAL   sequential        1    100     29       0    0.21s     476.2
+    LOCAL   threads          10    100     29       0    0.08s    1250.0
+    ...
+
+    $ python3 flags2_bench.py procs -s LOCAL -b asyncio -e -m 400 --procs 1 2 4
+    server  backend     procs max_req  flags     ok  elapsed     req/s
+    LOCAL   asyncio         1     400    676    194    0.60s    1134.0
+    LOCAL   asyncio         2     400    676    194    0.72s     932.5
+    LOCAL   asyncio         4     400    676    194    1.27s     533.0
+
+プロセスを増やして速くなるのは、CPUのコアが複数あり、サーバーが別のマシンで動いているときです。
+上の例は1コアのマシンでサーバーも同居しているので、プロセスを起動する分だけ遅くなっています。
+
+    $ python3 flags2_bench.py batch -s DELAY -b threads -l 100 -m 4 --batch 0 5 20 50
+    server  backend      batch max_req  flags     ok  elapsed   flags/s
+    DELAY   threads          0       4    100     23   12.68s       7.9
+    DELAY   threads          5       4    100     23    2.53s      39.5
+    DELAY   threads         20       4    100     23    1.02s      98.3
+    DELAY   threads         50       4    100     23    0.51s     194.9
+
+バッチを大きくするほどリクエストの数は減りますが、1つの応答が届くまでに時間がかかり、
+並行数より少ないバッチしかできないと接続が余ります。-m/--max_reqとあわせて選んでください。
+
+"""
+
+import os
+import sys
+import time
+import socket
+import tempfile
+import argparse
+import functools
+import subprocess
+
+from flags2_common import (SERVERS, POP20_CC, BACKENDS, HTTPStatus,
+                           build_parser, init_run, expand_cc_args,
+                           load_backend)
+from flags2_shards import download_sharded
+
+GRID_MAX_REQ = [1, 5, 10, 30, 100]
+GRID_LIMIT = 100
+PROCS = [1, 2, 4, 8]
+BATCH_SIZES = [0, 5, 20, 50, 200]
+# --batchに対応しているダウンローダーです。
+BATCH_BACKENDS = ['sequential', 'threads']
+
+POOL_HEADER = '{:<8}{:<12}{:<6}{:>8}{:>9}{:>10}'
+POOL_ROW = '{:<8}{:<12}{:<6}{:>8}{:>8.2f}s{:>10.1f}'
+GRID_HEADER = '{:<8}{:<12}{:>7}{:>7}{:>7}{:>8}{:>9}{:>10}'
+GRID_ROW = '{:<8}{:<12}{:>7}{:>7}{:>7}{:>8}{:>8.2f}s{:>10.1f}'
+PROCS_HEADER = '{:<8}{:<12}{:>5}{:>8}{:>7}{:>7}{:>9}{:>10}'
+PROCS_ROW = '{:<8}{:<12}{:>5}{:>8}{:>7}{:>7}{:>8.2f}s{:>10.1f}'
+BATCH_HEADER = '{:<8}{:<12}{:>6}{:>8}{:>7}{:>7}{:>9}{:>10}'
+BATCH_ROW = '{:<8}{:<12}{:>6}{:>8}{:>7}{:>7}{:>8.2f}s{:>10.1f}'
+
+
+def bench_one(module, server, cc_list, max_req, extra_args=(), procs=1):
+    """
+    1つのダウンローダーを1回だけ実行し、(経過時間（秒）, 結果のカウンタ)を返します。
+    procsが2以上なら、flags2_shardsでcc_listをprocs個のプロセスに分けて実行します。
+    """
+    # 条件付きGETで転送が省かれないよう、索引は使いません。
+    argv = ['-m', str(max_req), '-s', server, '--no-cache']
+    argv.extend(extra_args)
+    # 利用者のdownloads.journalを消さないよう、実行の記録は使い捨てのファイルに書きます。
+    fd, journal_path = tempfile.mkstemp(suffix='.journal')
+    os.close(fd)
+    options = init_run(build_parser(module.DEFAULT_CONCUR_REQ).parse_args(argv),
+                       journal_path)
+    actual_req = min(max_req, module.MAX_CONCUR_REQ, len(cc_list))
+    download_many = module.download_many
+    if procs > 1:
+        download_many = functools.partial(download_sharded, download_many,
+                                          procs=procs)
+    try:
+        t0 = time.time()
+        counter = download_many(cc_list, SERVERS[server], False, actual_req,
+                                options)
+        elapsed = time.time() - t0
+    finally:
+        options.journal.close()
+        os.remove(journal_path)
+    assert sum(counter.values()) == len(cc_list), \
+        'some downloads are unaccounted for'
+    return elapsed, counter
+
+
+def load_backends(names):
+    """
+    (名前, モジュール)のリストを返します。インポートできないものは、その旨を表示して飛ばします。
+    """
+    backends = []
+    for name in BACKENDS:
+        if name not in names:
+            continue
+        try:
+            backends.append((name, load_backend(name)))
+        except (ImportError, AttributeError) as exc:
+            print('*** Skipping {}: {}'.format(name, exc))
+    return backends
+
+
+def bench_pooling(servers, cc_list, max_req, backends):
+    """
+    接続プールの有無で、各サーバーに対する1秒あたりのリクエスト数を比較します。
+    """
+    rows = []
+    for server in servers:
+        for name, module in backends:
+            for pool in (False, True):
+                extra_args = [] if pool else ['--no-pool']
+                elapsed, _ = bench_one(module, server, cc_list, max_req,
+                                       extra_args)
+                rows.append((server, name, 'on' if pool else 'off',
+                             len(cc_list), elapsed, len(cc_list) / elapsed))
+    print(POOL_HEADER.format('server', 'backend', 'pool', 'flags', 'elapsed',
+                             'req/s'))
+    for row in rows:
+        print(POOL_ROW.format(*row))
+
+
+def bench_grid(servers, cc_list, max_req_values, backends):
+    """
+    各ダウンローダーを、--max_reqの値を変えながら各サーバーで実行して比較します。
+    並行数が1に固定されたダウンローダー（sequential）は、1回だけ実行します。
+    """
+    rows = []
+    for server in servers:
+        for name, module in backends:
+            values = sorted({min(max_req, module.MAX_CONCUR_REQ)
+                             for max_req in max_req_values})
+            for max_req in values:
+                elapsed, counter = bench_one(module, server, cc_list, max_req)
+                rows.append((server, name, max_req, len(cc_list),
+                             counter[HTTPStatus.ok],
+                             counter[HTTPStatus.error], elapsed,
+                             len(cc_list) / elapsed))
+    print(GRID_HEADER.format('server', 'backend', 'max_req', 'flags', 'ok',
+                             'errors', 'elapsed', 'req/s'))
+    for row in rows:
+        print(GRID_ROW.format(*row))
+
+
+def bench_procs(servers, cc_list, max_req, procs_values, backends):
+    """
+    -m/--max_reqの合計を変えずに、プロセスの数を増やしたときの1秒あたりのリクエスト数を比較します。
+    1つのイベントループが1つのコアを使い切っているなら、プロセスを増やすと速くなります。
+    """
+    rows = []
+    for server in servers:
+        for name, module in backends:
+            req = min(max_req, module.MAX_CONCUR_REQ)
+            for procs in procs_values:
+                elapsed, counter = bench_one(module, server, cc_list, req,
+                                             procs=procs)
+                rows.append((server, name, procs, req, len(cc_list),
+                             counter[HTTPStatus.ok], elapsed,
+                             len(cc_list) / elapsed))
+    print(PROCS_HEADER.format('server', 'backend', 'procs', 'max_req',
+                              'flags', 'ok', 'elapsed', 'req/s'))
+    for row in rows:
+        print(PROCS_ROW.format(*row))
+
+
+def bench_batch(servers, cc_list, max_req, sizes, backends):
+    """
+    1回のリクエストでまとめて取得する国旗の数を変えながら、1秒あたりの国旗の数を比較します。
+    0はバッチを使わず、国別コードごとにリクエストを送ります。
+    """
+    rows = []
+    for server in servers:
+        for name, module in backends:
+            req = min(max_req, module.MAX_CONCUR_REQ)
+            for size in sizes:
+                elapsed, counter = bench_one(module, server, cc_list, req,
+                                             ['--batch', str(size)])
+                rows.append((server, name, size, req, len(cc_list),
+                             counter[HTTPStatus.ok], elapsed,
+                             len(cc_list) / elapsed))
+    print(BATCH_HEADER.format('server', 'backend', 'batch', 'max_req',
+                              'flags', 'ok', 'elapsed', 'flags/s'))
+    for row in rows:
+        print(BATCH_ROW.format(*row))
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(.1)
+    raise RuntimeError('test server did not start on port {}'.format(port))
+
+
+def start_server(extra_args=()):
+    """
+    flags2_server.pyを別プロセスで起動し、LOCAL、DELAY、ERRORのポートが開くのを待ちます。
+    ベンチマークと同じプロセスで動かすと、サーバーとダウンローダーがGILを奪い合うからです。
+    """
+    import flags2_server
+    argv = [sys.executable, flags2_server.__file__, '--preset', 'all']
+    argv.extend(extra_args)
+    proc = subprocess.Popen(argv, stdout=subprocess.DEVNULL)
+    try:
+        for label in ('LOCAL', 'DELAY', 'ERROR'):
+            wait_for_port(flags2_server.port_of(label))
+    except Exception:
+        proc.terminate()
+        raise
+    return proc
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare flags2 downloaders.')
+    parser.add_argument('mode', choices=['pooling', 'grid', 'procs', 'batch'],
+        help='pooling: with and without keep-alive pools; '
+            'grid: every backend across --max_req values; '
+            'procs: the codes split across --procs processes; '
+            'batch: several flags per request across --batch sizes')
+    parser.add_argument('-s', '--server', metavar='LABEL', nargs='+',
+        help='servers to hit (default: LOCAL DELAY for pooling, procs '
+            'and batch, LOCAL DELAY ERROR for grid)')
+    parser.add_argument('-b', '--backend', metavar='NAME', nargs='+',
+        choices=list(BACKENDS),
+        help='backends to compare; any of {} (default: all of them, '
+            '{} for batch)'.format(', '.join(BACKENDS),
+                                   ' '.join(BATCH_BACKENDS)))
+    parser.add_argument('-e', '--every', action='store_true',
+        help='get flags for every possible code (AA...ZZ)')
+    parser.add_argument('-l', '--limit', metavar='N', type=int,
+        help='limit to N first codes of AA...ZZ '
+            '(grid default={})'.format(GRID_LIMIT))
+    parser.add_argument('-m', '--max_req', metavar='CONCURRENT', type=int,
+        nargs='+',
+        help='maximum concurrent requests (pooling, procs and batch '
+            'default=30, '
+            'grid default={})'.format(' '.join(map(str, GRID_MAX_REQ))))
+    parser.add_argument('--procs', metavar='N', type=int, nargs='+',
+        default=PROCS,
+        help='process counts to compare in procs mode (default={})'
+            .format(' '.join(map(str, PROCS))))
+    parser.add_argument('--batch', metavar='SIZE', type=int, nargs='+',
+        default=BATCH_SIZES,
+        help='batch sizes to compare in batch mode, 0 for one request '
+            'per flag (default={})'.format(' '.join(map(str, BATCH_SIZES))))
+    parser.add_argument('--serve', action='store_true',
+        help='start flags2_server.py --preset all for the duration of the run')
+    args = parser.parse_args()
+
+    if args.server:
+        servers = [label.upper() for label in args.server]
+    elif args.mode in ('pooling', 'procs', 'batch'):
+        servers = ['LOCAL', 'DELAY']
+    else:
+        servers = ['LOCAL', 'DELAY', 'ERROR']
+    unknown = [label for label in servers if label not in SERVERS]
+    if unknown:
+        print('*** Usage error: unknown server', ', '.join(unknown))
+        sys.exit(1)
+    limit = args.limit
+    if limit is None and args.mode == 'grid' and not args.every:
+        limit = GRID_LIMIT
+    if args.every or limit:
+        cc_list = expand_cc_args(True, False, [], limit or sys.maxsize)
+    else:
+        cc_list = sorted(POP20_CC)
+
+    if args.backend:
+        names = args.backend
+    elif args.mode == 'batch':
+        names = BATCH_BACKENDS
+    else:
+        names = list(BACKENDS)
+    backends = load_backends(names)
+    proc = start_server() if args.serve else None
+    try:
+        if args.mode == 'pooling':
+            max_req = args.max_req[0] if args.max_req else 30
+            bench_pooling(servers, cc_list, max_req, backends)
+        elif args.mode == 'procs':
+            max_req = args.max_req[0] if args.max_req else 30
+            bench_procs(servers, cc_list, max_req, args.procs, backends)
+        elif args.mode == 'batch':
+            max_req = args.max_req[0] if args.max_req else 30
+            bench_batch(servers, cc_list, max_req, args.batch, backends)
+        else:
+            bench_grid(servers, cc_list, args.max_req or GRID_MAX_REQ,
+                       backends)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,17 +3,42 @@ flags2から利用する共通モジュール
 """
 
 import os
+import json
 import time
 import sys
-import StringIO
+import string
+import random
+import hashlib
+import threading
 import argparse
+import functools
+import tempfile
+import importlib
+import itertools
+import contextlib
+import collections
+from concurrent import futures
 from collections import namedtuple
 from enum import Enum
 
+from flags2_metrics import Metrics
+from flags2_archive import ArchiveWriter
+from flags2_limits import RateLimiter
+
+try:
+    # resourceモジュールはUnix系OSでしか使えません。
+    import resource
+except ImportError:
+    resource = None
+
 
 Result = namedtuple('Result', 'status data')
+# 国別コードを数えた結果です。headは先頭の最大10個、lastは最後のコードです。
+CodeCount = namedtuple('CodeCount', 'count head last')
 
-HTTPStatus = Enum('Status', 'ok not_found error')
+# ワーカープロセスから結果を返せるよう、pickleがHTTPStatusの名前で探せるようにしています。
+HTTPStatus = Enum('Status', 'ok not_found error not_modified',
+                  qualname='HTTPStatus')
 
 POP20_CC = ('CN IN US ID BR PK NG BD RU JP '
             'MX PH VN ET EG DE IR TR CD FR').split()
@@ -29,66 +54,880 @@ SERVERS = {
 }
 DEFAULT_SERVER = 'LOCAL'
 
+# --backendで選べるダウンローダーと、その実装を含むモジュールです。
+# モジュールはそれぞれdownload_many、error_message、DEFAULT_CONCUR_REQ、MAX_CONCUR_REQを定義します。
+BACKENDS = collections.OrderedDict([
+    ('sequential', 'flags2_sequential'),
+    ('threads', 'flags2_threadpool'),
+    ('asyncio', 'flags2_asyncio'),
+    ('processes', 'flags2_processes'),
+    ('hybrid', 'flags2_hybrid'),
+    ('pipelined', 'flags2_pipelined'),
+])
+DEFAULT_BACKEND = 'threads'
+
 DEST_DIR = 'downloads/'
 COUNTRY_CODES_FILE = 'country_codes.txt'
 
+# --dedupeのときに、画像をSHA-256の値の名前で1つずつ保存するディレクトリです（DEST_DIRの中）。
+OBJECTS_DIR = '.objects'
+
+# --archiveのときに、画像をまとめて書き込むファイルの接尾辞です（DEST_DIRの隣）。
+ARCHIVE_SUFFIX = '.pack'
+
+# aiohttp.TCPConnectorのデフォルト値に合わせています（単位は秒）。
+DNS_TTL = 10
+KEEPALIVE = 15
+
+# 404を返した国別コードを記録しておく期間のデフォルト値です（7日、単位は秒）。
+NEGATIVE_TTL = 7 * 24 * 60 * 60
+
+# 再試行とタイムアウトのデフォルト値です（時間の単位は秒）。
+RETRIES = 2
+BACKOFF = 0.1
+BACKOFF_MAX = 5.0
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10.0
+
+# 一時的な障害とみなし、再試行するHTTPステータスコードです。
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+# --streamを指定したときに、1回で書き出すバイト数です。
+CHUNK_SIZE = 16 * 1024
+
+# 複数の国旗を1回のリクエストで受け取るバッチのプロトコル（--batch）です。
+# {base_url}/batch?cc=br,cn,...に対して、BATCH_TYPEの本体で
+# 国別コードごとに「CC ステータス 長さ ETag\r\n」の行と、長さ分のバイト列を返します。
+BATCH_PATH = 'batch'
+BATCH_TYPE = 'application/x-flags-batch'
+BATCH_SIZE = 20
+
+# flags2_hybridの各段の並行数と、段と段の間のキューの長さです。
+# CPUの段のプロセス数のデフォルトは、CPUの数です。
+WRITE_WORKERS = 4
+QUEUE_SIZE = 16
+
+# asyncio版のダウンローダーで、書き込み待ちにできる画像の合計バイト数です。
+WRITE_BUFFER = 8 * 2**20
+
+# flags2_pipelinedで、1本の接続に応答を待たずに送るリクエストの数です。
+PIPELINE_DEPTH = 16
+
+# --windowを指定しないときに、並行数の何倍までタスクを先に投入しておくかです。
+WINDOW_FACTOR = 4
+
+# mkstempは一時ファイルを0600で作成するので、
+# 名前を変える前にopenと同じパーミッションに戻すためにumaskを読み出しておきます。
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class NotModified(Exception):
+    """
+    条件付きGETに対してサーバーが304 Not Modifiedを返したことを表します。
+    """
+
+
+class JsonIndex:
+    """
+    DEST_DIRの隣にJSONファイルとして保存される、国別コードをキーにした索引の基底クラスです。
+    スレッドプールから使えるよう、更新はロックで保護しています。
+    """
+
+    # サブクラスで、ファイル名の接尾辞を定めます。
+    suffix = '.json'
+
+    def __init__(self, path, entries=None):
+        self.path = path
+        self.entries = entries if entries is not None else {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path=None):
+        if path is None:
+            path = os.path.normpath(DEST_DIR) + cls.suffix
+        try:
+            with open(path) as fp:
+                entries = json.load(fp)
+        except (OSError, ValueError):
+            # 索引がない、あるいは壊れていれば、空の索引から始めます。
+            entries = {}
+        return cls(path, entries)
+
+    # ロックはpickleできないので、別のプロセスに渡すときは除き、受け取った側で作り直します。
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def put(self, key, entry):
+        """
+        記録をそのまま追加します。別のプロセスで更新された記録を取り込むのにも使います。
+        """
+        with self._lock:
+            self.entries[key] = entry
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            with open(tmp_path, 'w') as fp:
+                json.dump(self.entries, fp, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class FlagCache(JsonIndex):
+    """
+    ダウンロード済みの国旗について、ETag、Last-Modified、サイズ、SHA-256を記録する索引です。
+    downloads.index.jsonとして保存され、
+    次回の実行ではIf-None-Match/If-Modified-Sinceを送るのに使われます。
+    """
+
+    suffix = '.index.json'
+    # --archiveのときは、以前のアーカイブの索引（ArchiveWriter.previous_index）です。
+    # 画像はDEST_DIRではなくアーカイブから引き継ぐので、こちらと照らし合わせます。
+    archived = None
+
+    def request_headers(self, cc):
+        """
+        条件付きGETのためのヘッダーを返します。
+        手元の画像（--archiveならアーカイブの中の画像）がないか、記録と大きさが違うときは、
+        無条件でダウンロードし直します。304が返ってくるのは、画像を引き継げるときだけです。
+        """
+        entry = self.entries.get(cc)
+        if entry is None:
+            return {}
+        if self.archived is not None:
+            found = self.archived.get(cc)
+            if found is None or found[1] != entry['size']:
+                return {}
+            if entry.get('sha256') and found[2] != entry['sha256']:
+                return {}
+        else:
+            path = os.path.join(DEST_DIR, cc.lower() + '.gif')
+            try:
+                if os.path.getsize(path) != entry['size']:
+                    return {}
+            except OSError:
+                return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def update(self, cc, headers, size, digest):
+        entry = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'size': size,
+            'sha256': digest,
+        }
+        self.put(cc, entry)
+
+
+class NegativeCache(JsonIndex):
+    """
+    404 Not Foundが返ってきた国別コードと、その時刻を記録する索引です。
+    downloads.404.jsonとして保存され、記録からttl秒以内のコードは
+    iter_cc_argsでダウンロードの対象から外されます。
+    """
+
+    suffix = '.404.json'
+    ttl = NEGATIVE_TTL
+
+    def __init__(self, path, entries=None):
+        super().__init__(path, entries)
+        self.skipped = 0
+
+    def __contains__(self, cc):
+        return self.fresh(cc)
+
+    def fresh(self, cc, now=None):
+        """
+        ccの記録が、now（省略すれば現在時刻）の時点でttl秒以内なら真を返します。
+        """
+        found_at = self.entries.get(cc)
+        if now is None:
+            now = time.time()
+        return found_at is not None and now - found_at < self.ttl
+
+    def ifilter(self, codes, now=None):
+        """
+        イテラブルから、記録にないコードだけを1つずつ生成します。除いたコードの数はskippedに加算されます。
+        nowを指定すると、その時刻を基準に期限を判断するので、何度たどっても同じコードを生成します。
+        """
+        for cc in codes:
+            if self.fresh(cc, now):
+                self.skipped += 1
+            else:
+                yield cc
+
+    def record(self, cc, status):
+        """
+        ダウンロードの結果を記録します。404ならコードを追加し、
+        ダウンロードできたか変更がなかったなら、記録から取り除きます。
+        """
+        with self._lock:
+            if status == HTTPStatus.not_found:
+                self.entries[cc] = time.time()
+            elif status in (HTTPStatus.ok, HTTPStatus.not_modified):
+                self.entries.pop(cc, None)
+
+    def save(self):
+        # 期限切れの記録は保存しません。
+        now = time.time()
+        with self._lock:
+            self.entries = {cc: found_at for cc, found_at
+                            in self.entries.items()
+                            if now - found_at < self.ttl}
+        super().save()
+
+
+class Journal:
+    """
+    国別コードごとの最終的な結果を、終わった順に1行ずつ追記する記録（JSON Lines）です。
+    downloads.journalとして保存され、--resumeのときは記録済みのコードを飛ばします。
+
+    1行は1回のos.writeで、O_APPENDで開いたファイルに書くので、
+    スレッドやワーカープロセスが同時に追記しても行が混ざりません。
+    途中で止まったときに書きかけになった最後の行は、読み込むときに無視します。
+    エラーは次の実行で再試行すべきなので、記録しません。
+    """
+
+    suffix = '.journal'
+
+    def __init__(self, path, entries=None):
+        self.path = path
+        self.entries = entries if entries is not None else {}
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path=None):
+        if path is None:
+            path = os.path.normpath(DEST_DIR) + cls.suffix
+        entries = {}
+        try:
+            with open(path) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                        entries[entry['cc']] = entry
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except OSError:
+            pass
+        return cls(path, entries)
+
+    @classmethod
+    def start(cls, path=None):
+        """
+        以前の記録を消して、新しい記録を始めます。
+        """
+        journal = cls.load(path)
+        with open(journal.path, 'w'):
+            pass
+        journal.entries = {}
+        return journal
+
+    # ファイル記述子とロックはpickleできないので、ワーカープロセスでは開き直します。
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_fd=None, _pid=None)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def completed(self):
+        """
+        記録済みのコードと、そのHTTPStatusのdictを返します。
+        """
+        return {cc: HTTPStatus[entry['status']]
+                for cc, entry in self.entries.items()}
+
+    def record(self, cc, status, size=None, digest=None):
+        entry = {
+            'cc': cc,
+            'status': status.name,
+            'size': size,
+            'sha256': digest,
+            'time': time.time(),
+        }
+        line = (json.dumps(entry, sort_keys=True) + '\n').encode('utf-8')
+        with self._lock:
+            # forkで作られたプロセスは、親のファイル記述子を共有しないよう開き直します。
+            if self._fd is None or self._pid != os.getpid():
+                self._fd = os.open(self.path,
+                                   os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                   0o666)
+                self._pid = os.getpid()
+            os.write(self._fd, line)
+            self.entries[cc] = entry
+
+    def close(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
+
+
+def record_result(options, cc, status, size=None, digest=None):
+    """
+    download_oneが1つの国別コードを終えたときに呼び出し、
+    404の記録（NegativeCache）と実行の記録（Journal）を更新します。
+    304なら、以前の画像を引き継ぐようにアーカイブ（ArchiveWriter）にも知らせます。
+    """
+    if options is None:
+        return
+    options.negatives.record(cc, status)
+    if options.archive is not None and status == HTTPStatus.not_modified:
+        options.archive.keep(cc)
+    if options.journal is not None and status != HTTPStatus.error:
+        options.journal.record(cc, status, size, digest)
+
+
+class Manifest(JsonIndex):
+    """
+    --dedupeのときに、国旗のファイル名と、画像のSHA-256の値を対応付ける索引です。
+    downloads.manifest.jsonとして保存されます。
+    ハードリンクを作れないファイルシステムでは、これが画像を探す唯一の手がかりになります。
+    """
+
+    suffix = '.manifest.json'
+
+
+class _HashingFile:
+    """
+    書き込んだデータのSHA-256を、書き込みながら計算するファイルオブジェクトのラッパーです。
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.algo = hashlib.sha256()
+
+    def write(self, data):
+        self.algo.update(data)
+        return self.fp.write(data)
+
+
+class FlagStore:
+    """
+    同じ画像を1度だけ保存する、内容アドレス方式の保存先です。
+
+    画像はDEST_DIR/.objects/<SHA-256>.gifとして保存され、国旗のファイル名は
+    そこへのハードリンクになります。すでに同じ画像があれば、新しく書いたものは捨てます。
+    ハードリンクは同じファイルを指すので、1つを書き換えると同じ画像の国旗がすべて変わります。
+    countsには、保存したファイル（files）、新しい画像（unique）、重複（dupes）、
+    そのバイト数（stored、saved）と、ハードリンクを作れなかった数（unlinked）を数えます。
+    """
+
+    def __init__(self, dest_dir=DEST_DIR, manifest=None):
+        self.dest_dir = dest_dir
+        self.objects_dir = os.path.join(dest_dir, OBJECTS_DIR)
+        self.manifest = manifest if manifest is not None else Manifest.load()
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest + '.gif')
+
+    @contextlib.contextmanager
+    def flag_file(self, filename):
+        """
+        flags2_common.flag_fileと同じように使えます。書き込みながら画像のSHA-256を計算し、
+        withブロックが正常に終了したら、画像を.objectsへ移してfilenameにリンクします。
+        """
+        os.makedirs(self.objects_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.' + filename, suffix='.part',
+                                        dir=self.objects_dir)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                hashing = _HashingFile(fp)
+                yield hashing
+            self._commit(tmp_path, hashing.algo.hexdigest(), filename)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def _commit(self, tmp_path, digest, filename):
+        size = os.path.getsize(tmp_path)
+        obj_path = self.object_path(digest)
+        # 同じ画像を2つのスレッドが同時に書き終えても、1つだけを残すようにします。
+        with self._lock:
+            self.counts['files'] += 1
+            if os.path.exists(obj_path):
+                os.remove(tmp_path)
+                self.counts['dupes'] += 1
+                self.counts['saved'] += size
+            else:
+                os.chmod(tmp_path, 0o666 & ~_UMASK)
+                os.replace(tmp_path, obj_path)
+                self.counts['unique'] += 1
+                self.counts['stored'] += size
+        self.link(obj_path, filename)
+        self.manifest.put(filename, digest)
+
+    def link(self, obj_path, filename):
+        path = os.path.join(self.dest_dir, filename)
+        tmp_path = path + '.link'
+        try:
+            # 古いファイルを置き換えるときも、途中の状態が見えないようにします。
+            os.link(obj_path, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            # ハードリンクを使えなければ、画像はManifestからだけたどれます。
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            with self._lock:
+                self.counts['unlinked'] += 1
+
+
+class RetryPolicy:
+    """
+    失敗したリクエストの再試行とタイムアウトの方針です。
+    再試行までの待ち時間は、0からbackoff * 2**attemptまで（上限backoff_max）の
+    一様乱数です（フルジッター）。同時に失敗したリクエストが、同時に再試行しないようにします。
+    """
+
+    def __init__(self, retries=RETRIES, backoff=BACKOFF,
+                 backoff_max=BACKOFF_MAX, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT):
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    @property
+    def timeout(self):
+        """requestsのtimeout引数に渡す(接続, 読み込み)のタプルです。"""
+        return (self.connect_timeout, self.read_timeout)
 
-def save_flag(img, filename):
-    path = os.path.join(DEST_DIR, filename)
-    with open(path, 'wb') as fp:
-        fp.write(img)
+    def delay(self, attempt):
+        return random.uniform(0, min(self.backoff_max,
+                                     self.backoff * 2 ** attempt))
 
 
-def initial_report(cc_list actual_req, server_label):
-    if len(cc_list) <= 10:
-        cc_msg = ', '.join(cc_list)
+def retry_call(policy, func, retry_reason, stats=None, slot=None):
+    """
+    funcを呼び出し、retry_reasonが再試行すべき例外だと判断したら
+    （理由の文字列を返したら）、待ってから呼び出し直します。
+    試行ごとの所要時間と、理由ごとの再試行回数はstatsに記録されます。
+    slotには、試行ごとにwith文で取得するコンテキストマネージャを返す関数を指定します。
+    --rateのトークンを待つ時間はslotの取得に含め、所要時間には数えません。
+    再試行までの待ち時間は、slotを解放してから待ちます。
+    """
+    attempt = 0
+    while True:
+        try:
+            with (slot() if slot is not None else contextlib.suppress()):
+                t0 = time.time()
+                try:
+                    result = func()
+                finally:
+                    if stats is not None:
+                        stats.observe_latency(time.time() - t0)
+        except Exception as exc:
+            reason = retry_reason(exc)
+            if reason is None or attempt >= policy.retries:
+                raise
+            if stats is not None:
+                stats.count_retry(reason)
+            time.sleep(policy.delay(attempt))
+            attempt += 1
+        else:
+            return result
+
+
+class RunStats:
+    """
+    download_manyの実行中に集計される、結果のカウンタ以外の統計情報です。
+    connectionsはホストごとに、新規に開いた接続（created）と
+    再利用した接続（reused）の数を数えます。
+    """
+
+    def __init__(self):
+        self.connections = collections.defaultdict(collections.Counter)
+        self.peak_rss = None
+        self.skipped = 0
+        # --adaptiveのときに、(経過秒数, 並行数の上限)の履歴が入ります。
+        self.concurrency = None
+        self.retries = collections.Counter()
+        # asyncio版のダウンローダーで、flags2_writer.AsyncWriter.summaryの値が入ります。
+        self.writes = None
+        # --dedupeのときに、FlagStore.countsの値が入ります。
+        self.dedupe = collections.Counter()
+        # --rateのときに、待たされたリクエストの数（delayed）と秒数（waited）が入ります。
+        self.throttle = collections.Counter()
+        # 区間ごとの所要時間と受信したバイト数です。
+        self.metrics = Metrics()
+        self._lock = threading.Lock()
+
+    def count_connection(self, host, kind):
+        self.connections[host][kind] += 1
+
+    def count_retry(self, reason):
+        with self._lock:
+            self.retries[reason] += 1
+
+    def observe_latency(self, seconds):
+        self.metrics.observe('request', seconds)
+
+    def merge(self, other):
+        """
+        別のプロセスで集計されたRunStatsを、このインスタンスに加えます。
+        """
+        with self._lock:
+            for host, conns in other.connections.items():
+                self.connections[host].update(conns)
+            self.retries.update(other.retries)
+            self.dedupe.update(other.dedupe)
+            self.throttle.update(other.throttle)
+            if other.writes is not None:
+                if self.writes is None:
+                    self.writes = dict(other.writes)
+                else:
+                    for key in ('files', 'batches', 'waited'):
+                        self.writes[key] += other.writes[key]
+                    # バッファはプロセスごとにあるので、ピーク値は最大のものを残します。
+                    self.writes['peak_bytes'] = max(self.writes['peak_bytes'],
+                                                    other.writes['peak_bytes'])
+        self.metrics.merge(other.metrics)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def save_flag(img, filename, metrics=None, store=None):
+    t0 = time.time()
+    if store is not None:
+        # --dedupeのときは、FlagStoreに保存します。
+        with store.flag_file(filename) as fp:
+            fp.write(img)
+    else:
+        # --dedupeで保存した<cc>.gifは.objectsの画像へのハードリンクなので、
+        # その場で書き換えると、リンクを共有する他の国旗まで変わってしまいます。
+        # 一時ファイルに書いてから置き換え、リンクだけを切り離します。
+        with flag_file(filename) as fp:
+            fp.write(img)
+    if metrics is not None:
+        metrics.observe('write', time.time() - t0)
+
+
+@contextlib.contextmanager
+def flag_file(filename):
+    """
+    DEST_DIRに一時ファイルを作成し、書き込み用のファイルオブジェクトを渡します。
+    withブロックが正常に終了すると、一時ファイルの名前をアトミックにfilenameへ変更します。
+    例外が発生したときは一時ファイルを削除するので、書きかけの画像が残ることはありません。
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + filename, suffix='.part',
+                                    dir=DEST_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            yield fp
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, os.path.join(DEST_DIR, filename))
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def save_flag_chunks(chunks, filename, store=None):
+    """
+    チャンクのイテラブルを順に書き出し、書き出したバイト数とSHA-256の値を返します。
+    画像全体をメモリに保持しないので、同時に処理する画像が多くてもメモリ使用量は増えません。
+    storeにFlagStoreを指定すると、そこに保存します。
+    """
+    size = 0
+    algo = hashlib.sha256()
+    opener = store.flag_file if store is not None else flag_file
+    with opener(filename) as fp:
+        for chunk in chunks:
+            fp.write(chunk)
+            algo.update(chunk)
+            size += len(chunk)
+    return size, algo.hexdigest()
+
+
+def peak_rss():
+    """
+    このプロセスの常駐メモリサイズ（RSS）のピーク値をバイト単位で返します。
+    計測できないOSではNoneを返します。
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrssの単位はmacOSではバイト、Linuxではキロバイトです。
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def load_backend(name):
+    """
+    BACKENDSに登録されたダウンローダーのモジュールをインポートして返します。
+    aiohttpなど、使わないダウンローダーの依存ライブラリは必要ありません。
+
+    どのダウンローダーも、次の約束に従います。
+    download_many(cc_list, base_url, verbose, concur_req, options=None)は、
+    HTTPStatusをキーにしたCounterを返し、国別コード1つにつき1回だけtallyで数えます。
+    mainはcc_listにジェネレータを渡すので、len(cc_list)の代わりにcount_hintを使います。
+    所要時間などの統計は、options.statsのRunStatsに記録します。
+    error_message(exc)は、エラーとして数えるべき例外ならメッセージを、
+    そうでなければ（スクリプトを終了させるべき例外なら）Noneを返します。
+    """
+    return importlib.import_module(BACKENDS[name])
+
+
+def pack_batch_frame(cc, status, body=b'', etag=None):
+    """
+    バッチの本体の、国別コード1つ分のフレームを返します。
+    """
+    header = '{} {} {} {}\r\n'.format(cc.upper(), status, len(body),
+                                      etag or '-')
+    return header.encode('ascii') + body
+
+
+def iter_batch_frames(data):
+    """
+    バッチの本体から、(国別コード, ステータス, 本体, ETag)を順に生成します。
+    本体は、dataがmemoryviewなら、コピーせずに切り出したmemoryviewです。
+    """
+    pos = 0
+    while pos < len(data):
+        end = bytes(data[pos:pos + 256]).find(b'\r\n')
+        if end < 0:
+            raise ValueError('truncated batch frame at byte {}'.format(pos))
+        cc, status, length, etag = (bytes(data[pos:pos + end])
+                                    .decode('ascii').split())
+        start = pos + end + 2
+        pos = start + int(length)
+        if pos > len(data):
+            raise ValueError('truncated batch frame for {}'.format(cc))
+        yield cc, int(status), data[start:pos], None if etag == '-' else etag
+
+
+def tally(counter, cc, status, error_msg='', verbose=False):
+    """
+    1つの国別コードの結果をcounterに数えます。error_msgがあれば、結果はエラーです。
+    """
+    if error_msg:
+        status = HTTPStatus.error
+    counter[status] += 1
+    if verbose and error_msg:
+        print('*** Error for {}: {}'.format(cc, error_msg))
+    return status
+
+
+def initial_report(codes, actual_req, server_label):
+    """
+    codesには、count_codesが返すCodeCountを指定します。
+    """
+    if codes.count <= len(codes.head):
+        cc_msg = ', '.join(codes.head)
     else:
-        cc_msg = 'from {} to {}'.format(cc_list[0], cc_list[-1])
+        cc_msg = 'from {} to {}'.format(codes.head[0], codes.last)
     print('{} site: {}'.format(server_label, SERVERS[server_label]))
     msg = 'Searching for {} flag{}: {}'
-    plural = 's' if len(cc_list) != 1 else ''
-    print(msg.format(len(cc_list), plural, cc_msg))
+    plural = 's' if codes.count != 1 else ''
+    print(msg.format(codes.count, plural, cc_msg))
     plural = 's' if actual_req != 1 else ''
     msg = '{} concurrent connection{} will be used.'
     print(msg.format(actual_req, plural))
 
 
-def final_report(cc_list, counter, start_time):
+def final_report(cc_list, counter, start_time, stats=None):
     elapsed = time.time() - start_time
     print('-' * 20)
     msg = '{} flag{} downloaded.'
     plural = 's' if counter[HTTPStatus.ok] != 1 else ''
     print(msg.format(counter[HTTPStatus.ok], plural))
+    if counter[HTTPStatus.not_modified]:
+        print(counter[HTTPStatus.not_modified], 'not modified.')
     if counter[HTTPStatus.not_found]:
         print(counter[HTTPStatus.not_found], 'not found.')
+    if stats is not None and stats.skipped:
+        print(stats.skipped, 'skipped (not found in a previous run).')
     if counter[HTTPStatus.error]:
         plural = 's' if counter[HTTPStatus.error] != 1 else ''
         print('{} error{}.'.format(counter[HTTPStatus.error], plural))
+    if stats is not None:
+        for host, conns in sorted(stats.connections.items()):
+            total = conns['created'] + conns['reused']
+            msg = 'Connections to {}: {} opened, {} reused ({:.0%} reuse).'
+            print(msg.format(host, conns['created'], conns['reused'],
+                             conns['reused'] / total if total else 0))
+    if stats is not None and stats.concurrency:
+        limits = [limit for _, limit in stats.concurrency]
+        msg = 'Concurrency: started at {}, peaked at {}, ended at {} ({} changes).'
+        print(msg.format(limits[0], max(limits), limits[-1], len(limits) - 1))
+    if stats is not None and stats.retries:
+        total = sum(stats.retries.values())
+        reasons = ', '.join('{}: {}'.format(reason, count) for reason, count
+                            in stats.retries.most_common())
+        plural = 's' if total != 1 else ''
+        print('{} retr{} ({}).'.format(total, 'ies' if plural else 'y',
+                                       reasons))
+    if stats is not None and stats.throttle['delayed']:
+        msg = ('Rate limit: {} requests delayed, '
+               '{:.2f}s spent waiting for tokens in all.')
+        print(msg.format(stats.throttle['delayed'], stats.throttle['waited']))
+    if stats is not None and stats.writes:
+        msg = ('Writes: {files} files in {batches} batches, '
+               'peak buffer {peak:.1f} KiB, {waited:.2f}s waiting for buffer.')
+        print(msg.format(peak=stats.writes['peak_bytes'] / 1024,
+                         **stats.writes))
+    if stats is not None and stats.dedupe['files']:
+        dedupe = stats.dedupe
+        total = dedupe['stored'] + dedupe['saved']
+        msg = ('Dedupe: {} files, {} new images, {} duplicates; '
+               '{:.1f} KiB saved ({:.0%}).')
+        print(msg.format(dedupe['files'], dedupe['unique'], dedupe['dupes'],
+                         dedupe['saved'] / 1024,
+                         dedupe['saved'] / total if total else 0))
+        if dedupe['unlinked']:
+            print(dedupe['unlinked'], 'files could not be hard-linked; '
+                  'see the manifest.')
+    if stats is not None and stats.dedupe['carried']:
+        print(stats.dedupe['carried'], 'flags carried over from the previous '
+              'archive.')
+    if stats is not None and stats.dedupe['dropped']:
+        print(stats.dedupe['dropped'], 'flags dropped from the previous '
+              'archive (not found or failed this run).')
+    if stats is not None:
+        for line in stats.metrics.report(elapsed):
+            print(line)
+    if stats is not None and stats.peak_rss is not None:
+        print('Peak RSS: {:.1f} MiB'.format(stats.peak_rss / 2**20))
     print('Elapsed time: {:.2f}s'.format(elapsed))
 
 
-def expand_cc_args(every_cc, all_cc, cc_args, limit):
-    codes = set()
+def iter_cc_args(every_cc, all_cc, cc_args, limit, negatives=None, now=None):
+    """
+    expand_cc_argsと同じ国別コードを、アルファベット順に1つずつ生成するジェネレータです。
+    --everyのときもコードのリストを作らないので、大きなコード空間にも使えます。
+    引数の検査は最初のコードを取り出したときに行われます。
+    nowはNegativeCache.ifilterに渡す、404の記録の期限を判断する時刻です。
+    """
     A_Z = string.ascii_uppercase
     if every_cc:
-        codes.update(a+b for a in A_Z for b in A_Z)
+        codes = (a+b for a in A_Z for b in A_Z)
     elif all_cc:
         with open(COUNTRY_CODES_FILE) as fp:
-            text = fp.read()
-        codes.update(text.split())
+            codes = sorted(set(fp.read().split()))
     else:
+        selected = set()
         for cc in (c.upper() for c in cc_args):
             if len(cc) == 1 and cc in A_Z:
-                codes.update(cc+c for c in A_Z)
+                selected.update(cc+c for c in A_Z)
             elif len(cc) == 2 and all(c in A_Z for c in cc):
-                codes.add(cc)
+                selected.add(cc)
             else:
                 msg = 'each CC argument must be A to Z or AA or ZZ.'
                 raise ValueError('*** Usage error: '+msg)
-    return  sorted(codes)[:limit]
+        codes = sorted(selected)
+    # -l/--limitは、404の記録があるかどうかに関係なく同じコードを選ぶよう、先に適用します。
+    codes = itertools.islice(codes, limit)
+    if negatives is not None:
+        codes = negatives.ifilter(codes, now)
+    yield from codes
+
+
+def expand_cc_args(every_cc, all_cc, cc_args, limit, negatives=None):
+    """
+    コマンドラインの引数から国別コードのリストを作成します。
+    negativesにNegativeCacheを指定すると、--limitで選んだコードのうち、
+    最近404が返ってきたコードは除かれます。
+    """
+    return list(iter_cc_args(every_cc, all_cc, cc_args, limit, negatives))
+
+
+def count_codes(codes, preview=10):
+    """
+    国別コードのイテラブルを1度だけたどり、CodeCountを返します。
+    コードのリストは作らないので、ダウンロードに渡すジェネレータとは別に、
+    同じ条件で作ったもう1つのジェネレータから数だけを求めるのに使います。
+    """
+    count = 0
+    head = []
+    last = None
+    for cc in codes:
+        count += 1
+        if len(head) < preview:
+            head.append(cc)
+        last = cc
+    return CodeCount(count, head, last)
+
+
+def count_hint(codes, options=None):
+    """
+    国別コードの数がわかればそれを返します。tqdmのtotalに使います。
+    ジェネレータのように数がわからなければ、mainが別に数えたoptions.totalを返します。
+    それもなければNoneを返します。
+    """
+    try:
+        return len(codes)
+    except TypeError:
+        return options.total if options is not None else None
 
 
-def process_args(default_concur_req):
+def window_size(concur_req, options=None):
+    """
+    同時に投入しておくタスクの数です。--windowがなければ並行数のWINDOW_FACTOR倍です。
+    """
+    if options is not None and options.window is not None:
+        return options.window
+    return concur_req * WINDOW_FACTOR
+
+
+def submit_windowed(executor, fn, codes, window, *args):
+    """
+    codesから国別コードを必要になった分だけ取り出してexecutor.submit(fn, cc, *args)を呼び出し、
+    完了した順に(future, cc)を生成します。
+    実行中と実行待ちのFutureは最大でwindow個なので、コードの数が多くてもメモリは増えません。
+    """
+    codes = iter(codes)
+    pending = {}
+
+    def fill():
+        for cc in itertools.islice(codes, window - len(pending)):
+            pending[executor.submit(fn, cc, *args)] = cc
+
+    fill()
+    while pending:
+        done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+        for future in done:
+            cc = pending.pop(future)
+            # 結果を処理する前に空いた分を補充し、プールを遊ばせないようにします。
+            fill()
+            yield future, cc
+
+
+def build_parser(default_concur_req):
     server_options = ', '.join(sorted(SERVERS))
     parser = argparse.ArgumentParser(
         description='Download flags for country codes.'
@@ -101,17 +940,189 @@ def process_args(default_concur_req):
         help='get flags for every possible code (AA...ZZ)')
     parser.add_argument('-l', '--limit', metavar='N', type=int,
         help='limit to N first codes', default=sys.maxsize)
+    # デフォルト値は、process_argsでダウンローダーが決まってから設定します。
     parser.add_argument('-m', '--max_req', metavar='CONCURRENT', type=int,
-        default=default_concur_req,
         help='maximum concurrent requests (default={})'
-            .format(default_concur_req))
+            .format(default_concur_req or 'depends on --backend'))
+    parser.add_argument('-b', '--backend', choices=list(BACKENDS),
+        help='download with this concurrency model instead of the one '
+            'of the script being run (default for flags2_common.py: {})'
+            .format(DEFAULT_BACKEND))
     parser.add_argument('-s', '--server', metavar='LABEL',
         default=DEFAULT_SERVER,
         help='Server to hit; one of {} (default={})'
             .format(server_options, DEFAULT_SERVER))
     parser.add_argument('-v', '--verbose', action='store_true',
         help='output detailed progress info')
+    parser.add_argument('--no-pool', dest='pool', action='store_false',
+        help='open a new connection for every request '
+            '(default: keep-alive pool of --max_req connections per thread)')
+    parser.add_argument('--limit-per-host', metavar='N', type=int, default=0,
+        help='maximum connections to a single host; 0 means no limit '
+            '(asyncio only, default=0)')
+    parser.add_argument('--dns-ttl', metavar='SECONDS', type=int,
+        default=DNS_TTL,
+        help='seconds to cache DNS lookups; 0 disables the cache '
+            '(asyncio only, default={})'.format(DNS_TTL))
+    parser.add_argument('--keepalive', metavar='SECONDS', type=float,
+        default=KEEPALIVE,
+        help='seconds to keep idle connections open '
+            '(asyncio only, default={})'.format(KEEPALIVE))
+    parser.add_argument('--stream', action='store_true',
+        help='write images to disk in {} KB chunks instead of buffering '
+            'them in memory'.format(CHUNK_SIZE // 1024))
+    parser.add_argument('--rss', action='store_true',
+        help='report the peak resident memory of the run')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+        help='ignore the ETag/Last-Modified index and download every flag')
+    parser.add_argument('--negative-ttl', metavar='SECONDS', type=int,
+        default=NEGATIVE_TTL,
+        help='skip codes that were not found within SECONDS '
+            '(default={})'.format(NEGATIVE_TTL))
+    parser.add_argument('--refresh-negatives', action='store_true',
+        help='request codes that were not found in previous runs too')
+    parser.add_argument('-r', '--retries', metavar='N', type=int,
+        default=RETRIES,
+        help='retry timeouts, connection errors and 429/5xx responses up to '
+            'N times (default={})'.format(RETRIES))
+    parser.add_argument('--backoff', metavar='SECONDS', type=float,
+        default=BACKOFF,
+        help='base delay between retries; doubled on each attempt, with full '
+            'jitter and a {}s cap (default={})'.format(BACKOFF_MAX, BACKOFF))
+    parser.add_argument('--connect-timeout', metavar='SECONDS', type=float,
+        default=CONNECT_TIMEOUT,
+        help='connect timeout per request (default={})'
+            .format(CONNECT_TIMEOUT))
+    parser.add_argument('--read-timeout', metavar='SECONDS', type=float,
+        default=READ_TIMEOUT,
+        help='read timeout per request (default={})'.format(READ_TIMEOUT))
+    parser.add_argument('--metrics-json', metavar='PATH',
+        help='write latency histograms and throughput to PATH as JSON')
+    parser.add_argument('--cpu-workers', metavar='N', type=int,
+        help='processes for the post-processing stage '
+            '(hybrid only, default: number of CPUs)')
+    parser.add_argument('--write-workers', metavar='N', type=int,
+        default=WRITE_WORKERS,
+        help='threads writing images to disk (asyncio and hybrid, '
+            'default={})'.format(WRITE_WORKERS))
+    parser.add_argument('--write-buffer', metavar='BYTES', type=int,
+        default=WRITE_BUFFER,
+        help='image bytes that may wait to be written; downloads pause '
+            'while it is full (asyncio and hybrid, default={})'
+            .format(WRITE_BUFFER))
+    parser.add_argument('--batch-writes', action='store_true',
+        help='hand images submitted together to one writer thread '
+            '(asyncio and hybrid)')
+    parser.add_argument('--procs', metavar='N', type=int, default=1,
+        help='split the codes across N processes, each running the backend '
+            'with its own event loop or thread pool; --max_req is shared '
+            'among them (default=1)')
+    parser.add_argument('--pipeline-depth', metavar='N', type=int,
+        default=PIPELINE_DEPTH,
+        help='requests sent on one connection before waiting for the first '
+            'response (pipelined only, default={})'.format(PIPELINE_DEPTH))
+    parser.add_argument('--batch', metavar='SIZE', type=int, nargs='?',
+        const=BATCH_SIZE, default=0,
+        help='ask for SIZE flags per request through the server batch '
+            'endpoint, falling back to one request per flag if the server '
+            'lacks it (sequential and threads only; SIZE default={})'
+            .format(BATCH_SIZE))
+    parser.add_argument('--window', metavar='N', type=int,
+        help='codes submitted ahead of the downloads in flight; codes are '
+            'read lazily and at most N tasks exist at a time '
+            '(default: {} x --max_req)'.format(WINDOW_FACTOR))
+    parser.add_argument('--queue-size', metavar='N', type=int,
+        default=QUEUE_SIZE,
+        help='images buffered between pipeline stages; a full queue holds '
+            'back the stage before it (hybrid only, default={})'
+            .format(QUEUE_SIZE))
+    parser.add_argument('--sha', metavar='SIZE', type=int, nargs='?',
+        const=2**20,
+        help='also run sha_futures.sha(SIZE) for every image in the '
+            'post-processing stage (hybrid only, default SIZE=1048576)')
+    parser.add_argument('--dedupe', action='store_true',
+        help='store each distinct image once under {}/ by SHA-256 and '
+            'hard-link the flag names to it'.format(OBJECTS_DIR))
+    parser.add_argument('--archive', metavar='PATH', nargs='?',
+        const=os.path.normpath(DEST_DIR) + ARCHIVE_SUFFIX, dest='archive_path',
+        help='append the images to one packed archive with an index instead '
+            'of writing a file per flag (default PATH={}{}; not available '
+            'with the processes backend)'
+            .format(os.path.normpath(DEST_DIR), ARCHIVE_SUFFIX))
+    parser.add_argument('--resume', action='store_true',
+        help='skip codes that the journal ({}{}) shows as done in an '
+            'interrupted run; without it, the journal starts over'
+            .format(os.path.normpath(DEST_DIR), Journal.suffix))
+    parser.add_argument('--rate', metavar='R', type=float,
+        help='send at most R requests per second to each host, with a token '
+            'bucket shared by all workers; raise --max_req to hide latency '
+            'without exceeding the rate')
+    parser.add_argument('--burst', metavar='N', type=float,
+        help='requests allowed back to back before --rate applies '
+            '(default: R, i.e. one second of requests)')
+    parser.add_argument('--adaptive', action='store_true',
+        help='adjust concurrency between 1 and --max_req (AIMD), growing '
+            'while latency stays low and backing off on errors')
+    return parser
+
+
+def init_run(args, journal_path=None):
+    """
+    コマンドラインの引数に、実行中に共有するオブジェクトを追加します。
+    journal_pathを指定すると、downloads.journalの代わりにそのファイルへ記録します。
+    """
+    args.stats = RunStats()
+    args.cache = FlagCache.load() if args.use_cache else None
+    args.negatives = NegativeCache.load()
+    args.negatives.ttl = args.negative_ttl
+    args.store = FlagStore() if args.dedupe else None
+    # ArchiveWriterもflag_fileを持っているので、FlagStoreの代わりに保存先として使えます。
+    args.archive = None
+    if args.archive_path is not None:
+        args.archive = args.store = ArchiveWriter(args.archive_path)
+        if args.cache is not None:
+            args.cache.archived = args.archive.previous_index()
+    args.retry = RetryPolicy(args.retries, args.backoff, BACKOFF_MAX,
+                             args.connect_timeout, args.read_timeout)
+    args.throttle = None
+    if args.rate is not None:
+        args.throttle = RateLimiter(args.rate, args.burst)
+    if args.resume:
+        args.journal = Journal.load(journal_path)
+    else:
+        args.journal = Journal.start(journal_path)
+    # --resumeで飛ばしたコードと、記録されていたHTTPStatusです。
+    args.resumed = {}
+    # ダウンローダーに渡すコードの数です。process_argsがコードを数えてから設定します。
+    args.total = None
+    return args
+
+
+def process_args(default_concur_req, download_many=None):
+    """
+    download_manyには、mainを呼び出したスクリプトのdownload_manyを指定します。
+    --backendがなければ、そのモジュールに合わせて引数を検査します。
+    """
+    server_options = ', '.join(sorted(SERVERS))
+    parser = build_parser(default_concur_req)
     args = parser.parse_args()
+    if args.backend is None and default_concur_req is None:
+        args.backend = DEFAULT_BACKEND
+    backend = None
+    if download_many is not None:
+        backend = sys.modules.get(download_many.__module__)
+    if args.backend is not None:
+        try:
+            backend = load_backend(args.backend)
+            default_concur_req = backend.DEFAULT_CONCUR_REQ
+        except (ImportError, AttributeError) as exc:
+            # 依存ライブラリがないか、そのPythonでは使えないAPIに依存していれば、
+            # トレースバックではなく使い方のエラーとして報告します。
+            print('*** Backend {} is not available: {}'.format(args.backend,
+                                                              exc))
+            sys.exit(1)
+    if args.max_req is None:
+        args.max_req = default_concur_req
     if args.max_req < 1:
         print('*** Usage error: --max_req CONCURRENT must be >= 1')
         parser.print_usage()
@@ -120,32 +1131,177 @@ def process_args(default_concur_req):
         print('*** Usage error: --limit N must be >= 1')
         parser.print_usage()
         sys.exit(1)
+    if args.retries < 0 or args.backoff < 0:
+        print('*** Usage error: --retries and --backoff must be >= 0')
+        parser.print_usage()
+        sys.exit(1)
+    if args.connect_timeout <= 0 or args.read_timeout <= 0:
+        print('*** Usage error: timeouts must be > 0')
+        parser.print_usage()
+        sys.exit(1)
+    if ((args.cpu_workers is not None and args.cpu_workers < 1)
+            or args.write_workers < 1 or args.queue_size < 1
+            or args.write_buffer < 1
+            or (args.window is not None and args.window < 1)
+            or args.procs < 1 or args.pipeline_depth < 1):
+        print('*** Usage error: --cpu-workers, --write-workers, '
+              '--write-buffer, --queue-size, --window, --procs and '
+              '--pipeline-depth must be >= 1')
+        parser.print_usage()
+        sys.exit(1)
+    if args.dedupe and args.archive_path is not None:
+        print('*** Usage error: --dedupe and --archive cannot be combined '
+              '(the archive stores each distinct image once anyway)')
+        parser.print_usage()
+        sys.exit(1)
+    if args.resume and args.archive_path is not None:
+        # 中断した実行のアーカイブ（.pack.part）は捨てられるので、
+        # 記録にあるコードを飛ばすと、その国旗はどこにも残りません。
+        print('*** Usage error: --resume cannot be combined with --archive '
+              '(an interrupted archive is discarded, not resumed)')
+        parser.print_usage()
+        sys.exit(1)
+    if args.procs > 1 and args.archive_path is not None:
+        print('*** Usage error: --archive cannot be combined with --procs')
+        parser.print_usage()
+        sys.exit(1)
+    if (args.archive_path is not None
+            and not getattr(backend, 'SUPPORTS_ARCHIVE', True)):
+        print('*** Usage error: --archive is not available with this '
+              'backend')
+        parser.print_usage()
+        sys.exit(1)
+    if ((args.rate is not None and args.rate <= 0)
+            or (args.burst is not None and args.burst < 1)):
+        print('*** Usage error: --rate must be > 0 and --burst >= 1')
+        parser.print_usage()
+        sys.exit(1)
+    if args.burst is not None and args.rate is None:
+        print('*** Usage error: --burst requires --rate')
+        parser.print_usage()
+        sys.exit(1)
+    if args.batch < 0:
+        print('*** Usage error: --batch SIZE must be >= 1')
+        parser.print_usage()
+        sys.exit(1)
+    if args.limit_per_host < 0 or args.dns_ttl < 0 or args.keepalive < 0:
+        print('*** Usage error: --limit-per-host, --dns-ttl and --keepalive '
+              'must be >= 0')
+        parser.print_usage()
+        sys.exit(1)
     args.server = args.server.upper()
     if args.server not in SERVERS:
         print('*** Usage error: --server Label must be one of',
             server_options)
         parser.print_usage()
         sys.exit(1)
+    # 国別コードの引数も、init_runがアーカイブや実行の記録のファイルを作る前に検査します。
+    # limitが0なら、検査だけをしてコードは1つも生成しません。
     try:
-        cc_list = expand_cc_args(args.every, args.all, args.cc, args.limit)
+        for _ in iter_cc_args(args.every, args.all, args.cc, 0):
+            pass
     except ValueError as exc:
         print(exc.args[0])
         parser.print_usage()
         sys.exit(1)
+    init_run(args)
 
+    # --refresh-negativesが指定されたときも、今回の結果は記録されます。
+    negatives = None if args.refresh_negatives else args.negatives
+    # --resumeのときは、記録済みのコードと、そのHTTPStatusです。
+    done = args.journal.completed() if args.resume else {}
+    # 404の記録の期限は、この時刻で判断します。実行中に期限が切れても、
+    # 数えたコードとダウンロードするコードが食い違わないようにするためです。
+    now = time.time()
 
-    if not cc_list:
-        cc_list = sorted(POP20_CC)
-    return args, cc_list
+    def iter_codes():
+        if not (args.every or args.all or args.cc):
+            return iter(sorted(POP20_CC))
+        return iter_cc_args(args.every, args.all, args.cc, args.limit,
+                            negatives, now)
 
+    # ダウンローダーには、コードを1つずつ生成するジェネレータを渡します。
+    # 報告や並行数に使うコードの数は、同じ条件のジェネレータをもう1度たどって数えます。
+    for cc in iter_codes():
+        if cc in done:
+            args.resumed[cc] = done[cc]
+    args.stats.skipped = args.negatives.skipped
+    cc_count = count_codes(cc for cc in iter_codes() if cc not in done)
+    args.total = cc_count.count
+    cc_iter = (cc for cc in iter_codes() if cc not in done)
+    return args, cc_iter, cc_count
 
-def main(download_many, default_concur_req, max_concur_req):
-    args, cc_list = process_args(default_concur_req)
-    actual_req = min(args.max_req, max_concur_req, len(cc_list))
-    initial_report(cc_list, actual_req, args.server)
+
+def main(download_many=None, default_concur_req=None, max_concur_req=None):
+    """
+    各スクリプトは自身のdownload_manyを渡して呼び出します。
+    --backendが指定されたら（引数なしで呼ばれたときはDEFAULT_BACKENDで）、
+    そのダウンローダーを代わりに使います。
+    """
+    args, cc_iter, cc_count = process_args(default_concur_req, download_many)
+    if args.backend is not None:
+        backend = load_backend(args.backend)
+        download_many = backend.download_many
+        max_concur_req = backend.MAX_CONCUR_REQ
+    # 既知の404をすべて除いた結果、コードが1つも残らないこともあります。
+    actual_req = max(1, min(args.max_req, max_concur_req, cc_count.count))
+    initial_report(cc_count, actual_req, args.server)
+    if args.resume:
+        print('Resuming: {} of {} flags already done.'.format(
+            len(args.resumed), len(args.resumed) + cc_count.count))
+    procs = min(args.procs, cc_count.count)
+    if procs > 1:
+        # flags2_shardsはflags2_commonをインポートするので、ここでインポートします。
+        import flags2_shards
+        per_proc = -(-actual_req // procs)
+        plural = 's' if per_proc != 1 else ''
+        print('Sharded across {} processes, {} connection{} each.'.format(
+            procs, per_proc, plural))
+        download_many = functools.partial(flags2_shards.download_sharded,
+                                          download_many, procs=procs)
     base_url = SERVERS[args.server]
+    if args.archive is not None:
+        # 問い合わせたコードを記録し、404などになった国旗を以前のアーカイブから引き継がないようにします。
+        cc_iter = args.archive.track(cc_iter)
     t0 = time.time()
-    counter = download_many(cc_list, base_url, args.verbose, actual_req)
-    assert sum(counter.values()) == len(cc_list), \
+    try:
+        counter = download_many(cc_iter, base_url, args.verbose, actual_req,
+                                args)
+    except BaseException:
+        if args.archive is not None:
+            args.archive.abort()
+        raise
+    finally:
+        args.journal.close()
+    # 前回までに終わっていたコードも、記録されていた結果として数えます。
+    counter.update(args.resumed.values())
+    if args.rss:
+        # ピーク値はプロセス全体のものなので、--streamの有無で比較するときは
+        # それぞれ別のプロセスとして実行してください。
+        args.stats.peak_rss = peak_rss()
+    if args.cache is not None:
+        args.cache.save()
+    args.negatives.save()
+    if args.archive is not None:
+        # 索引は、すべての画像を追加したあとに1度だけ書き込みます。
+        args.archive.close()
+        args.stats.dedupe.update(args.archive.counts)
+        args.stats.dedupe['carried'] = args.archive.carried
+        args.stats.dedupe['dropped'] = args.archive.dropped
+    elif args.store is not None:
+        args.store.manifest.save()
+        args.stats.dedupe.update(args.store.counts)
+    assert sum(counter.values()) == cc_count.count + len(args.resumed), \
         'some downloads are unaccounted for'
-    final_report(cc_list, counter, t0)
+    final_report(cc_count, counter, t0, args.stats)
+    if args.metrics_json:
+        counts = {status.name: count for status, count in counter.items()}
+        args.stats.metrics.dump(args.metrics_json, server=args.server,
+                                elapsed=time.time() - t0, counts=counts)
+
+
+if __name__ == '__main__':
+    # ダウンローダーはflags2_commonをインポートするので、このモジュールを__main__として
+    # 使うとHTTPStatusなどが2つずつできてしまいます。flags2_commonとしてインポートし直します。
+    import flags2_common
+    flags2_common.main()
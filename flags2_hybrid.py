@@ -0,0 +1,235 @@
+"""
+asyncioでダウンロードし、プロセスプールで後処理する段階的なパイプラインの実装
+
+ダウンロード（fetch）、後処理（CPU）、書き込み（write）の3段からなり、
+段と段の間は長さ--queue-sizeのasyncio.Queueでつながっています。
+後ろの段が遅れてキューが一杯になると、前の段はキューが空くまで待つので、
+メモリ上に溜まる画像の数には上限があります。
+
+    fetch: -m/--max_req個のコルーチンが、aiohttpで画像をダウンロードします。
+    CPU:   --cpu-workers個のプロセスで、画像のSHA-256を計算します。
+           --shaを指定すると、sha_futures.shaの計算も加わります。
+    write: --write-workers個のスレッドで、画像をディスクに書き出します
+           （flags2_writer.AsyncWriterを使うので、--write-bufferと--batch-writesも有効です）。
+
+画像は必ずメモリに読み込むので、--streamは使われません。
+
+Sample run::
+
+    $ python3 flags2_hybrid.py -s DELAY -e -l 200 --sha
+    DELAY site: http://localhost:8002/flags
+    Searching for 200 flags: from AA to HR
+    5 concurrent connections will be used.
+    --------------------
+    48 flags downloaded.
+    152 not found.
+    ...
+    Elapsed time: 20.41s
+
+"""
+
+import time
+import asyncio
+import functools
+import collections
+from concurrent import futures
+
+from aiohttp import web
+import tqdm
+
+from flags2_common import (main, tally, record_result, count_hint, HTTPStatus,
+                           WRITE_WORKERS, QUEUE_SIZE)
+from flags2_asyncio import (FetchError, fetch_flag, make_session,
+                            make_limiter, make_writer, retry_coro,
+                            acquire_slot, error_message)
+from sha_futures import sha, sha_digest
+
+DEFAULT_CONCUR_REQ = 5
+MAX_CONCUR_REQ = 1000
+
+STATUS_MSG = {
+    HTTPStatus.ok: 'OK',
+    HTTPStatus.not_found: 'not found',
+    HTTPStatus.not_modified: 'not modified',
+}
+
+
+def process_flag(image, sha_size=None):
+    """
+    CPUの段で、ワーカープロセスが実行する関数です。画像のSHA-256を返します。
+    sha_sizeが指定されたら、重い後処理の代わりにsha_futures.shaも実行します。
+    """
+    if sha_size:
+        sha(sha_size)
+    return sha_digest(image)
+
+
+class Pipeline:
+    """
+    1回のdownload_manyの実行で共有する、キューと結果の集計です。
+    """
+
+    def __init__(self, cc_list, verbose, options=None):
+        self.verbose = verbose
+        self.options = options
+        self.metrics = options.stats.metrics if options is not None else None
+        queue_size = options.queue_size if options is not None else QUEUE_SIZE
+        self.cpu_queue = asyncio.Queue(maxsize=queue_size)
+        self.write_queue = asyncio.Queue(maxsize=queue_size)
+        self.counter = collections.Counter()
+        self.progress = (None if verbose
+                         else tqdm.tqdm(total=count_hint(cc_list, options)))
+
+    def report(self, cc, status, error_msg='', size=None, digest=None):
+        """
+        1つの国別コードの処理が（どこかの段で）終わったときに呼び出します。
+        """
+        record_result(self.options, cc, status, size, digest)
+        if self.verbose and not error_msg:
+            print(cc, STATUS_MSG[status])
+        tally(self.counter, cc, status, error_msg, self.verbose)
+        if self.progress is not None:
+            self.progress.update(1)
+
+
+async def fetch_one(session, base_url, cc, semaphore, options=None):
+    """
+    画像と、レスポンスのヘッダーを返します。404と304以外の例外はFetchErrorにラップします。
+    """
+    cache = options.cache if options is not None else None
+    policy = options.retry if options is not None else None
+    metrics = options.stats.metrics if options is not None else None
+    throttle = options.throttle if options is not None else None
+    headers = cache.request_headers(cc) if cache is not None else {}
+
+    acquire = functools.partial(
+        acquire_slot, semaphore, throttle, base_url,
+        options.stats.throttle if throttle is not None else None)
+
+    def fetch():
+        return fetch_flag(session, base_url, cc, headers, metrics)
+
+    try:
+        if policy is None:
+            with await acquire():
+                return await fetch()
+        return await retry_coro(policy, fetch, options.stats, acquire)
+    except (web.HTTPNotFound, web.HTTPNotModified):
+        raise
+    except Exception as exc:
+        raise FetchError(cc) from exc
+
+
+async def fetch_worker(pipeline, session, base_url, cc_iter, semaphore):
+    # すべてのワーカーが同じイテレータから国別コードを取り出します。
+    # コルーチンは同じスレッドで交互に動くので、ロックは必要ありません。
+    for cc in cc_iter:
+        try:
+            image, headers = await fetch_one(session, base_url, cc,
+                                             semaphore, pipeline.options)
+        except web.HTTPNotModified:
+            pipeline.report(cc, HTTPStatus.not_modified)
+        except web.HTTPNotFound:
+            pipeline.report(cc, HTTPStatus.not_found)
+        except FetchError as exc:
+            pipeline.report(cc, HTTPStatus.error, error_message(exc))
+        else:
+            # CPUの段が遅れていれば、ここで待たされます（バックプレッシャー）。
+            await pipeline.cpu_queue.put((cc, image, headers))
+
+
+async def cpu_worker(pipeline, executor, sha_size):
+    loop = asyncio.get_event_loop()
+    while True:
+        item = await pipeline.cpu_queue.get()
+        if item is None:
+            return
+        cc, image, headers = item
+        t0 = time.time()
+        digest = await loop.run_in_executor(executor, process_flag, image,
+                                            sha_size)
+        if pipeline.metrics is not None:
+            pipeline.metrics.observe('process', time.time() - t0)
+        await pipeline.write_queue.put((cc, image, headers, digest))
+
+
+async def write_worker(pipeline, writer):
+    options = pipeline.options
+    while True:
+        item = await pipeline.write_queue.get()
+        if item is None:
+            return
+        cc, image, headers, digest = item
+        # 書き込みの完了を待ってから結果を数えるので、書き込みのエラーも失われません。
+        try:
+            await writer.write(image, cc.lower() + '.gif')
+        except OSError as exc:
+            pipeline.report(cc, HTTPStatus.error, str(exc))
+            continue
+        # 索引には、ディスクに書き出せた画像だけを記録します。
+        if options is not None and options.cache is not None:
+            options.cache.update(cc, headers, len(image), digest)
+        pipeline.report(cc, HTTPStatus.ok, size=len(image), digest=digest)
+
+
+async def run_stage(workers, next_queue=None, next_count=0):
+    """
+    1つの段のワーカーがすべて終わったら、次の段のワーカーの数だけNoneを送り、終了を知らせます。
+    """
+    await asyncio.gather(*workers)
+    for _ in range(next_count):
+        await next_queue.put(None)
+
+
+async def downloader_coro(cc_list, base_url, verbose, concur_req, options=None):
+    pipeline = Pipeline(cc_list, verbose, options)
+    if options is not None:
+        cpu_workers = options.cpu_workers
+        write_workers = options.write_workers
+        sha_size = options.sha
+    else:
+        cpu_workers, write_workers, sha_size = None, WRITE_WORKERS, None
+    # ProcessPoolExecutorは、max_workersがNoneならCPUの数だけプロセスを用意します。
+    cpu_executor = futures.ProcessPoolExecutor(cpu_workers)
+    writer = make_writer(options)
+    cpu_workers = cpu_executor._max_workers
+
+    semaphore = make_limiter(concur_req, options, verbose)
+    session = make_session(concur_req, options)
+    # fetchの段は、国別コードを必要になった分だけcc_listから取り出します。
+    cc_iter = iter(cc_list)
+    fetchers = [fetch_worker(pipeline, session, base_url, cc_iter, semaphore)
+                for _ in range(concur_req)]
+    cpus = [cpu_worker(pipeline, cpu_executor, sha_size)
+            for _ in range(cpu_workers)]
+    writers = [write_worker(pipeline, writer)
+               for _ in range(write_workers)]
+    try:
+        # 3つの段を同時に動かします。どこかで予期しない例外が起きたら、ここから上がります。
+        await asyncio.gather(
+            run_stage(fetchers, pipeline.cpu_queue, len(cpus)),
+            run_stage(cpus, pipeline.write_queue, len(writers)),
+            run_stage(writers))
+    finally:
+        await session.close()
+        if pipeline.progress is not None:
+            pipeline.progress.close()
+        cpu_executor.shutdown()
+        await writer.close()
+    if options is not None:
+        options.stats.writes = writer.summary()
+    return pipeline.counter
+
+
+def download_many(cc_list, base_url, verbose, concur_req, options=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        coro = downloader_coro(cc_list, base_url, verbose, concur_req, options)
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main(download_many, DEFAULT_CONCUR_REQ, MAX_CONCUR_REQ)
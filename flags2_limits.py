@@ -0,0 +1,276 @@
+"""
+flags2のダウンローダーから利用する、並行リクエスト数とリクエストの頻度の制御
+"""
+
+import time
+import types
+import asyncio
+import threading
+import collections
+from urllib.parse import urlsplit
+
+# 応答時間がこれまでの最小値の何倍を超えたら「遅い」とみなすかを決めます。
+LATENCY_FACTOR = 2.0
+
+# エラー時に並行数を何倍にするかを決めます（乗算的減少）。
+DECREASE_FACTOR = 0.5
+
+
+class AIMD:
+    """
+    AIMD（加算的増加・乗算的減少）で並行リクエスト数の上限（limit）を決めます。
+
+    応答時間が低いうちは、TCPのスロースタートと同じように成功1回ごとに上限を1つ増やし、
+    最初のエラーのあとは成功1回ごとに1/limitずつ（往復1回あたり約1つ）増やします。
+    エラーやタイムアウトが起きたら上限をDECREASE_FACTOR倍にします。
+    同時に走っていたリクエストのエラーで何度も減らさないよう、
+    減らしたあとは応答時間の平滑値が経過するまで、次の減少を行いません。
+    """
+
+    def __init__(self, initial, maximum, minimum=1):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.slow_start = True
+        self.min_latency = None
+        self.avg_latency = None
+        self.t0 = time.time()
+        self.last_decrease = 0
+        # 上限の整数値が変わるたびに、(経過秒数, 上限)を記録します。
+        self.history = [(0.0, int(self.limit))]
+
+    def on_success(self, latency):
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        if self.avg_latency is None:
+            self.avg_latency = latency
+        else:
+            self.avg_latency += (latency - self.avg_latency) / 8
+        if latency > self.min_latency * LATENCY_FACTOR:
+            # 応答が遅くなってきたら、それ以上は増やしません。
+            self.slow_start = False
+            return
+        if self.slow_start:
+            self._set(self.limit + 1)
+        else:
+            self._set(self.limit + 1 / self.limit)
+
+    def on_failure(self):
+        now = time.time()
+        if now - self.last_decrease < (self.avg_latency or 0):
+            return
+        self.last_decrease = now
+        self.slow_start = False
+        self._set(self.limit * DECREASE_FACTOR)
+
+    def _set(self, limit):
+        old = int(self.limit)
+        self.limit = max(self.minimum, min(limit, self.maximum))
+        if int(self.limit) != old:
+            self.history.append((time.time() - self.t0, int(self.limit)))
+
+
+class ThreadLimiter:
+    """
+    スレッド用の適応型リミッターです。withブロックに入るとスロットを1つ取得し、
+    ブロックを抜けると、かかった時間と例外の有無をAIMDに伝えます。
+    benignには例外を受け取る関数を指定し、それが真を返す例外（404など）はエラーとみなしません。
+    """
+
+    def __init__(self, controller, verbose=False, benign=None):
+        self.controller = controller
+        self.verbose = verbose
+        self.benign = benign
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def __enter__(self):
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.in_flight < int(self.controller.limit))
+            self.in_flight += 1
+        self._local.t0 = time.time()
+        return self
+
+    def restart(self):
+        """
+        応答時間を計り始める時刻を今にします。スロットを取得したあとで
+        --rateのトークンを待ったときに呼び出し、待ち時間をAIMDに伝えないようにします。
+        """
+        self._local.t0 = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        latency = time.time() - self._local.t0
+        ok = exc_type is None or (self.benign is not None
+                                  and self.benign(exc_value))
+        with self._cond:
+            self.in_flight -= 1
+            release(self.controller, latency, ok, self.verbose)
+            self._cond.notify_all()
+
+
+class AsyncLimiter:
+    """
+    asyncio用の適応型リミッターです。slot = await limiter.acquire()で取得し、
+    with slot: の形で使います（with (yield from limiter): の形でも使えます）。
+    benignに指定した例外（404など）は、エラーとはみなしません。
+    コルーチンはすべて同じスレッドで動くので、ロックは必要ありません。
+    """
+
+    def __init__(self, controller, benign=(), verbose=False):
+        self.controller = controller
+        self.benign = benign
+        self.verbose = verbose
+        self.in_flight = 0
+        self._waiters = collections.deque()
+
+    @types.coroutine
+    def acquire(self):
+        # @asyncio.coroutineはPython 3.11で削除されたので、types.coroutineを付けています。
+        # yield fromで駆動するジェネレータのままですが、async defの中からawaitすることもできます。
+        while self.in_flight >= int(self.controller.limit):
+            waiter = asyncio.Future()
+            self._waiters.append(waiter)
+            yield from waiter
+        self.in_flight += 1
+        return _AsyncSlot(self, time.time())
+
+    def __iter__(self):
+        slot = yield from self.acquire()
+        return slot
+
+    def release(self, latency, ok):
+        self.in_flight -= 1
+        release(self.controller, latency, ok, self.verbose)
+        # 空いたスロットの数だけ、待機中のコルーチンを起こします。
+        free = int(self.controller.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+class _AsyncSlot:
+
+    def __init__(self, limiter, t0):
+        self.limiter = limiter
+        self.t0 = t0
+
+    def __enter__(self):
+        return self
+
+    def restart(self):
+        # ThreadLimiter.restartと同じく、トークンを待った時間を応答時間から除きます。
+        self.t0 = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        ok = exc_type is None or issubclass(exc_type, self.limiter.benign)
+        self.limiter.release(time.time() - self.t0, ok)
+
+
+class TokenBucket:
+    """
+    1秒あたりrate個のトークンが、最大burst個まで溜まるバケツです。
+    reserveはトークンを1つ予約し、それが使えるようになるまでの秒数を返します。
+    トークンが足りなければ残りは負の数になり、予約した順に1/rate秒ずつ間隔が空きます。
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def reserve(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RateLimiter:
+    """
+    ホストごとのTokenBucketで、リクエストの頻度をrate回/秒（最大burst回の連続）に抑えます。
+    並行数ではなく頻度を制限するので、-m/--max_reqを大きくして応答の待ち時間を隠しつつ、
+    サーバーの制限（503など）を超えないようにできます。
+    スレッド版はwaitを、asyncio版はyield from（またはawait）limiter.wait_async(...)を、
+    リクエストを送る直前（再試行のたびに）呼び出します。
+    countsにCounterを渡すと、待たされたリクエストの数（delayed）と秒数（waited）を数えます。
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    # ロックはpickleできないので、別のプロセスに渡すときは除き、受け取った側で作り直します。
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def split(self, parts):
+        """
+        parts個のプロセスで分け合うための、頻度をparts分の1にしたRateLimiterを返します。
+        各プロセスのバケツは独立しているので、合計がrateとburstを超えないよう等分します。
+        burstが1未満になったバケツでは、最初のリクエストから1/rate秒ずつ間隔が空きます。
+        """
+        return RateLimiter(self.rate / parts, self.burst / parts)
+
+    def reserve(self, url, counts=None):
+        """
+        urlのホストのトークンを1つ予約し、待つべき秒数を返します。
+        """
+        host = urlsplit(url).netloc or url
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(self.rate,
+                                                           self.burst)
+            delay = bucket.reserve(time.monotonic())
+            if delay and counts is not None:
+                counts['delayed'] += 1
+                counts['waited'] += delay
+        return delay
+
+    def wait(self, url, counts=None):
+        delay = self.reserve(url, counts)
+        if delay:
+            time.sleep(delay)
+
+    @types.coroutine
+    def wait_async(self, url, counts=None):
+        # AsyncLimiter.acquireと同じく、yield fromとawaitのどちらでも使えるジェネレータです。
+        # 待つのはasyncio.sleepではなく、delay秒後に結果が入るFutureです。
+        delay = self.reserve(url, counts)
+        if delay:
+            waiter = asyncio.Future()
+            asyncio.get_event_loop().call_later(delay, _wake, waiter)
+            yield from waiter
+
+
+def _wake(waiter):
+    # 待っていたコルーチンが取り消されていれば、Futureはもう完了しています。
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def release(controller, latency, ok, verbose=False):
+    """
+    1件のリクエストの結果をAIMDに伝え、verboseなら上限の変化を表示します。
+    """
+    before = int(controller.limit)
+    if ok:
+        controller.on_success(latency)
+    else:
+        controller.on_failure()
+    if verbose and int(controller.limit) != before:
+        print('*** concurrency {} -> {}'.format(before, int(controller.limit)))
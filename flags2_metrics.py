@@ -0,0 +1,181 @@
+"""
+flags2のダウンローダーが共有する、所要時間のヒストグラムとスループットの集計
+"""
+
+import json
+import math
+import time
+import threading
+
+# ヒストグラムのバケツの境界は、1マイクロ秒からGROWTH倍ずつ増えていきます。
+# 2**(1/8)倍なら、パーセンタイルの誤差は9%程度です。
+MIN_VALUE = 1e-6
+GROWTH = 2 ** (1 / 8)
+BUCKETS = 256
+
+# 計測する区間の名前です。表示もこの順に行います。
+PHASES = ('dns', 'connect', 'ttfb', 'body', 'process', 'write', 'request')
+
+
+class Histogram:
+    """
+    対数スケールのバケツに値を数えるだけのヒストグラムです。
+    値を記録するコストは一定で、メモリも記録した値の数によらず一定です。
+    """
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        if value <= MIN_VALUE:
+            index = 0
+        else:
+            index = min(BUCKETS - 1,
+                        int(math.log(value / MIN_VALUE, GROWTH)) + 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """
+        pctパーセンタイルの値を含むバケツの上限を返します（ただし最大値を超えません）。
+        """
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(pct / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.max, MIN_VALUE * GROWTH ** index)
+        return self.max
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': {'{:.6g}'.format(MIN_VALUE * GROWTH ** index): count
+                        for index, count in enumerate(self.counts) if count},
+        }
+
+
+class Metrics:
+    """
+    区間ごとの所要時間のヒストグラムと、1秒ごとに受信したバイト数を集計します。
+    スレッドプールからも記録できるよう、更新はロックで保護しています。
+    """
+
+    def __init__(self):
+        self.t0 = time.time()
+        self.histograms = {phase: Histogram() for phase in PHASES}
+        self.bytes = 0
+        # 開始からの秒数（整数）ごとの受信バイト数です。
+        self.timeline = {}
+        self._lock = threading.Lock()
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            self.histograms[phase].record(seconds)
+
+    def add_bytes(self, size):
+        second = int(time.time() - self.t0)
+        with self._lock:
+            self.bytes += size
+            self.timeline[second] = self.timeline.get(second, 0) + size
+
+    def merge(self, other):
+        """
+        別のプロセスで集計されたMetricsを加えます。
+        1秒ごとの受信バイト数は、開始時刻の差だけずらして足し合わせます。
+        """
+        offset = int(other.t0 - self.t0)
+        with self._lock:
+            for phase, hist in other.histograms.items():
+                self.histograms[phase].merge(hist)
+            self.bytes += other.bytes
+            for second, size in other.timeline.items():
+                second = max(0, second + offset)
+                self.timeline[second] = self.timeline.get(second, 0) + size
+
+    # ロックはpickleできないので、別のプロセスに渡すときは除き、受け取った側で作り直します。
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def report(self, elapsed):
+        """
+        final_reportで表示する行のリストを返します。
+        """
+        lines = []
+        header = '{:<8}{:>7}{:>9}{:>9}{:>9}{:>9}'
+        row = '{:<8}{:>7}{:>7.1f}ms{:>7.1f}ms{:>7.1f}ms{:>7.1f}ms'
+        measured = [(phase, hist) for phase, hist
+                    in sorted(self.histograms.items(),
+                              key=lambda item: PHASES.index(item[0]))
+                    if hist.count]
+        if measured:
+            lines.append(header.format('phase', 'count', 'p50', 'p90', 'p99',
+                                       'max'))
+            for phase, hist in measured:
+                lines.append(row.format(phase, hist.count,
+                                        *(hist.percentile(pct) * 1000
+                                          for pct in (50, 90, 99, 100))))
+        if self.bytes and elapsed > 0:
+            msg = 'Throughput: {:.1f} KB/s ({} bytes).'
+            lines.append(msg.format(self.bytes / elapsed / 1024, self.bytes))
+            # 1秒ごとの値は、実行が2秒以上続いたときだけ意味があります。
+            if elapsed >= 2:
+                msg = 'Throughput per second: min {:.1f} KB/s, max {:.1f} KB/s.'
+                full = [size for second, size in self.timeline.items()
+                        if second < int(elapsed)] or [0]
+                lines.append(msg.format(min(full) / 1024, max(full) / 1024))
+        return lines
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'histograms': {phase: hist.to_dict() for phase, hist
+                               in self.histograms.items() if hist.count},
+                'bytes': self.bytes,
+                'timeline': [{'second': second, 'bytes': size}
+                             for second, size
+                             in sorted(self.timeline.items())],
+            }
+
+    def dump(self, path, **extra):
+        """
+        集計結果をJSONでpathに書き出します。extraは最上位のキーとして追加されます。
+        """
+        data = self.to_dict()
+        data.update(extra)
+        with open(path, 'w') as fp:
+            json.dump(data, fp, indent=1, sort_keys=True)
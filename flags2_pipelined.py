@@ -0,0 +1,355 @@
+"""
+HTTP/1.1のパイプライン化を使った実装
+
+国旗は1つ1つが小さいので、ダウンロードの時間はほとんどが往復の待ち時間です。
+この実装は-m/--max_req本の接続を開き、それぞれの接続で応答を待たずに
+最大--pipeline-depth個のリクエストを続けて送ります。
+応答は送った順に返ってくるので、送ったリクエストの列の先頭と突き合わせます。
+
+aiohttpはパイプライン化に対応していないので、asyncio.open_connectionで開いた
+ストリームに直接リクエストを書き、レスポンスを読み取ります。
+サーバーが接続を閉じたら、応答のなかったリクエストは新しい接続で送り直します。
+画像は必ずメモリに読み込むので、--streamは使われません。
+
+同じ接続数のflags2_asyncioとの比較は、flags2_bench.pyで行えます::
+
+    $ python3 flags2_bench.py grid -s DELAY -b asyncio pipelined -l 100 -m 1 4
+    server  backend     max_req  flags     ok  errors  elapsed     req/s
+    DELAY   asyncio           1    100     23       0   50.26s       2.0
+    DELAY   asyncio           4    100     23       0   12.59s       7.9
+    DELAY   pipelined         1    100     23       0    3.52s      28.4
+    DELAY   pipelined         4    100     23       0    1.02s      97.7
+
+flags2_server.pyは、パイプライン化されたリクエストを並行して処理します。
+1つずつ処理するサーバーでは、応答の遅延が積み重なるので、この差は出ません。
+
+"""
+
+import io
+import time
+import asyncio
+import hashlib
+import collections
+import http.client
+from urllib.parse import urlsplit
+
+import tqdm
+
+from flags2_common import (main, tally, record_result, count_hint, HTTPStatus,
+                           PIPELINE_DEPTH, RETRY_STATUS)
+from flags2_writer import AsyncWriter
+
+# -m/--max_reqは、この実装では接続の数です。
+DEFAULT_CONCUR_REQ = 4
+MAX_CONCUR_REQ = 100
+
+REQUEST = 'GET {path} HTTP/1.1\r\nHost: {host}\r\n{headers}\r\n'
+
+STATUS_MSG = {
+    HTTPStatus.ok: 'OK',
+    HTTPStatus.not_found: 'not found',
+    HTTPStatus.not_modified: 'not modified',
+}
+
+
+class ResponseError(Exception):
+    """200、304、404以外のステータスコードです。"""
+
+    def __init__(self, status):
+        super().__init__('HTTP {}'.format(status))
+        self.status = status
+
+
+class Jobs:
+    """
+    すべての接続で共有する、国別コードの取り出し口と結果の集計です。
+    再試行するコードは、待ち時間のあとでretriesに戻され、どの接続からでも送り直されます。
+    activeは取り出してから結果が出るまでのコードの数で、
+    これが0になり、cc_listも尽きたら、すべての接続が終了します。
+    コルーチンはすべて同じスレッドで動くので、ロックは必要ありません。
+    """
+
+    def __init__(self, cc_list, verbose, options=None):
+        self.cc_iter = iter(cc_list)
+        self.verbose = verbose
+        self.options = options
+        self.policy = options.retry if options is not None else None
+        self.retries = collections.deque()
+        self.active = 0
+        self.exhausted = False
+        self.counter = collections.Counter()
+        self.progress = (None if verbose
+                         else tqdm.tqdm(total=count_hint(cc_list, options)))
+        self._waiter = None
+
+    def take(self):
+        """
+        次に送る(国別コード, 試行回数)を返します。今すぐ送れるものがなければNoneを返します。
+        """
+        if self.retries:
+            job = self.retries.popleft()
+        elif not self.exhausted:
+            cc = next(self.cc_iter, None)
+            if cc is None:
+                self.exhausted = True
+                return None
+            job = (cc, 0)
+        else:
+            return None
+        self.active += 1
+        return job
+
+    def put_back(self, job):
+        """
+        結果の出なかったリクエストを、試行回数を変えずに送り直します。
+        """
+        self.active -= 1
+        self.retries.append(job)
+        self._notify()
+
+    def retry(self, job, reason, error_msg):
+        """
+        再試行の回数が残っていれば、待ち時間のあとで送り直します。残っていなければエラーです。
+        """
+        cc, attempt = job
+        if self.policy is None or attempt >= self.policy.retries:
+            self.report(cc, HTTPStatus.error, error_msg)
+            return
+        self.options.stats.count_retry(reason)
+        loop = asyncio.get_event_loop()
+        loop.call_later(self.policy.delay(attempt), self.put_back,
+                        (cc, attempt + 1))
+
+    def report(self, cc, status, error_msg='', size=None, digest=None):
+        self.active -= 1
+        record_result(self.options, cc, status, size, digest)
+        if self.verbose and not error_msg:
+            print(cc, STATUS_MSG[status])
+        tally(self.counter, cc, status, error_msg, self.verbose)
+        if self.progress is not None:
+            self.progress.update(1)
+        self._notify()
+
+    def finished(self):
+        return self.exhausted and not self.retries and self.active == 0
+
+    async def wait(self):
+        """
+        ほかの接続の結果が出るか、再試行するコードが戻ってくるまで待ちます。
+        """
+        if self._waiter is None:
+            self._waiter = asyncio.Future()
+        await self._waiter
+
+    def _notify(self):
+        if self._waiter is not None:
+            self._waiter.set_result(None)
+            self._waiter = None
+
+
+async def read_response(reader):
+    """
+    レスポンスを1つ読み、(ステータスコード, ヘッダー, 本体)を返します。
+    ヘッダーはhttp.client.HTTPMessageなので、名前の大文字小文字を区別しません。
+    """
+    line = await reader.readline()
+    if not line:
+        raise ConnectionResetError('connection closed by server')
+    try:
+        status = int(line.split()[1])
+    except (IndexError, ValueError):
+        raise ConnectionError('bad status line: {!r}'.format(line))
+    raw = []
+    while True:
+        line = await reader.readline()
+        raw.append(line)
+        if line in (b'\r\n', b'\n', b''):
+            break
+    headers = http.client.parse_headers(io.BytesIO(b''.join(raw)))
+    if status == 304 or 100 <= status < 200 or status == 204:
+        body = b''
+    elif headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        body = await read_chunked(reader)
+    elif headers.get('Content-Length') is not None:
+        body = await reader.readexactly(int(headers['Content-Length']))
+    else:
+        # 長さのわからない本体は、接続が閉じられるまでです。
+        body = await reader.read()
+        headers['Connection'] = 'close'
+    return status, headers, body
+
+
+async def read_chunked(reader):
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if size == 0:
+            # 最後のチャンクのあとのトレーラーを読み飛ばします。
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            return b''.join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+
+
+def build_request(host, base_path, cc, headers):
+    path = '{}/{cc}/{cc}.gif'.format(base_path, cc=cc.lower())
+    lines = ''.join('{}: {}\r\n'.format(name, value)
+                    for name, value in headers.items())
+    return REQUEST.format(path=path, host=host,
+                          headers=lines).encode('latin-1')
+
+
+async def connection_worker(jobs, base_url, depth, writer,
+                            options=None):
+    """
+    1本の接続で、最大depth個のリクエストを応答を待たずに送り続けます。
+    接続は、送るリクエストができたときに開きます。
+    """
+    url = urlsplit(base_url)
+    host, port = url.hostname, url.port or 80
+    host_key = '{}:{}'.format(host, port)
+    base_path = url.path.rstrip('/')
+    cache = options.cache if options is not None else None
+    policy = options.retry if options is not None else None
+    stats = options.stats if options is not None else None
+    throttle = options.throttle if options is not None else None
+
+    stream = None
+    in_flight = collections.deque()
+    while True:
+        # 送ったリクエストがdepth個になるまで、続けて送ります（パイプライン化）。
+        while len(in_flight) < depth:
+            job = jobs.take()
+            if job is None:
+                break
+            if stream is None:
+                try:
+                    stream = await asyncio.wait_for(
+                        asyncio.open_connection(host, port),
+                        policy.connect_timeout if policy else None)
+                except asyncio.TimeoutError:
+                    jobs.retry(job, 'timeout', 'Timeout')
+                    continue
+                except OSError as exc:
+                    jobs.retry(job, 'connection error',
+                               str(exc) or 'Connection error')
+                    continue
+                if stats is not None:
+                    stats.count_connection(host_key, 'created')
+            elif stats is not None:
+                stats.count_connection(host_key, 'reused')
+            if throttle is not None:
+                await throttle.wait_async(base_url, stats.throttle)
+            cc = job[0]
+            headers = cache.request_headers(cc) if cache is not None else {}
+            stream[1].write(build_request(host, base_path, cc, headers))
+            in_flight.append((job, time.time()))
+
+        if not in_flight:
+            if jobs.finished():
+                break
+            await jobs.wait()
+            continue
+
+        try:
+            await stream[1].drain()
+            status, headers, body = await asyncio.wait_for(
+                read_response(stream[0]),
+                policy.read_timeout if policy else None)
+        except (asyncio.TimeoutError, OSError, asyncio.IncompleteReadError,
+                ValueError) as exc:
+            # 応答のなかったリクエストは、新しい接続で送り直します。
+            stream[1].close()
+            stream = None
+            if isinstance(exc, asyncio.TimeoutError):
+                reason, error_msg = 'timeout', 'Timeout'
+            else:
+                reason = 'connection error'
+                error_msg = str(exc) or 'Connection error'
+            while in_flight:
+                jobs.retry(in_flight.popleft()[0], reason, error_msg)
+            continue
+
+        job, t0 = in_flight.popleft()
+        if stats is not None:
+            # パイプラインの中で前の応答を待った時間も含みます。
+            stats.observe_latency(time.time() - t0)
+            stats.metrics.add_bytes(len(body))
+        await handle_response(jobs, job, status, headers, body, writer)
+
+        if headers.get('Connection', '').lower() == 'close':
+            # サーバーが接続を閉じるので、残りのリクエストへの応答は返ってきません。
+            stream[1].close()
+            stream = None
+            while in_flight:
+                jobs.put_back(in_flight.popleft()[0])
+
+    if stream is not None:
+        stream[1].close()
+
+
+async def handle_response(jobs, job, status, headers, body, writer):
+    cc = job[0]
+    if status == 304:
+        jobs.report(cc, HTTPStatus.not_modified)
+    elif status == 404:
+        jobs.report(cc, HTTPStatus.not_found)
+    elif status in RETRY_STATUS:
+        jobs.retry(job, 'HTTP {}'.format(status), str(ResponseError(status)))
+    elif status != 200:
+        jobs.report(cc, HTTPStatus.error, str(ResponseError(status)))
+    else:
+        digest = hashlib.sha256(body).hexdigest()
+        # 書き込みの完了を待たずに次の応答を読みます。結果は書き込みが終わってから数えます。
+        done = await writer.submit(body, cc.lower() + '.gif')
+        done.add_done_callback(
+            lambda done: saved(jobs, cc, headers, body, digest, done))
+
+
+def saved(jobs, cc, headers, image, digest, done):
+    if done.exception() is not None:
+        jobs.report(cc, HTTPStatus.error, str(done.exception()))
+        return
+    cache = jobs.options.cache if jobs.options is not None else None
+    if cache is not None:
+        cache.update(cc, headers, len(image), digest)
+    jobs.report(cc, HTTPStatus.ok, size=len(image), digest=digest)
+
+
+async def downloader_coro(cc_list, base_url, verbose, concur_req,
+                          options=None):
+    jobs = Jobs(cc_list, verbose, options)
+    if options is None:
+        depth = PIPELINE_DEPTH
+        writer = AsyncWriter()
+    else:
+        depth = options.pipeline_depth
+        writer = AsyncWriter(options.write_workers, options.write_buffer,
+                             options.batch_writes, options.stats.metrics,
+                             options.store)
+    workers = [connection_worker(jobs, base_url, depth, writer, options)
+               for _ in range(concur_req)]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        await writer.close()
+        if jobs.progress is not None:
+            jobs.progress.close()
+    if options is not None:
+        options.stats.writes = writer.summary()
+    return jobs.counter
+
+
+def download_many(cc_list, base_url, verbose, concur_req, options=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        coro = downloader_coro(cc_list, base_url, verbose, concur_req, options)
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main(download_many, DEFAULT_CONCUR_REQ, MAX_CONCUR_REQ)
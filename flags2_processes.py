@@ -0,0 +1,134 @@
+"""
+プロセスプールを使った実装
+
+各ワーカープロセスがflags2_sequentialのdownload_oneを実行します。
+ダウンロードはI/Oバウンドなのでスレッドより有利になることはほとんどありませんが、
+同じ約束（flags2_common.load_backend）に従うダウンローダーとして比較に使えます。
+
+Sample run::
+
+    $ python3 flags2_processes.py -s DELAY a e i o u
+    DELAY site: http://localhost:8002/flags
+    Searching for 130 flags: from AA to UZ
+    4 concurrent connections will be used.
+    --------------------
+    50 flags downloaded.
+    80 not found.
+    Elapsed time: 17.02s
+
+"""
+
+import copy
+import collections
+from concurrent import futures
+
+import tqdm
+
+from flags2_common import (main, tally, HTTPStatus, NegativeCache, RunStats,
+                           count_hint, window_size, submit_windowed)
+from flags2_sequential import download_one, error_message
+
+# プロセスはスレッドよりずっと重いので、デフォルトは小さくしておきます。
+DEFAULT_CONCUR_REQ = 4
+
+# WindowsのProcessPoolExecutorは、61より多いワーカーを作れません。
+MAX_CONCUR_REQ = 61
+
+# アーカイブへの書き込み位置は1つのプロセスの中でしか管理できないので、
+# flags2_common.process_argsは--archiveを使い方のエラーにします。
+SUPPORTS_ARCHIVE = False
+
+# ワーカープロセスごとに、initializerで受け取ったoptionsを保持します。
+_options = None
+
+
+def init_worker(options):
+    global _options
+    _options = options
+
+
+def download_one_isolated(cc, base_url, verbose):
+    """
+    ワーカープロセスでdownload_oneを実行し、
+    (status, error_msg, 索引の記録のdict, RunStats)を返します。
+    requestsの例外はpickleできるとは限らないので、エラーはメッセージにしてから返します。
+    404の記録と統計は、親プロセスでまとめます。
+    実行の記録（Journal）には、ワーカーが直接追記します。
+    """
+    options = _options
+    if options is not None:
+        options = copy.copy(options)
+        options.stats = RunStats()
+        options.negatives = NegativeCache(None)
+        if options.store is not None:
+            # 重複の数はタスクごとに数え直し、RunStatsに入れて返します。
+            options.store = copy.copy(options.store)
+            options.store.counts = options.stats.dedupe
+    try:
+        res = download_one(cc, base_url, verbose, options)
+    except Exception as exc:
+        error_msg = error_message(exc)
+        if error_msg is None:
+            raise
+        status = HTTPStatus.error
+    else:
+        error_msg = ''
+        status = res.status
+    if options is None:
+        return status, error_msg, None, None
+    entries = {}
+    if options.cache is not None:
+        entries['cache'] = options.cache.entries.get(cc)
+    if options.store is not None:
+        entries['manifest'] = options.store.manifest.entries.get(
+            cc.lower() + '.gif')
+    return status, error_msg, entries, options.stats
+
+
+def download_many(cc_list, base_url, verbose, concur_req, options=None):
+    counter = collections.Counter()
+
+    # process_argsで検査済みですが、flags2_benchなどから直接呼ばれたときのために確かめます。
+    if options is not None and options.archive is not None:
+        raise ValueError('--archive is not available with the processes '
+                         'backend')
+
+    # 実行中に共有するオブジェクトのうち、404の記録と統計は親プロセスに残し、
+    # 索引（cache）、保存先（store）、再試行の方針などをワーカーに渡します。
+    worker_options = None
+    if options is not None:
+        worker_options = copy.copy(options)
+        worker_options.stats = None
+        worker_options.negatives = None
+        if options.throttle is not None:
+            # トークンバケツはプロセスごとにできるので、--rateをワーカーの数で分け合います。
+            worker_options.throttle = options.throttle.split(concur_req)
+
+    with futures.ProcessPoolExecutor(max_workers=concur_req,
+                                     initializer=init_worker,
+                                     initargs=(worker_options,)) as executor:
+        # flags2_threadpoolと同じく、国別コードは必要になった分だけ投入します。
+        window = window_size(concur_req, options)
+        done_iter = submit_windowed(executor, download_one_isolated, cc_list,
+                                    window, base_url, verbose)
+        if not verbose:
+            done_iter = tqdm.tqdm(done_iter,
+                                  total=count_hint(cc_list, options))
+
+        for future, cc in done_iter:
+            status, error_msg, entries, stats = future.result()
+            if options is not None:
+                if entries.get('cache') is not None:
+                    options.cache.put(cc, entries['cache'])
+                if entries.get('manifest') is not None:
+                    options.store.manifest.put(cc.lower() + '.gif',
+                                               entries['manifest'])
+                options.negatives.record(cc, status)
+                options.stats.merge(stats)
+            tally(counter, cc, status, error_msg, verbose)
+
+    return counter
+
+
+if __name__ == '__main__':
+    main(download_many, DEFAULT_CONCUR_REQ, MAX_CONCUR_REQ)
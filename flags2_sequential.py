@@ -14,34 +14,219 @@ Sample run::
 
 """
 
+import time
+import hashlib
+import functools
+import itertools
+import contextlib
 import collections
+import threading
 
 import requests
+from requests.adapters import HTTPAdapter
 import tqdm
 
-from flags2_common import main, save_flag, HTTPStatus, Result
+from flags2_common import (main, save_flag, save_flag_chunks, retry_call,
+                          tally, HTTPStatus, Result, NotModified, CHUNK_SIZE,
+                          RETRY_STATUS, record_result, count_hint,
+                          BATCH_PATH, BATCH_TYPE, iter_batch_frames)
 
 DEFAULT_CONCUR_REQ = 1
 MAX_CONCUR_REQ = 1
 
+# requests.Sessionはスレッドセーフであることが保証されていないので、
+# スレッドごとに1つずつ保持します。
+_local = threading.local()
+
+
+def get_session(pool_size):
+    """
+    呼び出し元のスレッド専用のrequests.Sessionを返します。
+    Sessionは接続をキープアライブで保持するので、同じサーバーへの2回目以降のリクエストでは
+    TCPのハンドシェイクが省略されます。プールの大きさはpool_sizeで指定します。
+    """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+    return session
+
+
+def retry_reason(exc):
+    """
+    再試行すべき例外なら、再試行の理由を表す文字列を返します。そうでなければNoneを返します。
+    """
+    # ConnectTimeoutはConnectionErrorのサブクラスでもあるので、先に調べます。
+    if isinstance(exc, requests.exceptions.Timeout):
+        return 'timeout'
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        return 'connection error'
+    if (isinstance(exc, requests.exceptions.HTTPError)
+            and exc.response.status_code in RETRY_STATUS):
+        return 'HTTP {}'.format(exc.response.status_code)
+    return None
+
+
+def error_message(exc):
+    """
+    download_oneから上がってきた例外のうち、エラーとして数えるもののメッセージを返します。
+    flags2_threadpoolとflags2_processesも、この関数を使います。
+    """
+    # 404以外のHTTPエラーです。
+    if isinstance(exc, requests.exceptions.HTTPError):
+        return 'HTTP error {res.status_code} - {res.reason}'.format(
+            res=exc.response)
+    # 再試行しても応答がなかったときです。
+    # ConnectTimeoutはConnectionErrorのサブクラスでもあるので、先に調べます。
+    if isinstance(exc, requests.exceptions.Timeout):
+        return 'Timeout'
+    # それ以外のネットワーク関連の例外です。
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        return 'Connection error'
+    return None
+
+
+def is_benign(exc):
+    """
+    --adaptiveのAIMDにエラーとして伝えない例外なら、真を返します。
+    304と404は、サーバーの過負荷を表すものではないからです。
+    """
+    if isinstance(exc, NotModified):
+        return True
+    return (isinstance(exc, requests.exceptions.HTTPError)
+            and exc.response.status_code == 404)
+
+
+@contextlib.contextmanager
+def request_slot(throttle=None, url=None, counts=None, limiter=None):
+    """
+    retry_callのslotに渡し、1回の試行の前に--adaptiveのスロット（limiter）を取得して、
+    --rateのトークンが空くまで待ちます。
+    retry_callは取得したあとで時間を計り始めるので、待ち時間は応答時間に含まれません。
+    スロットは試行ごとに解放されるので、再試行までの待ち時間には他のダウンロードが使えます。
+    試行の結果（例外）は、そのたびにlimiterに伝わります。
+    """
+    with (limiter if limiter is not None else contextlib.suppress()):
+        if throttle is not None:
+            throttle.wait(url, counts)
+            if limiter is not None:
+                limiter.restart()
+        yield
+
+
 # BEGIN FLAGS2_BASIC_HTTP_FUNCTIONS
-def get_flag(base_url, cc):
+def get_flag(base_url, cc, session=None, cache=None, timeout=None,
+             metrics=None):
     url = '{}/{cc}/{cc}.gif'.format(base_url, cc=cc.lower())
-    resp = requests.get(url)
+
+    # sessionが指定されなければ、リクエストごとに新しい接続を開きます。
+    http = requests if session is None else session
+
+    # 索引（cache）に記録があれば、条件付きGETにします。
+    headers = cache.request_headers(cc) if cache is not None else {}
+    t0 = time.time()
+    resp = http.get(url, headers=headers, timeout=timeout)
+    if metrics is not None:
+        # resp.elapsedはリクエストの送信からヘッダーの受信までの時間です。
+        # requestsでは接続の確立を分けて計測できないので、ttfbに含まれます。
+        ttfb = resp.elapsed.total_seconds()
+        metrics.observe('ttfb', ttfb)
+        metrics.observe('body', max(0, time.time() - t0 - ttfb))
+        metrics.add_bytes(len(resp.content))
+
+    # 304なら手元の画像が最新なので、本体はありません。
+    if resp.status_code == 304:
+        raise NotModified(cc)
 
     # 関数get_flagにはエラー処理がありません。HTTPの200以外のステータスコードに対しては、
     # requests.Response.raise_for_statusを使って例外を上げます。
     if resp.status_code != 200:
         resp.raise_for_status()
+    if cache is not None:
+        digest = hashlib.sha256(resp.content).hexdigest()
+        cache.update(cc, resp.headers, len(resp.content), digest)
     return resp.content
 
 
-def download_one(cc, base_url, verbose=False):
+def get_flag_stream(base_url, cc, filename, session=None, cache=None,
+                    timeout=None, metrics=None, store=None):
+    """
+    get_flagと同じリクエストを送りますが、レスポンスの本体をメモリに溜めずに、
+    CHUNK_SIZEバイトずつfilenameへ書き出します。
+    受信と書き込みが交互に行われるので、bodyの時間には書き込みの時間も含まれます。
+    書き出したバイト数とSHA-256の値を返します。
+    """
+    url = '{}/{cc}/{cc}.gif'.format(base_url, cc=cc.lower())
+    http = requests if session is None else session
+    headers = cache.request_headers(cc) if cache is not None else {}
+
+    # stream=Trueを指定すると、本体はiter_contentで読み出すまでダウンロードされません。
+    # withブロックを抜けると、接続はプールに返されます。
+    with http.get(url, headers=headers, stream=True, timeout=timeout) as resp:
+        if resp.status_code == 304:
+            raise NotModified(cc)
+        if resp.status_code != 200:
+            resp.raise_for_status()
+        t0 = time.time()
+        size, digest = save_flag_chunks(resp.iter_content(CHUNK_SIZE),
+                                        filename, store)
+        if metrics is not None:
+            metrics.observe('ttfb', resp.elapsed.total_seconds())
+            metrics.observe('body', time.time() - t0)
+            metrics.add_bytes(size)
+        if cache is not None:
+            cache.update(cc, resp.headers, size, digest)
+    return size, digest
+
+
+def download_one(cc, base_url, verbose=False, options=None, limiter=None):
+    # コマンドラインで--no-poolが指定されていなければ、
+    # -m/--max_reqの大きさの接続プールを持ったSessionを使います。
+    if options is not None and options.pool:
+        session = get_session(options.max_req)
+    else:
+        session = None
+    filename = cc.lower() + '.gif'
+    stream = options is not None and options.stream
+    cache = options.cache if options is not None else None
+    policy = options.retry if options is not None else None
+    timeout = policy.timeout if policy is not None else None
+    metrics = options.stats.metrics if options is not None else None
+    store = options.store if options is not None else None
+    throttle = options.throttle if options is not None else None
+
+    # --rateが指定されたら、試行のたびにホストのトークンが空くまで待ってから送ります。
+    # flags2_threadpoolの--adaptiveでは、試行のたびにlimiterのスロットも取得します。
+    slot = functools.partial(request_slot, throttle, base_url,
+                             options.stats.throttle if throttle else None,
+                             limiter)
+
+    def fetch():
+        if stream:
+            # --streamが指定されたら、画像はダウンロードしながらディスクに書き出されます。
+            return get_flag_stream(base_url, cc, filename, session, cache,
+                                   timeout, metrics, store)
+        return get_flag(base_url, cc, session, cache, timeout, metrics)
+
+    size = digest = None
     try:
-        image = get_flag(base_url, cc)
+        if policy is None:
+            with slot():
+                image = fetch()
+        else:
+            # タイムアウトや503などの一時的な障害は、間隔を空けて再試行します。
+            image = retry_call(policy, fetch, retry_reason, options.stats,
+                               slot)
+    # 手元の画像が最新なら、保存は不要です。
+    except NotModified:
+        status = HTTPStatus.not_modified
+        msg = 'not modified'
     # download_oneはrequests.exceptions.HTTPErrorをキャッチし、
     # HTTPステータスコード404を処理します。
-    except requests.exeptions.HTTPError as exc:
+    except requests.exceptions.HTTPError as exc:
         res = exc.response
         if res.status_code == 404:
             # ステータスコードが404なら、
@@ -54,71 +239,259 @@ def download_one(cc, base_url, verbose=False):
             # 呼び出し元へと伝播されます。
             raise
     else:
-        save_flag(iamge, cc.lower() + '.gif')
+        if stream:
+            size, digest = image
+        else:
+            save_flag(image, filename, metrics, store)
+            size, digest = len(image), hashlib.sha256(image).hexdigest()
         status = HTTPStatus.ok
         msg = 'OK'
 
     # コマンドラインの-v/--verboseはverbose（詳細表示）オプションで、デフォルトではオフです。
     # これが指定されたら、進行状況を確認できるように国別コードとステータスメッセージを表示します。
+    # 404の結果と、終わったことを記録し、次回の実行では問い合わせないようにします。
+    record_result(options, cc, status, size, digest)
+
     if verbose:
         print(cc, msg)
 
     # downlaod_oneはnamedtupleのResultを返します。Resultにはstatusフィールドがあり、
-    # HTTPStatus.not_foundかHTTPStatus.okのどちらかの値が収容されています。
+    # HTTPStatus.not_found、HTTPStatus.not_modified、HTTPStatus.okのいずれかの値が収容されています。
     return Result(status, cc)
 # END FLAGS2_BASIC_HTTP_FUNCTIONS
 
+
+class BatchUnsupported(Exception):
+    """
+    サーバーにバッチのエンドポイント（flags2_common.BATCH_PATH）がないことを表します。
+    """
+
+
+class BatchMalformed(Exception):
+    """
+    バッチの本体が、flags2_common.iter_batch_framesで読めない形をしていたことを表します。
+    """
+
+
+# バッチに対応していないとわかったサーバーのbase_urlです。以後は問い合わせません。
+_no_batch = set()
+
+
+def get_flags_batch(base_url, cc_list, session=None, cache=None,
+                    timeout=None, metrics=None):
+    """
+    get_flagのバッチ版です。cc_listの国旗を1回のリクエストで受け取り、
+    (国別コード, ステータスコード, 画像, ヘッダーのdict)のリストを返します。
+    索引に記録のある国旗は、ETagを添えて送り、変更がなければ304で返されます。
+    サーバーがバッチに対応していなければ、BatchUnsupportedを上げます。
+    本体のフレームが壊れていれば、BatchMalformedを上げます。
+    """
+    url = '{}/{}'.format(base_url, BATCH_PATH)
+    http = requests if session is None else session
+    params = {'cc': ','.join(cc.lower() for cc in cc_list)}
+    if cache is not None:
+        etags = [cache.request_headers(cc).get('If-None-Match', '')
+                 for cc in cc_list]
+        if any(etags):
+            params['etag'] = ','.join(etags)
+    t0 = time.time()
+    resp = http.get(url, params=params, timeout=timeout)
+    if resp.status_code in (400, 404, 405, 501):
+        raise BatchUnsupported(base_url)
+    if resp.status_code != 200:
+        resp.raise_for_status()
+    if resp.headers.get('Content-Type') != BATCH_TYPE:
+        raise BatchUnsupported(base_url)
+    if metrics is not None:
+        ttfb = resp.elapsed.total_seconds()
+        metrics.observe('ttfb', ttfb)
+        metrics.observe('body', max(0, time.time() - t0 - ttfb))
+        metrics.add_bytes(len(resp.content))
+    results = []
+    try:
+        for cc, status, image, etag in iter_batch_frames(resp.content):
+            headers = {'ETag': etag,
+                       'Last-Modified': resp.headers.get('Last-Modified')}
+            results.append((cc, status, image, headers))
+    except ValueError as exc:
+        raise BatchMalformed(str(exc)) from exc
+    return results
+
+
+def download_batch(cc_list, base_url, verbose=False, options=None):
+    """
+    cc_listの国旗をget_flags_batchでまとめてダウンロードし、
+    国別コードごとの(国別コード, HTTPStatus, エラーメッセージ)のリストを返します。
+    サーバーがバッチに対応していなければ、1つずつdownload_oneでダウンロードします。
+    """
+    if base_url in _no_batch:
+        return [download_each(cc, base_url, verbose, options)
+                for cc in cc_list]
+    if options is not None and options.pool:
+        session = get_session(options.max_req)
+    else:
+        session = None
+    cache = options.cache if options is not None else None
+    policy = options.retry if options is not None else None
+    timeout = policy.timeout if policy is not None else None
+    metrics = options.stats.metrics if options is not None else None
+    store = options.store if options is not None else None
+    throttle = options.throttle if options is not None else None
+
+    slot = functools.partial(request_slot, throttle, base_url,
+                             options.stats.throttle if throttle else None)
+
+    def fetch():
+        return get_flags_batch(base_url, cc_list, session, cache, timeout,
+                               metrics)
+
+    try:
+        if policy is None:
+            frames = fetch()
+        else:
+            frames = retry_call(policy, fetch, retry_reason, options.stats,
+                                slot)
+    except BatchUnsupported:
+        _no_batch.add(base_url)
+        return [download_each(cc, base_url, verbose, options)
+                for cc in cc_list]
+    except BatchMalformed as exc:
+        # 本体が壊れていたら、どの国旗が正しく届いたかわからないので、
+        # 1つも保存せずに、すべての国別コードをエラーとして数えます。
+        error_msg = 'Malformed batch: {}'.format(exc)
+        return [(cc, HTTPStatus.error, error_msg) for cc in cc_list]
+    except Exception as exc:
+        # バッチ全体が失敗したら、すべての国別コードをエラーとして数えます。
+        error_msg = error_message(exc)
+        if error_msg is None:
+            raise
+        return [(cc, HTTPStatus.error, error_msg) for cc in cc_list]
+
+    results = []
+    # 頼んでいないコードのフレームは無視し、返ってこなかったコードはエラーとして数えます。
+    # どの国別コードも、ちょうど1回だけ数えるためです。
+    missing = set(cc_list)
+    for cc, status, image, headers in frames:
+        if cc not in missing:
+            continue
+        missing.discard(cc)
+        size = digest = None
+        error_msg = ''
+        if status == 200:
+            try:
+                save_flag(image, cc.lower() + '.gif', metrics, store)
+            except OSError as exc:
+                results.append((cc, HTTPStatus.error, str(exc)))
+                continue
+            size, digest = len(image), hashlib.sha256(image).hexdigest()
+            if cache is not None:
+                cache.update(cc, headers, size, digest)
+            status, msg = HTTPStatus.ok, 'OK'
+        elif status == 304:
+            status, msg = HTTPStatus.not_modified, 'not modified'
+        elif status == 404:
+            status, msg = HTTPStatus.not_found, 'not found'
+        else:
+            error_msg = 'HTTP {}'.format(status)
+            status, msg = HTTPStatus.error, ''
+        record_result(options, cc, status, size, digest)
+        if verbose and msg:
+            print(cc, msg)
+        results.append((cc, status, error_msg))
+    results.extend((cc, HTTPStatus.error, 'Missing from batch')
+                   for cc in cc_list if cc in missing)
+    return results
+
+
+def download_each(cc, base_url, verbose=False, options=None):
+    """
+    バッチに対応していないサーバーのために、1つの国旗をdownload_oneでダウンロードし、
+    download_batchと同じ(国別コード, HTTPStatus, エラーメッセージ)を返します。
+    """
+    try:
+        res = download_one(cc, base_url, verbose, options)
+    except Exception as exc:
+        error_msg = error_message(exc)
+        if error_msg is None:
+            raise
+        return cc, HTTPStatus.error, error_msg
+    return cc, res.status, ''
+
+
+def iter_batches(cc_list, size):
+    """
+    cc_listを、size個ずつのリストに区切って生成します。
+    """
+    cc_iter = iter(cc_list)
+    while True:
+        batch = list(itertools.islice(cc_iter, size))
+        if not batch:
+            return
+        yield batch
+
+
+def tally_batch(counter, results, verbose=False, progress=None):
+    for cc, status, error_msg in results:
+        tally(counter, cc, status, error_msg, verbose)
+    if progress is not None:
+        progress.update(len(results))
+
 # BEGIN FLAGS2_DOWNLOAD_MANY_SEQEUNTIAL
-def download_many(cc_list, base_url, verbose, max_req):
+def download_many(cc_list, base_url, verbose, max_req, options=None):
 
     # Counterを使って、ダウンロード結果を
     # HTTPStatus.ok、HTTPStatus.not_found、HTTPStatus.error別に集計します。
     counter = collections.Counter()
 
-    # cc_iterには、引数として受け取った国別コードのリストをアルファベット順で収容します。
-    cc_iter = sorted(cc_list)
+    if options is not None and options.batch:
+        # --batchなら、国別コードをoptions.batch個ずつまとめてダウンロードします。
+        progress = (None if verbose
+                    else tqdm.tqdm(total=count_hint(cc_list, options)))
+        for batch in iter_batches(cc_list, options.batch):
+            tally_batch(counter, download_batch(batch, base_url, verbose,
+                                                options), verbose, progress)
+        if progress is not None:
+            progress.close()
+        return counter
+
+    # cc_iterは、引数として受け取った国別コードのイテラブルです。
+    # expand_cc_argsやiter_cc_argsはアルファベット順にコードを返すので、並べ替えはしません。
+    # ジェネレータを渡せば、コードはダウンロードのたびに1つずつ取り出されます。
+    cc_iter = cc_list
 
     if not verbose:
         # verboseモードで実行されていなければ、cc_iterを関数tqdmに渡します。
         # この関数はcc_iterの要素を生成するイテレータを返し、
         # 進行状況を示すプログレスバーを表示します。
-        cc_iter = tqdm.tqdm(cc_iter)
+        cc_iter = tqdm.tqdm(cc_iter, total=count_hint(cc_list, options))
 
     # このforループはcc_iterに対する反復処理です。
     for cc in cc_iter:
         try:
             # ループでは、download_oneを繰り返し呼び出すことでダウンロードを行います。
-            res = download_one(cc, base_url, verbose)
+            res = download_one(cc, base_url, verbose, options)
 
-        # get_flagが上げてきたHTTP関連の例外の中でも、
+        # get_flagが上げてきたネットワーク関連の例外の中でも、
         # download_oneでは処理されなかったものがここで処理されます。
-        except requests.exceptions.HTTPError as exc:
-            error_msg = 'HTTP error {res.status_code} - {res.reason}'
-            error_msg = error_msg.format(res=exc.response)
-
-        # それ以外のネットワーク関連の例外はここで処理されます。
+        # エラーとして数えない例外（error_messageがNoneを返すもの）は再度上げられます。
         # download_manyを呼び出す関数flags2_common.mainにはtry/exceptがないので、
-        # それ以外の例外が発生するとスクリプトは終了します。
-        except requests.exceptions.ConnectionError as exc:
-            error_msg = 'Connection error'
+        # その場合はスクリプトが終了します。
+        except Exception as exc:
+            error_msg = error_message(exc)
+            if error_msg is None:
+                raise
+            status = HTTPStatus.error
 
         else:
             # download_oneから例外が上がってこなければ、
-            # download_oneが返すHTTPStatus（namedtuple）からstatusを取り出します。
+            # download_oneが返すResult（namedtuple）からstatusを取り出します。
             error_msg = ''
             status = res.status
 
-        if error_msg:
-            # エラーが発生したら、ローカルなstatusを適切に設定します。
-            status = HTTPStatus.error
-
         # HTTPStatus（Enum）の値をキーに用いて、カウンタ値を1つ増やします。
-        counter[status] += 1
-
         # verboseモードで実行されているならば、
-        # その時点の国別コードのエラーメッセージ（あれば）を表示します。
-        if verbose and error_msg:
-            print('*** Error for {}: {}'.format(cc, error_msg))
+        # その時点の国別コードのエラーメッセージ（あれば）も表示されます。
+        tally(counter, cc, status, error_msg, verbose)
 
     # 最後に関数mainが処理した数を表示できるようにcounterを返します。
     return counter    
@@ -0,0 +1,382 @@
+"""
+flags2_common.SERVERSのLOCAL、DELAY、ERRORの代わりになる、asyncioによるテスト用サーバー
+
+国旗の代わりに、国別コードごとに決まった内容の合成GIFを返します。
+応答の遅延（--delay）、エラーの割合（--error-rate）、
+接続ごとの帯域（--bandwidth）を指定して、各ダウンローダーの振る舞いを再現性よく比較できます。
+
+Sample run::
+
+    $ python3 flags2_server.py --preset all
+    LOCAL serving 194 flags at http://localhost:8001/flags
+    DELAY serving 194 flags at http://localhost:8002/flags (delay const:0.5)
+    ERROR serving 194 flags at http://localhost:8003/flags (delay const:0.5, 25% errors)
+
+"""
+
+import os
+import sys
+import time
+import random
+import string
+import asyncio
+import hashlib
+import argparse
+import email.utils
+import urllib.parse
+
+from flags2_common import (SERVERS, COUNTRY_CODES_FILE, BATCH_PATH, BATCH_TYPE,
+                           pack_batch_frame)
+
+# 実在する国別コードとほぼ同じ数です。--every（676コード）の約7割が404になります。
+DEFAULT_CODE_COUNT = 194
+
+# 合成GIFの大きさの範囲（バイト）です。国別コードごとに、この範囲で決まった大きさになります。
+MIN_SIZE = 1024
+MAX_SIZE = 8 * 1024
+
+# 帯域を制限するときに、1回で書き出すバイト数です。
+WRITE_CHUNK = 1024
+
+PRESETS = {
+    'LOCAL': dict(port=8001, delay='const:0', error_rate=0),
+    'DELAY': dict(port=8002, delay='const:0.5', error_rate=0),
+    'ERROR': dict(port=8003, delay='const:0.5', error_rate=0.25),
+}
+
+REASONS = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    503: 'Service Temporarily Unavailable',
+}
+
+
+def parse_delay(spec):
+    """
+    遅延の分布を表す文字列から、秒数を返す関数を作成します。
+    const:X、uniform:A,B、exp:MEAN、normal:MU,SIGMA、lognormal:MU,SIGMAが使えます。
+    """
+    name, _, params = spec.partition(':')
+    try:
+        values = [float(value) for value in params.split(',') if value]
+    except ValueError:
+        raise ValueError('bad delay parameters: {!r}'.format(spec))
+    arity = {'const': 1, 'uniform': 2, 'exp': 1, 'normal': 2, 'lognormal': 2}
+    if name not in arity or len(values) != arity[name]:
+        raise ValueError('bad delay spec: {!r}'.format(spec))
+    if name == 'const':
+        return lambda: values[0]
+    if name == 'uniform':
+        return lambda: random.uniform(*values)
+    if name == 'exp':
+        return lambda: random.expovariate(1 / values[0]) if values[0] else 0
+    if name == 'normal':
+        return lambda: max(0, random.normalvariate(*values))
+    return lambda: random.lognormvariate(*values)
+
+
+def default_codes():
+    """
+    COUNTRY_CODES_FILEがあればそのコードを、なければ乱数の種を固定して
+    AA..ZZからDEFAULT_CODE_COUNT個を選んだコードを返します。
+    """
+    if os.path.exists(COUNTRY_CODES_FILE):
+        with open(COUNTRY_CODES_FILE) as fp:
+            return set(fp.read().split())
+    A_Z = string.ascii_uppercase
+    every = [a+b for a in A_Z for b in A_Z]
+    return set(random.Random(DEFAULT_CODE_COUNT).sample(every,
+                                                        DEFAULT_CODE_COUNT))
+
+
+def make_gif(cc, size=None):
+    """
+    国別コードごとに決まった内容の合成GIF（1x1ピクセル）を作成します。
+    sizeを省略すると、MIN_SIZEからMAX_SIZEの間で国別コードごとに決まった大きさになります。
+    """
+    rnd = random.Random(cc)
+    if size is None:
+        size = rnd.randint(MIN_SIZE, MAX_SIZE)
+    header = (b'GIF89a\x01\x00\x01\x00\x80\x00\x00' +
+              bytes(rnd.getrandbits(8) for _ in range(6)) +
+              b',\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00')
+    # 残りはコメント拡張ブロックで埋め、最後にトレーラー（;）を置きます。
+    padding = max(0, size - len(header) - 1)
+    blocks = bytearray()
+    while padding > 0:
+        length = min(255, max(1, padding - 4))
+        block = b'!\xfe' + bytes([length]) + bytes(
+            rnd.getrandbits(8) for _ in range(length)) + b'\x00'
+        blocks += block
+        padding -= len(block)
+    return header + bytes(blocks) + b';'
+
+
+class FlagServer:
+    """
+    /flags/{cc}/{cc}.gifというパスで合成GIFを返すHTTP/1.1サーバーです。
+    /flags/batch?cc=br,cn,...には、複数の国旗をflags2_common.pack_batch_frameの
+    フレームに詰めて1つのレスポンスで返します（遅延は1回分です）。
+    キープアライブとパイプライン化に対応しています。1つの接続で続けて受け取ったリクエストは
+    並行して処理し（遅延も並行して待ちます）、応答は受け取った順に送ります。
+    """
+
+    def __init__(self, codes, delay='const:0', error_rate=0, bandwidth=0,
+                 size=None, label='LOCAL'):
+        self.label = label
+        self.delay_spec = delay
+        self.delay = parse_delay(delay)
+        self.error_rate = error_rate
+        self.bandwidth = bandwidth
+        self.images = {cc.lower(): make_gif(cc, size) for cc in codes}
+        self.etags = {cc: '"{}"'.format(hashlib.sha1(image).hexdigest()[:16])
+                      for cc, image in self.images.items()}
+        self.last_modified = email.utils.formatdate(time.time(), usegmt=True)
+        self.requests = 0
+
+    def describe(self, port):
+        notes = []
+        if self.delay_spec != 'const:0':
+            notes.append('delay ' + self.delay_spec)
+        if self.error_rate:
+            notes.append('{:.0%} errors'.format(self.error_rate))
+        if self.bandwidth:
+            notes.append('{} bytes/s'.format(self.bandwidth))
+        msg = '{} serving {} flags at http://localhost:{}/flags'.format(
+            self.label, len(self.images), port)
+        return msg + (' ({})'.format(', '.join(notes)) if notes else '')
+
+    async def handle_connection(self, reader, writer):
+        # 応答を準備するタスクを受け取った順に並べ、send_responsesが順に送ります。
+        responses = asyncio.Queue()
+        sender = asyncio.ensure_future(self.send_responses(writer, responses))
+        try:
+            while not sender.done():
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, version, headers = request
+                keep_alive = (version == 'HTTP/1.1' and
+                              headers.get('connection', '').lower() != 'close')
+                task = asyncio.ensure_future(self.respond(method, path,
+                                                          headers))
+                responses.put_nowait((task, keep_alive))
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            responses.put_nowait(None)
+            try:
+                await sender
+            except ConnectionError:
+                pass
+            writer.close()
+
+    async def send_responses(self, writer, responses):
+        while True:
+            item = await responses.get()
+            if item is None:
+                return
+            task, keep_alive = item
+            status, extra, body = await task
+            await self.send(writer, status, extra, body, keep_alive)
+            if not keep_alive:
+                return
+
+    async def respond(self, method, path, headers):
+        """
+        遅延のあとで、リクエストに対する(ステータス, 追加のヘッダー, 本体)を返します。
+        """
+        self.requests += 1
+        delay = self.delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self.route(method, path, headers)
+
+    def route(self, method, path, headers):
+        """
+        リクエストに対する(ステータス, 追加のヘッダー, 本体)を返します。
+        """
+        if method not in ('GET', 'HEAD'):
+            return 400, {}, b''
+        if self.error_rate and random.random() < self.error_rate:
+            return 503, {}, b''
+        path, _, query = path.partition('?')
+        parts = path.strip('/').split('/')
+        if parts == ['flags', BATCH_PATH]:
+            return self.route_batch(urllib.parse.parse_qs(query))
+        if len(parts) != 3 or parts[0] != 'flags':
+            return 404, {}, b''
+        cc, filename = parts[1], parts[2]
+        image = self.images.get(cc)
+        if image is None or filename != cc + '.gif':
+            return 404, {}, b''
+        etag = self.etags[cc]
+        extra = {'Content-Type': 'image/gif', 'ETag': etag,
+                 'Last-Modified': self.last_modified}
+        if headers.get('if-none-match') == etag or (
+                'if-none-match' not in headers and
+                headers.get('if-modified-since') == self.last_modified):
+            return 304, extra, b''
+        return 200, extra, image if method == 'GET' else b''
+
+    def route_batch(self, query):
+        """
+        ccパラメータ（カンマ区切り）の国旗をまとめて返します。
+        etagパラメータに同じ順でETagを並べると、一致した国旗は304のフレームになります。
+        """
+        codes = [cc for cc in ','.join(query.get('cc', [])).lower().split(',')
+                 if cc]
+        if not codes:
+            return 400, {}, b''
+        etags = ','.join(query.get('etag', [])).split(',')
+        etags += [''] * (len(codes) - len(etags))
+        frames = []
+        for cc, etag in zip(codes, etags):
+            image = self.images.get(cc)
+            if image is None:
+                frames.append(pack_batch_frame(cc, 404))
+            elif etag == self.etags[cc]:
+                frames.append(pack_batch_frame(cc, 304, etag=etag))
+            else:
+                frames.append(pack_batch_frame(cc, 200, image,
+                                               self.etags[cc]))
+        extra = {'Content-Type': BATCH_TYPE,
+                 'Last-Modified': self.last_modified}
+        return 200, extra, b''.join(frames)
+
+    async def send(self, writer, status, extra, body, keep_alive):
+        lines = ['HTTP/1.1 {} {}'.format(status, REASONS[status]),
+                 'Content-Length: {}'.format(len(body)),
+                 'Connection: {}'.format('keep-alive' if keep_alive
+                                         else 'close')]
+        lines.extend('{}: {}'.format(name, value)
+                     for name, value in extra.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if not self.bandwidth:
+            writer.write(body)
+        else:
+            # 帯域を制限するときは、少しずつ書き出しては待ちます。
+            for start in range(0, len(body), WRITE_CHUNK):
+                chunk = body[start:start + WRITE_CHUNK]
+                writer.write(chunk)
+                await writer.drain()
+                await asyncio.sleep(len(chunk) / self.bandwidth)
+        await writer.drain()
+
+
+async def read_request(reader):
+    """
+    リクエスト行とヘッダーを読み、(メソッド, パス, バージョン, ヘッダー)を返します。
+    接続が閉じられたらNoneを返します。本体のあるリクエストには対応していません。
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, path, version = line.decode('latin-1').split()
+    except ValueError:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return method, path, version, headers
+
+
+def port_of(label):
+    return int(SERVERS[label].split(':')[2].split('/')[0])
+
+
+def build_servers(args):
+    """
+    コマンドラインの引数から、(ポート番号, FlagServer)のリストを作成します。
+    """
+    codes = default_codes()
+    if args.codes:
+        codes = {cc.strip().upper() for cc in args.codes.split(',') if cc}
+    if args.preset == 'all':
+        labels = ['LOCAL', 'DELAY', 'ERROR']
+    elif args.preset:
+        labels = [args.preset]
+    else:
+        labels = []
+    servers = []
+    for label in labels:
+        settings = PRESETS[label]
+        server = FlagServer(codes, settings['delay'], settings['error_rate'],
+                            args.bandwidth, args.size, label)
+        servers.append((port_of(label), server))
+    if not labels:
+        server = FlagServer(codes, args.delay, args.error_rate,
+                            args.bandwidth, args.size, 'CUSTOM')
+        servers.append((args.port, server))
+    return servers
+
+
+def serve(servers, host='localhost'):
+    """
+    (ポート番号, FlagServer)のリストを受け取り、Ctrl-Cが押されるまで応答し続けます。
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    listeners = []
+    for port, server in servers:
+        coro = asyncio.start_server(server.handle_connection, host, port)
+        listeners.append(loop.run_until_complete(coro))
+        print(server.describe(port))
+    sys.stdout.flush()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for listener in listeners:
+            listener.close()
+            loop.run_until_complete(listener.wait_closed())
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve synthetic flags for the flags2 downloaders.')
+    parser.add_argument('--preset', choices=['LOCAL', 'DELAY', 'ERROR', 'all'],
+        help='serve on the port and with the behaviour of a SERVERS entry '
+            '(all: the three of them)')
+    parser.add_argument('-p', '--port', type=int, default=port_of('LOCAL'),
+        help='port to listen on without --preset (default=%(default)s)')
+    parser.add_argument('--delay', metavar='SPEC', default='const:0',
+        help='response delay distribution: const:X, uniform:A,B, exp:MEAN, '
+            'normal:MU,SIGMA or lognormal:MU,SIGMA (default=%(default)s)')
+    parser.add_argument('--error-rate', metavar='P', type=float, default=0,
+        help='fraction of requests answered with 503 (default=0)')
+    parser.add_argument('--bandwidth', metavar='BYTES', type=int, default=0,
+        help='bytes per second per connection; 0 means unlimited')
+    parser.add_argument('--size', metavar='BYTES', type=int,
+        help='size of every image (default: {} to {} bytes per code)'
+            .format(MIN_SIZE, MAX_SIZE))
+    parser.add_argument('--codes', metavar='CC,CC,...',
+        help='codes to serve (default: {} or {} fixed random codes)'
+            .format(COUNTRY_CODES_FILE, DEFAULT_CODE_COUNT))
+    args = parser.parse_args()
+    try:
+        parse_delay(args.delay)
+    except ValueError as exc:
+        print('*** Usage error:', exc)
+        parser.print_usage()
+        sys.exit(1)
+    if not 0 <= args.error_rate <= 1:
+        print('*** Usage error: --error-rate must be between 0 and 1')
+        parser.print_usage()
+        sys.exit(1)
+    serve(build_servers(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+国別コードのリストを分割し、複数のプロセスでダウンロードする実装（--procs）
+
+1つのイベントループは1つのコアしか使えないので、-m/--max_reqを大きくしても、
+TLSやレスポンスの解析でそのコアが埋まると速くなりません。
+--procs Nを指定すると、cc_listをN個に分け、プロセスごとに
+ダウンローダー（--backend）のdownload_manyを実行します。
+プロセスはそれぞれ自分のイベントループ（あるいはスレッドプール）と接続プールを持ちます。
+-m/--max_reqは全体の並行数で、プロセスの数で等分されます。
+
+各プロセスの結果のカウンタと統計（RunStats）は、final_reportの前に親プロセスでまとめます。
+索引（cache）、404の記録、--dedupeの記録も、プロセスが更新した分を親プロセスに取り込みます。
+
+Sample run::
+
+    $ python3 flags2_common.py -b threads -s LOCAL -e -m 40 --procs 4
+    LOCAL site: http://localhost:8001/flags
+    Searching for 676 flags: from AA to ZZ
+    40 concurrent connections will be used.
+    Sharded across 4 processes, 10 connections each.
+    --------------------
+    194 flags downloaded.
+    482 not found.
+    Elapsed time: 1.32s
+
+どれだけ速くなるかは、flags2_bench.py procsで比べられます。
+
+"""
+
+import os
+import copy
+import collections
+import contextlib
+from concurrent import futures
+
+import tqdm
+
+from flags2_common import NegativeCache, RunStats
+
+# --procsのデフォルトです。1なら分割しません。
+DEFAULT_PROCS = 1
+
+
+def split_codes(cc_list, procs):
+    """
+    cc_listをprocs個に分けます。404の多い文字と少ない文字があるので、
+    先頭から区切るのではなく、1つおきに（ラウンドロビンで）振り分けます。
+    """
+    cc_list = list(cc_list)
+    return [cc_list[i::procs] for i in range(procs)]
+
+
+def download_shard(download_many, cc_list, base_url, verbose, concur_req,
+                   options=None):
+    """
+    ワーカープロセスでdownload_manyを実行し、(カウンタ, RunStats, 索引の記録のdict)を返します。
+    optionsはpickleされて届くので、このプロセスだけのコピーです。
+    """
+    entries = {}
+    if options is not None:
+        options.stats = RunStats()
+        options.negatives = NegativeCache(None)
+        if options.store is not None:
+            # 重複の数はこのプロセスの分だけを数え、RunStatsに入れて返します。
+            options.store.counts = options.stats.dedupe
+
+    # 各プロセスがプログレスバーを表示すると重なってしまうので、親プロセスだけが表示します。
+    with open(os.devnull, 'w') as devnull:
+        redirect = (contextlib.redirect_stderr(devnull) if not verbose
+                    else contextlib.suppress())
+        with redirect:
+            counter = download_many(cc_list, base_url, verbose, concur_req,
+                                    options)
+
+    if options is None:
+        return counter, None, entries
+    entries['negatives'] = options.negatives.entries
+    if options.cache is not None:
+        entries['cache'] = {cc: options.cache.entries[cc] for cc in cc_list
+                            if cc in options.cache.entries}
+    if options.store is not None:
+        manifest = options.store.manifest.entries
+        filenames = (cc.lower() + '.gif' for cc in cc_list)
+        entries['manifest'] = {filename: manifest[filename]
+                               for filename in filenames
+                               if filename in manifest}
+    return counter, options.stats, entries
+
+
+def merge_entries(options, cc_list, entries):
+    """
+    ワーカープロセスが更新した索引の記録を、親プロセスのoptionsに取り込みます。
+    """
+    for cc, entry in entries.get('cache', {}).items():
+        options.cache.put(cc, entry)
+    for filename, entry in entries.get('manifest', {}).items():
+        options.store.manifest.put(filename, entry)
+    # cc_listのコードは記録になかった（か、期限が切れていた）ものなので、
+    # 今回404でなかったコードは記録から取り除きます。
+    negatives = entries['negatives']
+    for cc in cc_list:
+        if cc in negatives:
+            options.negatives.put(cc, negatives[cc])
+        else:
+            options.negatives.entries.pop(cc, None)
+
+
+def download_sharded(download_many, cc_list, base_url, verbose, concur_req,
+                     options=None, procs=DEFAULT_PROCS):
+    """
+    cc_listをprocs個に分け、それぞれをワーカープロセスのdownload_manyでダウンロードします。
+    最初の引数には、--backendのダウンローダーのdownload_manyを指定します。
+    """
+    if options is not None and options.archive is not None:
+        # アーカイブへの書き込み位置は1つのプロセスの中でしか管理できません。
+        raise ValueError('--archive is not available with --procs')
+
+    shards = [shard for shard in split_codes(cc_list, procs) if shard]
+    if not shards:
+        return collections.Counter()
+    per_proc = max(1, -(-concur_req // len(shards)))
+    shard_options = options
+    if options is not None and options.throttle is not None:
+        # トークンバケツはプロセスごとにできるので、--rateをプロセスの数で分け合います。
+        shard_options = copy.copy(options)
+        shard_options.throttle = options.throttle.split(len(shards))
+
+    counter = collections.Counter()
+    with futures.ProcessPoolExecutor(max_workers=len(shards)) as executor:
+        to_do_map = {}
+        for shard in shards:
+            future = executor.submit(download_shard, download_many, shard,
+                                     base_url, verbose, per_proc,
+                                     shard_options)
+            to_do_map[future] = shard
+
+        done_iter = futures.as_completed(to_do_map)
+        if not verbose:
+            # 親プロセスのプログレスバーは、国別コードの数をプロセスが終わるごとに進めます。
+            progress = tqdm.tqdm(total=sum(map(len, shards)))
+        for future in done_iter:
+            shard = to_do_map[future]
+            shard_counter, stats, entries = future.result()
+            counter.update(shard_counter)
+            if options is not None:
+                merge_entries(options, shard, entries)
+                options.stats.merge(stats)
+            if not verbose:
+                progress.update(len(shard))
+        if not verbose:
+            progress.close()
+
+    return counter
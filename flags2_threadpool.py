@@ -1,16 +1,19 @@
 import collections
 from concurrent import futures
 
-import requests
-
 # プログレス表示ライブラリをインポートします。
 import tqdm
 
-# flags2_commonモジュールから関数を1つ、Enumを1つインポートします。
-from flags2_common import main, HTTPStatus
+# flags2_commonモジュールから関数とEnumをインポートします。
+from flags2_common import (main, tally, HTTPStatus, count_hint, window_size,
+                           submit_windowed)
+
+# download_oneとerror_messageはflags2_sequentialのものを再利用します。
+from flags2_sequential import (download_one, download_batch, error_message,
+                               iter_batches, tally_batch, is_benign)
 
-# download_oneはflags2_sequentialのものを再利用します。
-from flags2_sequential import download_one
+# --adaptiveのときに並行数を制御します。
+from flags2_limits import AIMD, ThreadLimiter
 
 # コマンドラインの-m/--max_reqは並行スレッドプールの最大数を指定するオプションです。
 # デフォルトでは、並行して送信できるリクエストの最大数はここに示した30です。
@@ -22,9 +25,18 @@ DEFAULT_CONCUR_REQ = 30
 MAX_CONCUR_REQ = 1000
 
 
-def download_many(cc_list, base_url, verbose, concur_req):
+def download_many(cc_list, base_url, verbose, concur_req, options=None):
     counter = collections.Counter()
 
+    # --adaptiveが指定されたら、スレッドはconcur_req本用意しますが、
+    # 同時に実行されるダウンロードの数はAIMDで1から増減させます。
+    limiter = None
+    if options is not None and options.adaptive:
+        # download_oneは試行ごとにスロットを取得し、結果をAIMDに伝えます。
+        # 304と404はエラーとはみなしません。
+        limiter = ThreadLimiter(AIMD(1, concur_req), verbose, is_benign)
+        options.stats.concurrency = limiter.controller.history
+
     # main関数は実際に用意するプール数を、MAX_CONCUR_REQ、国旗の数（cc_listの要素数）、
     # そして-m/--max_reqコマンドラインオプションで指定された値のうちの最小の値から定めます。
     # この値は、この関数が呼ばれるときに第4引数として引き渡されます（concur_req）。
@@ -32,70 +44,69 @@ def download_many(cc_list, base_url, verbose, concur_req):
     # これにより、余分なスレッドが作成されないようになります。
     with futures.ThreadPoolExecutor(max_workers=concur_req) as executor:
 
-        # このdictはエラー報告用に、Futureインスタンスと国別コードをマップします。
-        # Futureインスタンスはそれぞれのダウンロードを表現しています。
-        to_do_map = {}
-
-        # 国別コードのアルファベット順のリストに対して反復処理します。
+        # download_oneに渡す呼び出し可能オブジェクトと、国別コードに続く引数です。
+        # executor.submitを1回呼び出すと、
+        # 呼び出し可能オブジェクトの実行を1つスケジュールし、Futureインスタンスが返されます。
+        # （国別コードのcc、ベースURLのbase_url、verbose、コマンドラインのoptions）
+        # 接続プールを持ったSessionは、ワーカースレッドごとにdownload_oneの中で用意されます。
+        if options is not None and options.batch:
+            # --batchなら、options.batch個ずつの国別コードのリストを1つのタスクにします。
+            # download_batchは国別コードごとの結果のリストを返し、例外は上げません。
+            batches = iter_batches(cc_list, options.batch)
+            progress = (None if verbose
+                        else tqdm.tqdm(total=count_hint(cc_list, options)))
+            for future, _ in submit_windowed(executor, download_batch,
+                                             batches,
+                                             window_size(concur_req, options),
+                                             base_url, verbose, options):
+                tally_batch(counter, future.result(), verbose, progress)
+            if progress is not None:
+                progress.close()
+            return counter
+
+        # 国別コードを先にすべて投入してFutureインスタンスを溜めるのではなく、
+        # submit_windowedが必要になった分だけcc_listから取り出して投入します。
+        # 同時に存在するFutureインスタンスはwindow個までなので、--everyのように
+        # コードが多いときでもメモリは増えません。cc_listはジェネレータでも構いません。
         # 結果が得られる順番は、何よりも、HTTPレスポンスがいつ返ってくるかに依存します。
         # しかし、concur_reqで指定されたスレッドプール数が国旗数（len(cc_list)）よりもずっと小さいときは、
         # ダウンロードがアルファベット順に処理されることもあります。
-        for cc in sorted(cc_list):
-
-            # executor.submitを1回呼び出すと、
-            # 呼び出し可能オブジェクトの実行を1つスケジュールし、Futureインスタンスが返されます。
-            # 第1引数が呼び出し可能オブジェクト（ここではdownload_one）で、
-            # 残りの引数はそのオブジェクトが受け取る引数です。
-            # （国別コードのcc、ベースURLのbase_url、verbose）
-            future = executor.submit(download_one, cc, base_url, verbose)
-
-            # 得られたfutureと国別コードをdictに格納します。
-            to_do_map[future] = cc
-
-        # futures.as_completedはFutureインスタンスのイテレータを返します。
-        # 各インスタンスは完了と同時にyieldされます。
-        done_iter = futures.as_completed(to_do_map)
+        window = window_size(concur_req, options)
+        done_iter = submit_windowed(executor, download_one, cc_list, window,
+                                    base_url, verbose, options, limiter)
 
         if not verbose:
             # verboseモードで実行されていなければ、
-            # 関数tqdmにas_completedから得られた結果を指定し、プログレスバーを表示します。
+            # 関数tqdmに完了したFutureインスタンスのイテレータを指定し、プログレスバーを表示します。
             # done_iterにはlenがないので、これだけでは残りの作業業を確定できません。
-            # そこで、先に説明したようにオプション引数のtotal=で予想される要素数をtqdmに伝えなければなりません。
-            done_iter = tqdm.tqdm(done_iter, total=len(cc_list))
+            # そこで、オプション引数のtotal=で予想される要素数をtqdmに伝えなければなりません。
+            done_iter = tqdm.tqdm(done_iter,
+                                  total=count_hint(cc_list, options))
 
         # 完了したFutureインスタンスに対して反復処理します。
-        for future in done_iter:
+        for future, cc in done_iter:
             try:
                 # Futureインスタンスのresultメソッドを呼び出すと、
                 # この呼び出し可能オブジェクトが返した値が返されるか、
                 # 実行時にキャッチされた例外が何であれ上げられます。
                 # このメソッドは、解決するまで処理をブロックすることがあります。
-                # しかし、この例ではas_completedは完了したFutureインスタンスを返すだけなので、
+                # しかし、この例ではsubmit_windowedは完了したFutureインスタンスを返すだけなので、
                 # ブロックはされません。
                 res = future.result()
 
             # 上げられる可能性のある例外を処理します。
             # 本関数のこれ以降の部分は、1行を除いて、逐次型のdownload_manyと同じです。
-            except requests.exceptions.HTTPError as exc:
-                error_msg = 'HTTP {res.status_code} - {res.reason}'
-                error_msg = error_msg.format(res=exc.response)
-            except reqeusts.exceptions.ConnectionError as exc:
-                error_msg = 'Connection error'
+            except Exception as exc:
+                error_msg = error_message(exc)
+                if error_msg is None:
+                    raise
+                status = HTTPStatus.error
             else:
                 error_msg = ''
                 status = res.status
 
-            if error_msg:
-                status = HTTPStatus.error
-            counter[status] += 1
-            if verbose and error_msg:
-                # エラーメッセージに必要なデータを得るため、
-                # その時点のFutureインスタンス（future）をキーに指定してto_do_mapから国別コードを取得します。
-                # 逐次型スクリプトでは国別コードのリストに対して反復処理したため、
-                # このような処理をせずともその時点でのccが入手できました。
-                # ここでは、Futureインスタンスに対して反復処理しているため、to_do_mapを用います。
-                cc = to_do_map[future]
-                print('*** Error for {}: {}'.format(cc, error_msg))
+            # エラーメッセージに必要な国別コードは、submit_windowedがFutureインスタンスと組にして返します。
+            tally(counter, cc, status, error_msg, verbose)
 
     return counter
 
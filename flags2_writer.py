@@ -0,0 +1,152 @@
+"""
+asyncio版のダウンローダーから利用する、ディスクへの書き込み
+
+書き込みは専用のスレッドプールで行い、書き込み待ちの画像のバイト数に上限（予算）を設けます。
+予算を超えると、書き込みを依頼したコルーチンは空きができるまで待たされます。
+"""
+
+import time
+import asyncio
+import collections
+from concurrent import futures
+
+from flags2_common import save_flag, WRITE_WORKERS, WRITE_BUFFER
+
+# まとめ書きのときに、1回でスレッドに渡す最大のバイト数です。
+BATCH_BYTES = 256 * 1024
+
+
+def write_batch(items, metrics=None, store=None):
+    """
+    (filename, data)のリストを順に書き出し、それぞれの例外（成功ならNone）のリストを返します。
+    1つの失敗で残りの書き込みを止めないよう、例外はここで受け止めます。
+    """
+    errors = []
+    for filename, data in items:
+        try:
+            save_flag(data, filename, metrics, store)
+        except Exception as exc:
+            errors.append(exc)
+        else:
+            errors.append(None)
+    return errors
+
+
+class AsyncWriter:
+    """
+    画像をディスクに書き出す専用のスレッドプールと、書き込み待ちのバイト数の予算です。
+
+    submitは予算に空きができるまで待ってから書き込みを依頼し、完了を表すFutureを返します。
+    batchが真なら、イベントループの同じ周回で依頼された画像をまとめて1つのスレッドに渡し、
+    スレッドの切り替えとイベントループへの通知の回数を減らします。
+    コルーチンはすべて同じスレッドで動くので、ロックは必要ありません。
+    """
+
+    def __init__(self, workers=WRITE_WORKERS, max_bytes=WRITE_BUFFER,
+                 batch=False, metrics=None, store=None):
+        self.executor = futures.ThreadPoolExecutor(workers)
+        self.store = store
+        self.max_bytes = max_bytes
+        self.batch = batch
+        self.metrics = metrics
+        self.pending = 0
+        self.peak = 0
+        self.files = 0
+        self.batches = 0
+        self.waited = 0.0
+        self._waiters = collections.deque()
+        self._queue = []
+        self._outstanding = set()
+
+    async def submit(self, data, filename):
+        size = len(data)
+        # 予算より大きな画像も、ほかに書き込み待ちがなければ受け付けます。
+        t0 = time.time()
+        while self.pending and self.pending + size > self.max_bytes:
+            waiter = asyncio.Future()
+            self._waiters.append(waiter)
+            await waiter
+        self.waited += time.time() - t0
+        self.pending += size
+        self.peak = max(self.peak, self.pending)
+        done = asyncio.Future()
+
+        def release(done):
+            self._outstanding.discard(done)
+            self._release(size)
+
+        done.add_done_callback(release)
+        self._outstanding.add(done)
+        if self.batch:
+            # 最初の1件が来たときに、周回の終わりでまとめて書き出すよう予約します。
+            if not self._queue:
+                asyncio.get_event_loop().call_soon(self._flush)
+            self._queue.append((filename, data, done))
+        else:
+            self._run([(filename, data, done)])
+        return done
+
+    async def write(self, data, filename):
+        """
+        書き込みを依頼し、完了を待ちます。書き込みのエラーはここから上がります。
+        """
+        done = await self.submit(data, filename)
+        await done
+
+    def _flush(self):
+        items, self._queue = self._queue, []
+        batch, size = [], 0
+        for item in items:
+            batch.append(item)
+            size += len(item[1])
+            if size >= BATCH_BYTES:
+                self._run(batch)
+                batch, size = [], 0
+        if batch:
+            self._run(batch)
+
+    def _run(self, items):
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(
+            self.executor, write_batch,
+            [(filename, data) for filename, data, _ in items], self.metrics,
+            self.store)
+        self.batches += 1
+
+        def set_results(future):
+            if future.exception() is not None:
+                errors = [future.exception()] * len(items)
+            else:
+                errors = future.result()
+            for (_, _, done), exc in zip(items, errors):
+                if exc is None:
+                    self.files += 1
+                    done.set_result(None)
+                else:
+                    done.set_exception(exc)
+
+        future.add_done_callback(set_results)
+
+    def _release(self, size):
+        self.pending -= size
+        # 待っているコルーチンをすべて起こし、それぞれに予算を確かめ直させます。
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def close(self):
+        """
+        残っている書き込みがすべて終わるのを待ってから、スレッドプールを終了します。
+        """
+        if self._outstanding:
+            await asyncio.wait(list(self._outstanding))
+        self.executor.shutdown()
+
+    def summary(self):
+        return {
+            'files': self.files,
+            'batches': self.batches,
+            'peak_bytes': self.peak,
+            'waited': self.waited,
+        }
@@ -0,0 +1,203 @@
+"""
+arcfour_futures.pyとsha_futures.pyのワーカー数による性能比較
+
+各ワークロード（JOBS個のジョブ）を、ワーカー数を1から2×コア数まで変えながら、
+ProcessPoolExecutorとThreadPoolExecutorでそれぞれ--repeat回ずつ実行し、
+経過時間の平均と標準偏差、ワーカー1つのときに対する速度向上率（speedup）と
+並列化効率（efficiency = speedup / workers）を表示します。
+--csvと--jsonを指定すると、同じ結果をファイルに書き出します（-は標準出力）。
+
+arcfourは純粋なPythonなので、スレッドではGILに阻まれて速くなりません。
+shaのhashlibは大きなデータを処理する間GILを解放するので、スレッドでも速くなります。
+shaのデータ（既定では1ジョブ64MiB、--sha-sizeで変更できます）は親プロセスで作っておくので、
+プロセスではその分のpickleが加わります。
+計測するのはジョブの投入から完了までで、プールの起動と終了の時間は含めません。
+
+Sample run::
+
+    $ python3 futures_bench.py -w 1 2 -r 2 --json results.json
+    workload executor  workers     mean    stdev  speedup  efficiency
+    arcfour  process         1    2.04s   0.068s     1.00        1.00
+    arcfour  process         2    2.39s   0.144s     0.85        0.43
+    arcfour  thread          1    3.19s   0.094s     1.00        1.00
+    arcfour  thread          2    3.27s   0.065s     0.97        0.49
+    sha      process         1    3.12s   0.020s     1.00        1.00
+    sha      process         2    3.29s   0.066s     0.95        0.47
+    sha      thread          1    0.62s   0.016s     1.00        1.00
+    sha      thread          2    0.61s   0.006s     1.01        0.51
+
+上の例は1コアのマシンのものなので、どちらのExecutorでもワーカーを増やしても速くなりません。
+shaのprocessが遅いのは、768MiBのデータをpickleしてワーカーに送るためです。
+コアが複数あれば、arcfourはprocessだけが、shaはthreadでも速くなるはずです。
+
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import statistics
+import collections
+from concurrent import futures
+
+import arcfour_futures
+import sha_futures
+
+EXECUTORS = collections.OrderedDict([
+    ('process', futures.ProcessPoolExecutor),
+    ('thread', futures.ThreadPoolExecutor),
+])
+
+REPEAT = 3
+# shaの1ジョブあたりのバイト数です。sha_futures.SIZE（1MiB）では12ジョブでも数ミリ秒で終わり、
+# プールとのやり取りの時間に埋もれてしまうので、大きくしています。
+SHA_SIZE = 2**26
+
+HEADER = '{:<9}{:<9}{:>8}{:>9}{:>9}{:>9}{:>12}'
+ROW = '{:<9}{:<9}{:>8}{:>8.2f}s{:>8.3f}s{:>9.2f}{:>12.2f}'
+FIELDS = ['workload', 'executor', 'workers', 'mean', 'stdev', 'speedup',
+          'efficiency']
+
+
+def arcfour_jobs(size=arcfour_futures.SIZE):
+    return arcfour_futures.arcfour_test, [
+        (job_size, arcfour_futures.KEY)
+        for job_size in arcfour_futures.job_sizes(size=size)]
+
+
+def sha_jobs(size=SHA_SIZE):
+    data = os.urandom(size)
+    return sha_futures.sha_digest, [(data,)] * sha_futures.JOBS
+
+
+WORKLOADS = collections.OrderedDict([
+    ('arcfour', arcfour_jobs),
+    ('sha', sha_jobs),
+])
+
+# ワークロードごとの、1ジョブあたりのバイト数の既定値です（--arcfour-sizeと--sha-size）。
+SIZES = {'arcfour': arcfour_futures.SIZE, 'sha': SHA_SIZE}
+
+
+def run_once(executor_class, workers, fn, jobs):
+    """ すべてのジョブが終わるまでの秒数を返します。プールの起動と終了は含めません """
+    with executor_class(workers) as executor:
+        # ワーカーの起動時間を計測に含めないよう、先に全員を起こしておきます。
+        list(executor.map(len, [b''] * workers))
+        t0 = time.time()
+        to_do = [executor.submit(fn, *args) for args in jobs]
+        for future in futures.as_completed(to_do):
+            future.result()
+        elapsed = time.time() - t0
+    return elapsed
+
+
+def sweep(workloads, executors, worker_counts, repeat=REPEAT, sizes=None):
+    """
+    結果の行（FIELDSをキーとするdict）のリストを返します。
+    sizesには、ワークロードの名前から1ジョブあたりのバイト数へのdictを指定します。
+    """
+    sizes = dict(SIZES, **(sizes or {}))
+    rows = []
+    for workload in workloads:
+        fn, jobs = WORKLOADS[workload](sizes[workload])
+        for executor in executors:
+            baseline = None
+            for workers in worker_counts:
+                times = [run_once(EXECUTORS[executor], workers, fn, jobs)
+                         for _ in range(repeat)]
+                mean = statistics.mean(times)
+                stdev = statistics.stdev(times) if repeat > 1 else 0.0
+                if baseline is None:
+                    baseline = mean  # worker_countsの先頭は必ず1です。
+                speedup = baseline / mean
+                rows.append(dict(zip(FIELDS, [
+                    workload, executor, workers, mean, stdev, speedup,
+                    speedup / workers])))
+                print(ROW.format(*(rows[-1][name] for name in FIELDS)),
+                      file=sys.stderr)
+    return rows
+
+
+def open_output(path):
+    if path == '-':
+        return sys.stdout
+    return open(path, 'w', newline='')
+
+
+def write_csv(rows, path):
+    fp = open_output(path)
+    try:
+        writer = csv.DictWriter(fp, FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+
+
+def write_json(rows, path, meta):
+    fp = open_output(path)
+    try:
+        json.dump(dict(meta, results=rows), fp, indent=2)
+        fp.write('\n')
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+
+
+def main():
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(
+        description='Sweep worker counts for arcfour_futures and sha_futures.')
+    parser.add_argument('-l', '--workload', nargs='+', choices=list(WORKLOADS),
+        default=list(WORKLOADS),
+        help='workloads to run (default: all of them)')
+    parser.add_argument('-x', '--executor', nargs='+', choices=list(EXECUTORS),
+        default=list(EXECUTORS),
+        help='executors to compare (default: all of them)')
+    parser.add_argument('-w', '--workers', metavar='N', type=int, nargs='+',
+        help='worker counts, 1 is always included '
+            '(default: 1 to 2 x cores = {})'.format(2 * cores))
+    parser.add_argument('-r', '--repeat', metavar='N', type=int,
+        default=REPEAT,
+        help='runs per configuration (default={})'.format(REPEAT))
+    parser.add_argument('--arcfour-size', metavar='BYTES', type=int,
+        default=SIZES['arcfour'],
+        help='average bytes per arcfour job (default={})'.format(
+            SIZES['arcfour']))
+    parser.add_argument('--sha-size', metavar='BYTES', type=int,
+        default=SIZES['sha'],
+        help='bytes hashed per sha job (default={})'.format(SIZES['sha']))
+    parser.add_argument('--csv', metavar='PATH',
+        help='write the results as CSV (- for stdout)')
+    parser.add_argument('--json', metavar='PATH',
+        help='write the results as JSON (- for stdout)')
+    args = parser.parse_args()
+
+    worker_counts = set(args.workers or range(1, 2 * cores + 1))
+    if (min(worker_counts) < 1 or args.repeat < 1 or args.arcfour_size < 1
+            or args.sha_size < 1):
+        print('*** Usage error: --workers, --repeat, --arcfour-size and '
+              '--sha-size must be positive')
+        sys.exit(1)
+    # speedupとefficiencyの基準にするため、ワーカー1つの計測は必ず行います。
+    worker_counts = sorted(worker_counts | {1})
+
+    # 途中経過は標準エラー出力に表示し、CSVやJSONを標準出力に書き出せるようにします。
+    print(HEADER.format(*FIELDS), file=sys.stderr)
+    sizes = {'arcfour': args.arcfour_size, 'sha': args.sha_size}
+    rows = sweep(args.workload, args.executor, worker_counts, args.repeat,
+                 sizes)
+    meta = {'cores': cores, 'repeat': args.repeat, 'sizes': sizes,
+            'python': sys.version.split()[0]}
+    if args.csv:
+        write_csv(rows, args.csv)
+    if args.json:
+        write_json(rows, args.json, meta)
+
+
+if __name__ == '__main__':
+    main()
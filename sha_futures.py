@@ -12,19 +12,22 @@ SIZE = 2**20
 STATUS = '{} workers, elapsed time: {:.2f}s'
 
 
-def sha(size):
-    data = bytearray(randrange(256) for i i range(size))
+def sha_digest(data):
     algo = hashlib.new('sha256')
     algo.update(data)
     return algo.hexdigest()
 
+def sha(size):
+    data = bytearray(randrange(256) for i in range(size))
+    return sha_digest(data)
+
 def main(workers=None):
     if workers:
         workers = int(workers)
     t0 = time.time()
 
     with futures.ProcessPoolExecutor(workers) as executor:
-        actual_worders = executor._max_workers
+        actual_workers = executor._max_workers
         to_do = (executor.submit(sha, SIZE) for i in range(JOBS))
         for future in futures.as_completed(to_do):
             res = future.result()